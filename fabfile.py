@@ -1,10 +1,16 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import atexit
 import codecs
+import collections
 import datetime
+import functools
 import json
 import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import webbrowser
 from io import BytesIO, StringIO
@@ -12,9 +18,22 @@ from io import BytesIO, StringIO
 import pkg_resources
 import requests
 import yaml
-from fabric.api import get, hosts, lcd, local, put, run, settings, sudo, task
+from fabric.api import (
+    get,
+    hide,
+    hosts,
+    lcd,
+    local,
+    put,
+    run,
+    settings,
+    sudo,
+    task,
+)
 from fabric.contrib import files
-from fabric.state import env
+from fabric.exceptions import NetworkError
+from fabric.network import normalize_to_string
+from fabric.state import connections, env
 from fabric.utils import abort
 
 
@@ -41,6 +60,104 @@ env.target = os.environ.get("TARGET", None)
 env.tag = os.environ.get("TAG", None)
 env.rpi_user = os.environ.get("RPI_USER", env.rpi_user)
 
+# notice dead connections (e.g. to a rebooted DUT) instead of hanging on them
+env.keepalive = env.get("ssh_keepalive", 15)
+
+
+##~~ SSH sessions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Fabric keeps one connection per host for the whole run and multiplexes all
+# commands over it as channels. The wrappers below make sure that connection is
+# dropped and transparently reopened once the host went away, e.g. after a reboot,
+# and record how long each operation took.
+
+ssh_stats = collections.defaultdict(list)
+
+
+def ssh_session_alive(host_string):
+    client = dict.get(connections, normalize_to_string(host_string))
+    if client is None:
+        return True
+
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+
+    # a full round trip, anything merely queued locally would succeed until TCP gives up
+    try:
+        channel = transport.open_session(timeout=env.get("ssh_alive_timeout", 5))
+    except Exception:
+        return False
+    channel.close()
+    return True
+
+
+def ssh_drop_session(host_string=None):
+    """closes the connection to host_string, the next operation on it reconnects"""
+    if host_string is None:
+        host_string = env.host_string
+    if not host_string:
+        return
+
+    client = dict.pop(connections, normalize_to_string(host_string), None)
+    if client is not None:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+def ssh_session(operation):
+    @functools.wraps(operation)
+    def wrapper(*args, **kwargs):
+        host_string = env.host_string
+        if host_string and not ssh_session_alive(host_string):
+            print("Connection to {} went away, reconnecting".format(host_string))
+            ssh_drop_session(host_string)
+
+        start = time.monotonic()
+        try:
+            return operation(*args, **kwargs)
+        finally:
+            ssh_stats[(env.host_string, operation.__name__)].append(
+                time.monotonic() - start
+            )
+
+    return wrapper
+
+
+run = ssh_session(run)
+sudo = ssh_session(sudo)
+get = ssh_session(get)
+put = ssh_session(put)
+
+# fabric.contrib.files calls fabric's own run/sudo, so use wrapped aliases of its helpers
+files_exists = ssh_session(files.exists)
+files_append = ssh_session(files.append)
+files_upload_template = ssh_session(files.upload_template)
+
+
+def print_ssh_stats():
+    if not ssh_stats:
+        return
+
+    print("SSH operation latency:")
+    for (host_string, operation), durations in sorted(ssh_stats.items()):
+        print(
+            "  {} {}: {} calls, avg {:.0f}ms, max {:.0f}ms, total {:.1f}s".format(
+                host_string,
+                operation,
+                len(durations),
+                sum(durations) / len(durations) * 1000,
+                max(durations) * 1000,
+                sum(durations),
+            )
+        )
+
+
+if env.get("ssh_stats") or os.environ.get("SSH_STATS"):
+    atexit.register(print_ssh_stats)
+
 
 RELEASE_CHANNEL_LOOKUP = {
     "maintenance": "rc/maintenance",
@@ -98,6 +215,13 @@ def dict_merge(a, b, leaf_merger=None):
     return result
 
 
+def is_true(value):
+    """interprets task arguments, which arrive as strings from the command line"""
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes", "y", "on")
+    return bool(value)
+
+
 def normalize_version(version):
     if "-" in version:
         version = version[: version.find("-")]
@@ -144,6 +268,139 @@ def get_comparable_version(version_string, cut=None, **kwargs):
     return version
 
 
+##~~ Checkpoints ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Every target has a journal of the steps of its flash, provision & test chain that
+# completed, along with a hash of their inputs. When a chain gets rerun after a failure,
+# steps already in the journal with the same inputs get skipped. Rerunning a step with
+# different inputs drops it and everything after it from the journal, once a test has
+# finished the next step starts a new journal.
+
+
+def journal_path(target):
+    return os.path.join(
+        os.path.expanduser(env.get("journal", "~/.cache/octoprint-devtools/journal")),
+        "{}.json".format(target),
+    )
+
+
+def journal_load(target):
+    try:
+        with open(journal_path(target), encoding="utf-8") as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return dict(steps=[], done=False)
+
+    max_age = env.get("journal_max_age", 6 * 60 * 60)
+    if journal.get("done") or time.time() - journal.get("updated", 0) > max_age:
+        return dict(steps=[], done=False)
+    return journal
+
+
+def journal_save(target, journal):
+    path = journal_path(target)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    journal["updated"] = time.time()
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(journal, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def journal_steps(target, exclude=()):
+    """returns the steps in the journal of target, even if its chain already finished"""
+    try:
+        with open(journal_path(target), encoding="utf-8") as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [entry for entry in journal.get("steps", []) if entry["step"] not in exclude]
+
+
+def journal_restore(target, steps):
+    """starts a new journal for target with steps already done"""
+    journal_save(target, dict(steps=list(steps), done=False))
+
+
+def journal_reset(target):
+    if target and os.path.exists(journal_path(target)):
+        os.remove(journal_path(target))
+
+
+def inputs_hash(inputs):
+    import hashlib
+
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def checkpoint(target, step, inputs=None, resume=True):
+    """
+    returns True if step already completed on target with the same inputs and can be
+    skipped, otherwise drops it and everything after it from the journal
+    """
+    if not target:
+        return False
+
+    journal = journal_load(target)
+    for index, entry in enumerate(journal["steps"]):
+        if entry["step"] == step:
+            if is_true(resume) and entry["inputs"] == inputs_hash(inputs):
+                print(
+                    "Skipping {} on {}, already done at {} (resume=0 to redo)".format(
+                        step, target, entry["time"]
+                    )
+                )
+                return True
+            journal["steps"] = journal["steps"][:index]
+            journal_save(target, journal)
+            break
+    return False
+
+
+def checkpoint_drop(target, step):
+    """drops step and everything after it from the journal of target"""
+    checkpoint(target, step, resume=False)
+
+
+def checkpoint_done(target, step, inputs=None):
+    if not target:
+        return
+
+    journal = journal_load(target)
+    journal["steps"] = [entry for entry in journal["steps"] if entry["step"] != step]
+    journal["steps"].append(
+        dict(
+            step=step,
+            inputs=inputs_hash(inputs),
+            time=datetime.datetime.now().replace(microsecond=0).isoformat(" "),
+        )
+    )
+    journal_save(target, journal)
+
+
+def checkpoint_finish(target):
+    """marks the chain on target as complete, the next step starts a new journal"""
+    if not target:
+        return
+
+    journal = journal_load(target)
+    journal["done"] = True
+    journal_save(target, journal)
+
+
+def directory_hash(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    for root, dirs, names in sorted(os.walk(path)):
+        for name in sorted(names):
+            with open(os.path.join(root, name), "rb") as f:
+                digest.update(name.encode("utf-8"))
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
 ##~~ Release testing ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
@@ -275,15 +532,156 @@ def venv_executable(venv, executable):
         return "{}/bin/{}".format(venv, executable)
 
 
-def test_install(installable, python, target="wheel"):
+def installable_requirements(installable):
+    """Requires-Dist of a local wheel or sdist or of OctoPrint==<version>, None if unknown"""
+    import email.parser
+    import tarfile
+    import zipfile
+
+    metadata = None
+    path = os.path.join(env.octoprint, installable)
+    try:
+        if installable.endswith(".whl"):
+            with zipfile.ZipFile(path) as z:
+                for name in z.namelist():
+                    if name.endswith(".dist-info/METADATA"):
+                        metadata = z.read(name)
+                        break
+
+        elif installable.endswith(".tar.gz"):
+            with tarfile.open(path) as t:
+                for member in t.getmembers():
+                    if member.name.count("/") == 1 and member.name.endswith("/PKG-INFO"):
+                        metadata = t.extractfile(member).read()
+                        break
+
+        elif installable.startswith("OctoPrint=="):
+            r = requests.get(
+                "https://pypi.org/pypi/OctoPrint/{}/json".format(
+                    installable[len("OctoPrint==") :]
+                ),
+                timeout=10,
+            )
+            if r.status_code == 200:
+                return sorted(r.json()["info"].get("requires_dist") or [])
+
+    except Exception as exc:
+        print("Could not read requirements of {}: {}".format(installable, exc))
+
+    if metadata is None:
+        return None
+
+    message = email.parser.BytesParser().parsebytes(metadata, headersonly=True)
+    return sorted(message.get_all("Requires-Dist") or []) or None
+
+
+def venv_template(installable, python, refresh=False):
+    """
+    returns the path of a venv with all dependencies of installable installed into
+    python, creating it if needed, or None if the dependencies can't be determined
+    """
+    import hashlib
+
+    requirements = installable_requirements(installable)
+    if requirements is None:
+        return None
+
+    interpreter = getattr(env, python)
+    version = local(
+        '{} -c "import sys; print(sys.version)"'.format(interpreter), capture=True
+    )
+    key = hashlib.sha256(
+        json.dumps(
+            [os.path.realpath(interpreter), version, requirements], sort_keys=True
+        ).encode("utf-8")
+    ).hexdigest()[:16]
+
+    templates = os.path.expanduser(
+        env.get("venv_templates", "~/.cache/octoprint-devtools/venvs")
+    )
+    template = os.path.join(templates, "{}-{}".format(python, key))
+    if os.path.exists(os.path.join(template, ".complete")) and not refresh:
+        return template
+
+    print("Creating venv template {} for {}".format(template, installable))
+    shutil.rmtree(template, ignore_errors=True)
+    with lcd(env.octoprint):
+        local("{} -m venv {}".format(interpreter, template))
+        local(
+            "{} -m pip install {}".format(
+                venv_executable(template, "python"), installable
+            )
+        )
+        local(
+            "{} -m pip uninstall -y OctoPrint".format(
+                venv_executable(template, "python")
+            )
+        )
+    with open(os.path.join(template, ".complete"), "w") as f:
+        f.write("\n".join(requirements))
+
+    return template
+
+
+def clone_venv(template, venv):
+    """clones template to venv, copy-on-write if possible and via hardlinks otherwise"""
+    import subprocess
+
+    if os.path.exists(venv):
+        shutil.rmtree(venv)
+
+    if sys.platform.startswith("linux") and (
+        subprocess.call(
+            ["cp", "-a", "--reflink=always", template, venv], stderr=subprocess.DEVNULL
+        )
+        == 0
+    ):
+        pass
+    else:
+        shutil.rmtree(venv, ignore_errors=True)
+        try:
+            shutil.copytree(template, venv, symlinks=True, copy_function=os.link)
+        except OSError:
+            # different filesystem
+            shutil.rmtree(venv, ignore_errors=True)
+            shutil.copytree(template, venv, symlinks=True)
+
+    # console scripts still point at the template's interpreter, replace them (which
+    # also makes sure we never write through a hardlink into the template)
+    old = os.path.abspath(template).encode("utf-8")
+    new = os.path.abspath(venv).encode("utf-8")
+    bindir = os.path.dirname(venv_executable(venv, "python"))
+    for name in os.listdir(bindir):
+        path = os.path.join(bindir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        if old in data:
+            mode = os.stat(path).st_mode
+            os.remove(path)
+            with open(path, "wb") as f:
+                f.write(data.replace(old, new))
+            os.chmod(path, mode)
+
+
+def test_install(installable, python, target="wheel", fresh=False):
     basedir = "testconf-dist"
     venv = "venv-dist"
 
+    template = None
+    if not is_true(fresh):
+        template = venv_template(installable, python)
+
     with lcd(env.octoprint):
         local("rm -rf {} || true".format(venv))
         local("rm -rf {} || true".format(basedir))
 
-        local("{} -m venv {}".format(getattr(env, python), venv))
+        if template:
+            # dependencies are already satisfied, so this only installs OctoPrint
+            clone_venv(template, os.path.join(env.octoprint, venv))
+        else:
+            local("{} -m venv {}".format(getattr(env, python), venv))
         local(
             "{} -m pip install {}".format(venv_executable(venv, "python"), installable)
         )
@@ -295,7 +693,146 @@ def test_install(installable, python, target="wheel"):
         )
 
 
-def test_local(tag, python, target="wheel"):
+def source_tree_hash(path):
+    """git tree hash of the working tree at path, uncommitted changes included"""
+    import subprocess
+
+    index = subprocess.check_output(
+        ["git", "rev-parse", "--git-path", "index"], cwd=path, universal_newlines=True
+    ).strip()
+
+    # stage everything into a copy of the index, keeping the real one untouched
+    fd, tmp = tempfile.mkstemp(prefix="index-")
+    os.close(fd)
+    try:
+        shutil.copyfile(os.path.join(path, index), tmp)
+        git_env = dict(os.environ, GIT_INDEX_FILE=tmp)
+        subprocess.check_call(["git", "add", "-A"], cwd=path, env=git_env)
+        return subprocess.check_output(
+            ["git", "write-tree"], cwd=path, env=git_env, universal_newlines=True
+        ).strip()
+    finally:
+        os.remove(tmp)
+
+
+def build_backend_version(path):
+    """build backend and build frontend versions used for building the project at path"""
+    import importlib.metadata
+
+    backend = "setuptools.build_meta:__legacy__"
+    try:
+        import tomllib
+
+        with open(os.path.join(path, "pyproject.toml"), "rb") as f:
+            backend = tomllib.load(f).get("build-system", {}).get("build-backend", backend)
+    except (ImportError, OSError, ValueError):
+        pass
+
+    versions = [backend]
+    for distribution in (backend.split(".")[0].split(":")[0], "build"):
+        try:
+            versions.append(
+                "{}=={}".format(distribution, importlib.metadata.version(distribution))
+            )
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return " ".join(versions)
+
+
+def build_artifact(target, parallel=False):
+    """
+    returns the path of the sdist or wheel built from the current state of env.octoprint,
+    building only what's not in the build cache yet
+
+    with parallel, sdist and wheel get built concurrently (the wheel from a copy of the
+    tree, as both builds write to it)
+    """
+    import hashlib
+    import subprocess
+
+    targets = ["sdist", "wheel"] if parallel else [target]
+
+    # the version of the build comes from the latest tag
+    describe = local(
+        "git -C {} describe --tags --always".format(env.octoprint), capture=True
+    )
+    key = hashlib.sha256(
+        "{} {} {}".format(
+            source_tree_hash(env.octoprint),
+            describe,
+            build_backend_version(env.octoprint),
+        ).encode("utf-8")
+    ).hexdigest()[:16]
+    cache = os.path.join(
+        os.path.expanduser(env.get("build_cache", "~/.cache/octoprint-devtools/builds")),
+        key,
+    )
+
+    def cached(t):
+        path = os.path.join(cache, t)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if name.endswith(".tar.gz" if t == "sdist" else ".whl"):
+                    return os.path.join(path, name)
+        return None
+
+    missing = [t for t in targets if cached(t) is None]
+    if missing:
+        print("Building {} of {} (build key {})".format(" & ".join(missing), env.octoprint, key))
+        workdirs = []
+        processes = []
+        try:
+            for t in missing:
+                source = env.octoprint
+                if parallel and t == "wheel" and len(missing) > 1:
+                    workdir = tempfile.mkdtemp(prefix="octoprint-build-")
+                    workdirs.append(workdir)
+                    source = os.path.join(workdir, "src")
+                    shutil.copytree(
+                        env.octoprint,
+                        source,
+                        symlinks=True,
+                        ignore=shutil.ignore_patterns(
+                            "build", "dist", "venv*", "testconf*", "*.egg-info", ".tox"
+                        ),
+                    )
+
+                outdir = tempfile.mkdtemp(prefix="octoprint-dist-")
+                workdirs.append(outdir)
+                command = [sys.executable, "-m", "build", "--" + t, "--outdir", outdir]
+                process = subprocess.Popen(command, cwd=source)
+                processes.append((t, process, outdir))
+                if not parallel:
+                    process.wait()
+
+            for t, process, outdir in processes:
+                if process.wait() != 0:
+                    abort("Building the {} failed".format(t))
+                os.makedirs(os.path.join(cache, t), exist_ok=True)
+                for name in os.listdir(outdir):
+                    shutil.move(os.path.join(outdir, name), os.path.join(cache, t, name))
+        finally:
+            for workdir in workdirs:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    return cached(target)
+
+
+def check_build_version(installable, tag):
+    """aborts unless the sdist or wheel at installable is a build of tag"""
+    name = os.path.basename(installable)
+    if name.endswith(".tar.gz"):
+        name = name[: -len(".tar.gz")]
+    version = name.split("-")[1] if "-" in name else None
+    if version not in (tag, pkg_resources.safe_version(tag)):
+        abort(
+            "{} is not a build of {}, check out {} in {} first".format(
+                os.path.basename(installable), tag, tag, env.octoprint
+            )
+        )
+
+
+def test_local(tag, python, target="wheel", fresh=False, parallel=False):
     # test local install of tag against python version and wheel/sdist
     if tag is None:
         tag = env.tag
@@ -303,37 +840,238 @@ def test_local(tag, python, target="wheel"):
     if tag is None:
         abort("Tag needs to be set")
 
-    with lcd(env.octoprint):
-        if not os.path.exists(os.path.join("dist", "OctoPrint-{}.tar.gz".format(tag))):
-            local("{} -m build".format(sys.executable))
-
-    if target == "wheel":
-        installable = "dist/OctoPrint-{}-py3-none-any.whl".format(tag)
-    elif target == "sdist":
-        installable = "dist/OctoPrint-{}.tar.gz".format(tag)
-    else:
+    if target not in ("wheel", "sdist"):
         abort("Unknown target {}".format(target))
         return
 
-    test_install(installable, python)
+    installable = build_artifact(target, parallel=is_true(parallel))
+    check_build_version(installable, tag)
+
+    test_install(installable, python, fresh=fresh)
 
 
 @task
-def test_sdist(python, tag=None):
+def test_sdist(python, tag=None, fresh=False, parallel=False):
     """test sdist install of tag against python version"""
-    test_local(tag, python, target="sdist")
+    test_local(tag, python, target="sdist", fresh=fresh, parallel=parallel)
 
 
 @task
-def test_wheel(python, tag=None):
+def test_wheel(python, tag=None, fresh=False, parallel=False):
     """test wheel install of tag against python version"""
-    test_local(tag, python, target="wheel")
+    test_local(tag, python, target="wheel", fresh=fresh, parallel=parallel)
 
 
 @task
-def test_version(version, python="python37"):
+def test_version(version, python="python37", fresh=False):
     """test install of version against python version"""
-    test_install("OctoPrint=={}".format(version), python)
+    test_install("OctoPrint=={}".format(version), python, fresh=fresh)
+
+
+_reserved_ports = set()
+_reserved_ports_lock = threading.Lock()
+
+
+def free_port():
+    """
+    reserves a free local port for a server started right after, returns it
+
+    the port is connected to once and closed on our end, which leaves it in TIME_WAIT:
+    the kernel won't hand it out as an ephemeral port again for a while, but a server
+    binding it with SO_REUSEADDR (as tornado does) still can. ports handed out here are
+    also remembered, so that parallel cells never get the same one.
+    """
+    import socket
+
+    with _reserved_ports_lock:
+        while True:
+            with socket.socket() as listener:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind(("127.0.0.1", 0))
+                listener.listen(1)
+                port = listener.getsockname()[1]
+
+                with socket.socket() as client:
+                    client.connect(("127.0.0.1", port))
+                    accepted, _ = listener.accept()
+                    accepted.close()
+
+            if port not in _reserved_ports:
+                _reserved_ports.add(port)
+                return port
+
+
+def test_matrix_path(*parts):
+    # outside the checkout, anything in there would change its source tree hash
+    return os.path.join(
+        os.path.expanduser(env.get("testmatrix", "~/.cache/octoprint-devtools/testmatrix")),
+        *parts
+    )
+
+
+def smoke_test(installable, python, target, template=None, timeout=120):
+    """
+    installs installable for python into its own venv and starts the server on a
+    free port until it answers, returns the timings
+    """
+    import subprocess
+
+    workdir = test_matrix_path("{}-{}".format(python, target))
+    venv = os.path.join(workdir, "venv")
+    basedir = os.path.join(workdir, "basedir")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+
+    result = dict(python=python, target=target, ok=False)
+    start = time.monotonic()
+    with open(os.path.join(workdir, "install.log"), "w") as log:
+        if template:
+            clone_venv(template, venv)
+        elif subprocess.call(
+            [getattr(env, python), "-m", "venv", venv], stdout=log, stderr=log
+        ):
+            result["error"] = "creating venv failed"
+            return result
+
+        if subprocess.call(
+            [venv_executable(venv, "python"), "-m", "pip", "install", installable],
+            cwd=env.octoprint,
+            stdout=log,
+            stderr=log,
+        ):
+            result["error"] = "install failed"
+            return result
+    result["install"] = time.monotonic() - start
+
+    port = free_port()
+    result["port"] = port
+    start = time.monotonic()
+    with open(os.path.join(workdir, "server.log"), "w") as log:
+        server = subprocess.Popen(
+            [
+                venv_executable(venv, "octoprint"),
+                "serve",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(port),
+                "--basedir",
+                basedir,
+            ],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        session = requests.Session()
+        try:
+            probes = {
+                "online": ("online.txt", lambda status: status == 200),
+                "api": ("api/version", lambda status: status < 500),
+            }
+            interval = 0.2
+            while probes and time.monotonic() < start + timeout:
+                if server.poll() is not None:
+                    result["error"] = "server exited with {}".format(server.returncode)
+                    return result
+
+                for phase, (path, accept) in list(probes.items()):
+                    try:
+                        ok, ttfb = probe_http(
+                            session, "http://127.0.0.1:{}/{}".format(port, path), accept
+                        )
+                    except Exception:
+                        continue
+                    if ok:
+                        result[phase] = time.monotonic() - start
+                        del probes[phase]
+
+                time.sleep(interval)
+                interval = min(interval * 1.5, 2.0)
+
+            if probes:
+                result["error"] = "server not up after {}s".format(timeout)
+                return result
+        finally:
+            session.close()
+            server.terminate()
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+    result["ok"] = True
+    shutil.rmtree(venv, ignore_errors=True)
+    shutil.rmtree(basedir, ignore_errors=True)
+    return result
+
+
+@task
+def test_matrix(
+    pythons, targets="sdist|wheel", tag=None, jobs=None, fresh=False, timeout=120
+):
+    """headless install & startup test of tag against pythons and targets (separated by |)"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    if tag is None:
+        tag = env.tag
+
+    pythons = pythons.split("|")
+    targets = targets.split("|")
+    for python in pythons:
+        if not hasattr(env, python):
+            abort("Unknown python: {}".format(python))
+    for target in targets:
+        if target not in ("sdist", "wheel"):
+            abort("Unknown target {}".format(target))
+
+    installables = {
+        target: build_artifact(target, parallel=len(targets) > 1) for target in targets
+    }
+    if tag:
+        for installable in installables.values():
+            check_build_version(installable, tag)
+
+    # templates get created up front, so that cells sharing one don't race for it
+    cells = []
+    for python in pythons:
+        for target in targets:
+            template = None
+            if not is_true(fresh):
+                template = venv_template(installables[target], python)
+            cells.append((installables[target], python, target, template))
+
+    with ThreadPoolExecutor(int(jobs) if jobs else os.cpu_count()) as executor:
+        futures = [
+            executor.submit(smoke_test, *cell, timeout=float(timeout)) for cell in cells
+        ]
+        results = [future.result() for future in futures]
+
+    def seconds(value):
+        return "{:.1f}s".format(value) if value is not None else "-"
+
+    print("")
+    print(
+        "{:<12} {:<6} {:>8} {:>8} {:>8}  result".format(
+            "python", "target", "install", "online", "api"
+        )
+    )
+    for result in results:
+        print(
+            "{:<12} {:<6} {:>8} {:>8} {:>8}  {}".format(
+                result["python"],
+                result["target"],
+                seconds(result.get("install")),
+                seconds(result.get("online")),
+                seconds(result.get("api")),
+                "ok" if result["ok"] else result.get("error"),
+            )
+        )
+
+    with open(test_matrix_path("results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    if not all(result["ok"] for result in results):
+        abort("Not all installs came up, see {}".format(test_matrix_path()))
 
 
 ##~~ FlashHost ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -355,6 +1093,10 @@ def boot_part_device(serial):
     )
 
 
+def dut_host_string(target):
+    return "{}@{}.lan".format(env.rpi_user, env.targets[target]["hostname"])
+
+
 def mqtt_annotate(target, text):
     if env.flashhost.get("mqtt_annotation"):
         run('{} {} "{}"'.format(env.flashhost["mqtt_annotation"], target, text))
@@ -387,37 +1129,369 @@ def print_file(path):
     print(read_file(path).decode("utf-8"))
 
 
+_uploaded_tools = set()
+
+
+def flashhost_tool(tool="imagetool.py"):
+    """uploads a helper script from files/ to the flashhost (once per run), returns its invocation"""
+    tooldir = env.flashhost.get("tools", "/tmp/octoprint-devtools")
+    path = "{}/{}".format(tooldir, tool)
+
+    if (env.host_string, tool) not in _uploaded_tools:
+        run("mkdir -p {}".format(tooldir))
+        put(os.path.join("files", tool), path)
+        _uploaded_tools.add((env.host_string, tool))
+
+    return "python3 {}".format(path)
+
+
+def flashhost_record_path(serial):
+    records = env.flashhost.get("records", env.flashhost["images"] + "/records")
+    return "{}/{}.json".format(records, format_serial(serial))
+
+
+def flashhost_state_path(serial):
+    records = env.flashhost.get("records", env.flashhost["images"] + "/records")
+    return "{}/{}.state.json".format(records, format_serial(serial))
+
+
+def flashhost_verify_path(serial):
+    records = env.flashhost.get("records", env.flashhost["images"] + "/records")
+    return "{}/{}.verify.json".format(records, format_serial(serial))
+
+
+def image_name_from_url(url):
+    name = url.split("?")[0].rstrip("/").split("/")[-1]
+    for extension in (".zip", ".xz", ".gz", ".zst", ".img"):
+        if name.endswith(extension):
+            name = name[: -len(extension)]
+    return name
+
+
+_image_indexes = dict()
+
+
+def flashhost_image_index(refresh=False):
+    """returns the index of the flashhost's image store, read once per run"""
+    if refresh or env.host_string not in _image_indexes:
+        path = "{}/index.json".format(env.flashhost["images"])
+        with settings(hide("everything"), warn_only=True):
+            data = read_file(path)
+        try:
+            index = json.loads(data.decode("utf-8"))
+        except ValueError:
+            index = None
+        if not isinstance(index, dict) or "aliases" not in index:
+            index = dict(images=dict(), aliases=dict())
+        _image_indexes[env.host_string] = index
+    return _image_indexes[env.host_string]
+
+
+def flashhost_image_changed():
+    _image_indexes.pop(env.host_string, None)
+
+
+def flashhost_store_chown(*paths):
+    """
+    hands the image store back to the flashhost user after imagetool ran as root,
+    including the index lock, which the user's store operations need to open
+    """
+    images = env.flashhost["images"]
+    sudo(
+        "chown -R --reference={images} {images}/store {images}/index.json* {paths}".format(
+            images=images, paths=" ".join(paths)
+        )
+    )
+
+
+def flashhost_image_name(image):
+    """resolves image to its name in the image store, with or without 'octopi-' prefix"""
+    aliases = flashhost_image_index()["aliases"]
+    for name in (image, "octopi-{}".format(image)):
+        if name in aliases:
+            return name
+    return None
+
+
+def flashhost_image_digest(image, refresh=False):
+    """returns the hash of image in the image store, or None if it isn't stored"""
+    if image.startswith("http://") or image.startswith("https://"):
+        image = image_name_from_url(image)
+    index = flashhost_image_index(refresh=refresh)
+    name = flashhost_image_name(image)
+    return index["aliases"].get(name) if name else None
+
+
+def flashhost_image_path(image):
+    """returns the path of image on the flashhost, or None if it doesn't exist"""
+    name = flashhost_image_name(image)
+    if name is not None:
+        return "{}/{}.img".format(env.flashhost["images"], name)
+
+    # not in the store (yet), look for a plain file
+    imagefile = "{}/{}.img".format(env.flashhost["images"], image)
+    if not files_exists(imagefile):
+        print("Could not find {}, trying with 'octopi-' prefix".format(imagefile))
+        imagefile = "{}/octopi-{}.img".format(env.flashhost["images"], image)
+        if not files_exists(imagefile):
+            return None
+    return imagefile
+
+
+def flashhost_await_device(target, partitions=False):
+    """
+    waits for the target's card to show up on the flashhost, and with partitions for
+    the kernel to have picked up the partition table that was just flashed to it
+    """
+    serial = env.targets[target]["serial"]
+    timeout = env.flashhost.get("device_timeout", 30)
+
+    if partitions:
+        sudo(
+            "{} wait {} --reread {} --timeout {}".format(
+                flashhost_tool(), boot_part_device(serial), disk_device(serial), timeout
+            )
+        )
+    else:
+        sudo(
+            "{} wait {} --timeout {}".format(
+                flashhost_tool(), disk_device(serial), timeout
+            )
+        )
+
+
 @task
 @hosts("pi@flashhost.octo")
 def flashhost_release_lock():
-    """release flash lock if left set for some reason"""
+    """release flash lock and queues if left set for some reason"""
     lock = env.flashhost["flashlock"]
-    sudo("rm -rf {}".format(lock))
+    sudo("rm -rf {} {}".format(lock, flashhost_flash_queue()))
+
+
+def flashhost_flash_queue():
+    return env.flashhost.get("flashqueue", env.flashhost["flashlock"] + ".d")
+
+
+def flashhost_flash_slot(target, targetdev):
+    """
+    returns command prefix that waits for a free flash slot on the target's USB bus
+
+    the bus is detected from the device unless set as usbbus on the target, the
+    number of concurrent flashes per bus via flashhost.bus_slots (default: auto,
+    derived from bus speed and flashhost.card_mbps)
+    """
+    imagetool = flashhost_tool()
+    options = "--queue {} --device {} --slots {} --card-mbps {}".format(
+        flashhost_flash_queue(),
+        targetdev,
+        env.flashhost.get("bus_slots", "auto"),
+        env.flashhost.get("card_mbps", 20),
+    )
+    if env.targets[target].get("usbbus"):
+        options += " --bus {}".format(env.targets[target]["usbbus"])
+    return "{} slot {} --".format(imagetool, options)
+
+
+def flashhost_flash_bus(target):
+    """returns the target's USB bus and how many cards can get flashed on it at once"""
+    serial = env.targets[target]["serial"]
+    options = "--device {} --serial {} --slots {} --card-mbps {}".format(
+        disk_device(serial),
+        serial,
+        env.flashhost.get("bus_slots", "auto"),
+        env.flashhost.get("card_mbps", 20),
+    )
+    if env.targets[target].get("usbbus"):
+        options += " --bus {}".format(env.targets[target]["usbbus"])
+    with hide("stdout"):
+        bus, slots = run("{} bus {}".format(flashhost_tool(), options)).split()
+    return bus, int(slots)
+
+
+def flashhost_verify(target, imagefile, verify, slot):
+    """
+    reads what just got flashed back from the card of target and compares it with
+    imagefile, verify "full" checks all chunks of the image, "sample" a random share
+    of them (flashhost.verify_sample)
+
+    partition table and boot partition get checked right away, before provisioning
+    mounts them, the rest in the background while the next steps already run.
+    flashhost_dut waits for that to finish before switching the card over
+    """
+    if verify not in ("full", "sample"):
+        abort("Unknown verification: {}".format(verify))
+
+    serial = env.targets[target]["serial"]
+    targetdev = disk_device(serial)
+    result = flashhost_verify_path(serial)
+    imagetool = flashhost_tool()
+
+    options = ""
+    if verify == "sample":
+        options += " --sample {}".format(env.flashhost.get("verify_sample", 0.05))
+
+    sudo(f"{imagetool} verify check {imagefile} {targetdev} --region boot{options}")
+
+    # the background read back counts against the bus like a flash
+    sudo(
+        f"echo '{{\"status\": \"queued\"}}' > {result} && "
+        f"(setsid nohup {slot} {imagetool} verify check {imagefile} {targetdev} "
+        f"--region rest --result {result}{options} > {result}.log 2>&1 &)",
+        pty=False,
+    )
+
+
+def flashhost_await_verification(target, check=True):
+    """
+    waits for a background verification of the card of target to finish, returns
+    whether the card holds what got flashed to it, with check aborts if it doesn't
+    """
+    serial = env.targets[target]["serial"]
+    result = flashhost_verify_path(serial)
+    imagetool = flashhost_tool()
+    timeout = env.flashhost.get("verify_timeout", 3600)
+
+    with settings(warn_only=True):
+        outcome = run(
+            f"test ! -e {result} || {imagetool} verify await {result} --timeout {timeout}"
+        )
+    if outcome.failed and check:
+        mqtt_annotate(target, "Verification of the flash of {} failed".format(target))
+        abort(
+            "{} doesn't hold what got flashed to it, see {} on the flashhost".format(
+                target, result
+            )
+        )
+    return outcome.succeeded
 
 
 @task
 @hosts("pi@flashhost.octo")
-def flashhost_flash(image, target=None):
-    """flashes target with OctoPi image of provided image using dd"""
-    lockfile = env.flashhost["flashlock"]
-
-    imagefile = "{}/{}.img".format(env.flashhost["images"], image)
-    if not files.exists(imagefile):
-        print("Could not find {}, trying with 'octopi-' prefix".format(imagefile))
-        imagefile = "{}/octopi-{}.img".format(env.flashhost["images"], image)
+def flashhost_flash(
+    image, target=None, mode=None, cache=None, checksum=None, verify=None
+):
+    """
+    flashes target with OctoPi image of provided image
+
+    mode "full" (default) writes the whole image using dd, mode "sparse" only
+    writes the chunks of the image that contain data, according to a block map
+    cached next to the image. Mode "diff" compares against the card and the record
+    of its last flash and only writes changed chunks, falling back to a sparse write
+    if the record is stale. The default can be changed via flashhost.flashmode.
+
+    image may also be an http(s) URL, in which case it gets streamed straight to
+    the card while being cached in the images directory as cache (defaults to the
+    URL's file name), with checksum being the expected checksum of the download.
+    If that image is already cached, it gets flashed from there instead.
+
+    With verify "full" (or "sample", default: flashhost.verify) the card gets read back
+    and compared with the image after flashing (or a random share of it), see
+    flashhost_verify.
+    """
+    if mode is None:
+        mode = env.flashhost.get("flashmode", "full")
+    if mode not in ("full", "sparse", "diff"):
+        abort("Unknown flash mode: {}".format(mode))
+    if verify is None:
+        verify = env.flashhost.get("verify", False)
+    if verify not in ("full", "sample"):
+        verify = "full" if is_true(verify) else None
 
     if target is None:
         target = env.target
     if target not in env.targets:
         abort("Unknown target: {}".format(target))
-    if not files.exists(imagefile):
-        abort("Image not available: {}".format(imagefile))
     serial = env.targets[target]["serial"]
+
+    # whatever was journaled for the card is gone now
+    journal_reset(target)
     targetdev = disk_device(serial)
 
-    sudo(
-        f"flock -w600 {lockfile} pv --eta --rate --progress --bytes --width 80 {imagefile} | sudo dd bs=4M of={targetdev}"
-    )
+    # a read back of the previous flash might still be running
+    flashhost_await_verification(target, check=False)
+    sudo("rm -f {}".format(flashhost_verify_path(serial)))
+
+    record = flashhost_record_path(serial)
+    slot = flashhost_flash_slot(target, targetdev)
+
+    if image.startswith("http://") or image.startswith("https://"):
+        url = image
+        if cache is None:
+            cache = image_name_from_url(url)
+
+        path = env.flashhost["images"]
+        if flashhost_image_path(cache) is None:
+            imagefile = "{}/{}.img".format(path, cache)
+            imagetool = flashhost_tool()
+            # diff has nothing to compare against yet, it's a sparse write then
+            stream_mode = "full" if mode == "full" else "sparse"
+            options = f"--cache {imagefile} --record {record} --tmp {path}/tmp --store {path} --mode {stream_mode}"
+            if checksum:
+                options += f" --checksum {checksum}"
+            if env.flashhost.get("quota"):
+                options += " --quota {}".format(env.flashhost["quota"])
+
+            run(f"mkdir -p {path}/tmp")
+            sudo(f"{slot} {imagetool} stream '{url}' {targetdev} {options}")
+            flashhost_store_chown(imagefile)
+            flashhost_image_changed()
+            if verify:
+                flashhost_verify(target, imagefile, verify, slot)
+            return
+
+        print("{} is already cached as {}, flashing from there".format(url, cache))
+        image = cache
+
+    imagefile = flashhost_image_path(image)
+    if imagefile is None:
+        # might still be on its way through the prefetch queue
+        imagetool = flashhost_tool()
+        with settings(warn_only=True):
+            result = run(
+                "{} store await {} {}".format(imagetool, env.flashhost["images"], image)
+            )
+        if result.succeeded:
+            flashhost_image_changed()
+            imagefile = flashhost_image_path(image)
+    if imagefile is None:
+        abort("Image not available: {}".format(image))
+
+    images = env.flashhost["images"]
+    if mode == "full":
+        imagetool = flashhost_tool()
+
+        if verify:
+            # as the flashhost user and before dd, verification needs the block map
+            run(f"{imagetool} bmap {imagefile}")
+
+        # the shared lock keeps the image store from evicting the image meanwhile,
+        # taken before queueing for a slot, waiting in the queue counts as flashing
+        sudo(
+            f"flock -s {imagefile} {slot} sh -c 'pv --eta --rate --progress --bytes --width 80 {imagefile} | dd bs=4M of={targetdev}'"
+        )
+        run(f"{imagetool} store touch {images} {imagefile}")
+
+        # we don't know the chunk hashes of what we just wrote
+        sudo(f"rm -f {record}")
+    elif mode in ("sparse", "diff"):
+        imagetool = flashhost_tool()
+
+        # build the block map outside the lock, it's cached next to the image
+        run(f"{imagetool} bmap {imagefile}")
+
+        options = f"--record {record}"
+        if mode == "diff":
+            max_age = env.flashhost.get("record_max_age", 7 * 24 * 60 * 60)
+            options += f" --diff --max-age {max_age}"
+        sudo(f"flock -s {imagefile} {slot} {imagetool} write {imagefile} {targetdev} {options}")
+
+        # as the flashhost user, so the index doesn't end up owned by root
+        run(f"{imagetool} store touch {images} {imagefile}")
+    else:
+        abort("Unknown flash mode: {}".format(mode))
+
+    if verify:
+        flashhost_verify(target, imagefile, verify, slot)
 
 
 def encrypt_psk(ssid, psk):
@@ -429,56 +1503,36 @@ def encrypt_psk(ssid, psk):
     ).decode("utf-8")
 
 
-def flashhost_provision_octopi(target, boot):
+def render_template(name, **context):
+    from jinja2 import Environment, FileSystemLoader
+
+    jinja = Environment(loader=FileSystemLoader("templates"), keep_trailing_newline=True)
+    return jinja.get_template(name).render(**context).encode("utf-8")
+
+
+def provision_files_octopi(target):
     hostname = env.targets[target]["hostname"]
     password = env.rpi_password
 
     if env.rpi_user != "pi":
         abort("Legacy provisioning only supports pi user")
 
-    files.upload_template(
-        "octopi-wpa-supplicant.txt",
-        boot + "/octopi-wpa-supplicant.txt",
-        context=dict(ssid=env.wifi_ssid, psk=env.wifi_psk, country=env.wifi_country),
-        use_jinja=True,
-        template_dir="templates",
-        backup=False,
-        keep_trailing_newline=True,
-        use_sudo=True,
-    )
-    files.upload_template(
-        "octopi-network.txt",
-        boot + "/octopi-network.txt",
-        context=dict(ssid=env.wifi_ssid, psk=env.wifi_psk),
-        use_jinja=True,
-        template_dir="templates",
-        backup=False,
-        keep_trailing_newline=True,
-        use_sudo=True,
-    )
-    files.upload_template(
-        "octopi-hostname.txt",
-        boot + "/octopi-hostname.txt",
-        context=dict(hostname=hostname),
-        use_jinja=True,
-        template_dir="templates",
-        backup=False,
-        keep_trailing_newline=True,
-        use_sudo=True,
-    )
-    files.upload_template(
-        "octopi-password.txt",
-        boot + "/octopi-password.txt",
-        context=dict(password=password),
-        use_jinja=True,
-        template_dir="templates",
-        backup=False,
-        keep_trailing_newline=True,
-        use_sudo=True,
-    )
+    return {
+        "octopi-wpa-supplicant.txt": render_template(
+            "octopi-wpa-supplicant.txt",
+            ssid=env.wifi_ssid,
+            psk=env.wifi_psk,
+            country=env.wifi_country,
+        ),
+        "octopi-network.txt": render_template(
+            "octopi-network.txt", ssid=env.wifi_ssid, psk=env.wifi_psk
+        ),
+        "octopi-hostname.txt": render_template("octopi-hostname.txt", hostname=hostname),
+        "octopi-password.txt": render_template("octopi-password.txt", password=password),
+    }
 
 
-def flashhost_provision_firstrun(target, boot):
+def provision_files_firstrun(target, template="firstrun.sh"):
     from passlib.hash import sha512_crypt
 
     hostname = env.targets[target]["hostname"]
@@ -487,30 +1541,163 @@ def flashhost_provision_firstrun(target, boot):
 
     passwordhash = sha512_crypt.using(rounds=5000).hash(password)
 
-    files.upload_template(
-        "firstrun.sh",
-        boot + "/firstrun.sh",
-        context=dict(
+    return {
+        template: render_template(
+            template,
             hostname=hostname,
             user=user,
             passwordhash=passwordhash,
             ssid=env.wifi_ssid,
             psk=encrypt_psk(env.wifi_ssid, env.wifi_psk),
             country=env.wifi_country,
-        ),
-        use_jinja=True,
-        template_dir="templates",
-        backup=False,
-        keep_trailing_newline=True,
-        use_sudo=True,
+        )
+    }
+
+
+FIRSTRUN_CMDLINE = "systemd.run=/boot/firstrun.sh systemd.run_success_action=reboot systemd.unit=kernel-command-line.target"
+
+CONFIG_TXT = "disable_poe_fan=1\nboot_delay=3\nenable_uart=1\n"
+
+
+def provision_bundle(target, firstrun=True, rootfs=False):
+    """
+    renders all boot partition provisioning for target into a tar.gz bundle
+
+    the bundle contains the files for the boot partition, the config.txt additions,
+    the cmdline.txt patch and files/provision_boot.sh to apply all that
+
+    with rootfs, the firstrun changes get rendered as rootfs.sh instead, to be applied
+    to the image's rootfs directly, and cmdline.txt stays untouched, whatever
+    firstrun is set to
+    """
+    import tarfile
+
+    contents = dict()
+    if rootfs:
+        contents["rootfs.sh"] = provision_files_firstrun(target, template="rootfs.sh")[
+            "rootfs.sh"
+        ]
+        boot_files = dict()
+        cmdline = ""
+    elif firstrun:
+        boot_files = provision_files_firstrun(target)
+        cmdline = FIRSTRUN_CMDLINE
+    else:
+        boot_files = provision_files_octopi(target)
+        cmdline = ""
+
+    contents.update({"boot/" + name: data for name, data in boot_files.items()})
+    contents["config.txt"] = CONFIG_TXT.encode("utf-8")
+    contents["cmdline.txt"] = cmdline.encode("utf-8")
+    with open(os.path.join("files", "provision_boot.sh"), "rb") as f:
+        contents["provision_boot.sh"] = f.read()
+
+    fd = BytesIO()
+    with tarfile.open(fileobj=fd, mode="w:gz") as tar:
+        for name, data in sorted(contents.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755 if name.endswith(".sh") else 0o644
+            info.mtime = time.time()
+            tar.addfile(info, BytesIO(data))
+    return fd.getvalue()
+
+
+def flashhost_run_bundle(bundle, command):
+    """
+    extracts a provisioning bundle on the flashhost and runs command on it
+
+    the bundle holds credentials, so it gets uploaded readable only by the flashhost
+    user instead of travelling with the command (and ending up in logs), and removed
+    again afterwards. command can refer to the directory it got extracted to as $d
+    """
+    with hide("running", "stdout"):
+        archive = run("mktemp").strip()
+    try:
+        put(BytesIO(bundle), archive, mode=0o600)
+        sudo(
+            "d=$(mktemp -d) && tar -xzf {} -C $d && {}; r=$?; rm -rf $d; exit $r".format(
+                archive, command
+            )
+        )
+    finally:
+        run("rm -f {}".format(archive))
+
+
+def flashhost_apply_bundle(bundle, mount, device=None):
+    """
+    applies a provisioning bundle to the boot partition at mount, mounting device on
+    mount if given and unmounting it again afterwards
+    """
+    flashhost_run_bundle(
+        bundle, "sh $d/provision_boot.sh {} {}".format(mount, device or "")
+    )
+
+
+def provision_key(target, firstrun=True, rootfs=False):
+    """hash of all inputs of the provisioning of target"""
+    import hashlib
+
+    inputs = dict(
+        hostname=env.targets[target]["hostname"],
+        user=env.rpi_user,
+        password=env.rpi_password,
+        ssid=env.wifi_ssid,
+        psk=env.wifi_psk,
+        country=env.wifi_country,
+        firstrun=bool(firstrun),
+        rootfs=bool(rootfs),
+        config=CONFIG_TXT,
+        cmdline=FIRSTRUN_CMDLINE if firstrun and not rootfs else "",
     )
-    print_file(boot + "/firstrun.sh")
 
-    cmdline = read_file(boot + "/cmdline.txt").strip()
-    if b"firstrun.sh" not in cmdline:
-        cmdline += b" systemd.run=/boot/firstrun.sh systemd.run_success_action=reboot systemd.unit=kernel-command-line.target"
-        write_file(boot + "/cmdline.txt", cmdline, use_sudo=True)
-        print_file(boot + "/cmdline.txt")
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8"))
+    paths = [os.path.join("templates", name) for name in sorted(os.listdir("templates"))]
+    paths.append(os.path.join("files", "provision_boot.sh"))
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def flashhost_prebake(image, target, firstrun=True, rootfs=False):
+    """
+    returns the name of a copy of image with the boot partition provisioning for
+    target already applied, creating it if it isn't cached yet
+
+    with rootfs, the firstrun changes get applied to the copy's rootfs instead, so
+    the target doesn't need the extra firstrun boot. This forces firstrun off
+
+    the copy is cached in the image store under <image>@<target>, keyed by the
+    hash of the base image and of the provisioning inputs
+    """
+    name = flashhost_image_name(image)
+    if name is None:
+        abort("Image {} is not in the image store, can't prebake it".format(image))
+
+    index = flashhost_image_index()
+    base = index["aliases"][name]
+    key = provision_key(target, firstrun=firstrun, rootfs=rootfs)
+    variant = "{}@{}".format(name, target)
+
+    digest = index["aliases"].get(variant)
+    info = index["images"].get(digest, dict()).get("variant", dict())
+    if info.get("base") == base and info.get("key") == key:
+        print("Using cached provisioned variant {}".format(variant))
+        return variant
+
+    print("Creating provisioned variant {}...".format(variant))
+    imagetool = flashhost_tool()
+    images = env.flashhost["images"]
+    flashhost_run_bundle(
+        provision_bundle(target, firstrun=firstrun, rootfs=rootfs),
+        "{} store variant {} {} {} $d --key {} --target {}".format(
+            imagetool, images, name, variant, key, target
+        ),
+    )
+    flashhost_store_chown(f"{images}/{variant}.img")
+    flashhost_image_changed()
+    return variant
 
 
 @task
@@ -525,10 +1712,10 @@ def flashhost_mount(target=None):
     boot = boot_part_device(serial)
     mount = "{}/{}".format(env.flashhost["mounts"], target)
 
-    if not files.exists(mount):
+    if not files_exists(mount):
         run("mkdir -p {}".format(mount))
 
-    if not files.exists(mount + "/cmdline.txt"):
+    if not files_exists(mount + "/cmdline.txt"):
         sudo("mount {} {}".format(boot, mount))
 
 
@@ -558,28 +1745,9 @@ def flashhost_provision(target=None, firstrun=True):
     boot = boot_part_device(serial)
     mount = "{}/{}".format(env.flashhost["mounts"], target)
 
-    if not files.exists(mount):
-        run("mkdir -p {}".format(mount))
-
-    if not files.exists(mount + "/cmdline.txt"):
-        sudo("mount {} {}".format(boot, mount))
-
-    if firstrun:
-        flashhost_provision_firstrun(target, mount)
-    else:
-        flashhost_provision_octopi(target, mount)
-
-    files.append(
-        mount + "/config.txt",
-        "disable_poe_fan=1\nboot_delay=3\nenable_uart=1",
-        use_sudo=True,
-    )
-
-    if not files.exists(mount + "/octopi.txt"):
-        # not an octopi image, make sure to manually enable ssh
-        sudo("touch {}/ssh".format(mount))
-
-    sudo("umount {}".format(mount))
+    bundle = provision_bundle(target, firstrun=is_true(firstrun))
+    flashhost_await_device(target, partitions=True)
+    flashhost_apply_bundle(bundle, mount, device=boot)
 
 
 @task
@@ -594,12 +1762,14 @@ def flashhost_host(target=None):
     serial = env.targets[target]["serial"]
 
     sudo("{} -d {}".format(env.flashhost["ykush"], usbport))
+    ssh_drop_session(dut_host_string(target))
+    checkpoint_drop(target, "dut")
     sudo(
         "{} /dev/usb-sd-mux/id-{} host".format(
             env.flashhost["usbsdmux"], format_serial(serial)
         )
     )
-    time.sleep(5.0)
+    flashhost_await_device(target)
 
     mqtt_annotate(target, "Switched {} to Host mode".format(target))
 
@@ -615,12 +1785,16 @@ def flashhost_dut(target=None):
     usbport = env.targets[target]["usbport"]
     serial = env.targets[target]["serial"]
 
+    # the card must not go away while it's still getting read back
+    flashhost_await_verification(target)
+
     sudo(
         "{} /dev/usb-sd-mux/id-{} dut".format(
             env.flashhost["usbsdmux"], format_serial(serial)
         )
     )
     sudo("{} -u {}".format(env.flashhost["ykush"], usbport))
+    ssh_drop_session(dut_host_string(target))
     if env.targets[target].get("um25c"):
         sudo("systemctl restart {}".format(env.targets[target]["um25c"]))
 
@@ -649,63 +1823,458 @@ def flashhost_reboot(target=None):
     if target not in env.targets:
         abort("Unknown target: {}".format(target))
     usbport = env.targets[target]["usbport"]
+    serial = env.targets[target]["serial"]
 
-    sudo("{} -d {}".format(env.flashhost["ykush"], usbport))
-    time.sleep(1.0)
-    sudo("{} -u {}".format(env.flashhost["ykush"], usbport))
+    # one call, so the off time doesn't depend on the latency of the connection. the
+    # card dropping off the bus tells us the power is really gone, if it doesn't within
+    # power_off_timeout the target gets powered up again all the same
+    sudo(
+        "{ykush} -d {port} && {{ {imagetool} wait {device} --absent --timeout {timeout}; "
+        "{ykush} -u {port}; }}".format(
+            ykush=env.flashhost["ykush"],
+            port=usbport,
+            imagetool=flashhost_tool(),
+            device=disk_device(serial),
+            timeout=env.flashhost.get("power_off_timeout", 10),
+        )
+    )
+    ssh_drop_session(dut_host_string(target))
 
     mqtt_annotate(target, "Rebooted {}".format(target))
 
 
+def flashhost_card_matches(target, image, provision, resume=True):
+    """
+    checks the fingerprint left on the target's card by its last flash & provision,
+    True if it still holds image provisioned with provision and wasn't booted since.
+    The card needs to be in Host mode
+    """
+    if not is_true(resume) or not image:
+        return False
+
+    serial = env.targets[target]["serial"]
+    imagetool = flashhost_tool()
+    with settings(warn_only=True):
+        result = sudo(
+            "{} state check {} {} --image {} --provision {}".format(
+                imagetool,
+                disk_device(serial),
+                flashhost_state_path(serial),
+                image,
+                provision,
+            )
+        )
+    if result.failed:
+        return False
+
+    # a card that failed verification needs a fresh flash, which also clears the result
+    if not flashhost_await_verification(target, check=False):
+        print("Last flash of {} failed verification, flashing again".format(target))
+        return False
+
+    print(
+        "{} still holds the requested image & provisioning, skipping flash (resume=0 to redo)".format(
+            target
+        )
+    )
+    mqtt_annotate(target, "Skipped flashing {}, card already up to date".format(target))
+    return True
+
+
+def flashhost_write_card_state(target, image, provision):
+    """leaves a fingerprint of image and provision on the target's card"""
+    if not image:
+        return
+
+    serial = env.targets[target]["serial"]
+    imagetool = flashhost_tool()
+    sudo(
+        "{} state write {} {} --image {} --provision {}".format(
+            imagetool,
+            disk_device(serial),
+            flashhost_state_path(serial),
+            image,
+            provision,
+        )
+    )
+
+
+FLASH_STEPS = ("prepare", "flash", "provision", "dut")
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_flash_and_provision(
+    version,
+    target=None,
+    firstrun=True,
+    cache=None,
+    prebaked=None,
+    rootfs=None,
+    resume=True,
+    steps=None,
+):
+    """
+    runs flash & provision cycle on target for specified OctoPi version or image URL
+
+    steps that already completed with the same inputs (see the target's journal) get
+    skipped, unless resume is false. So does the whole flash & provision if the card
+    still holds the same image with the same provisioning and wasn't booted since
+
+    with prebaked (default: flashhost.prebake) a copy of the image with the target's
+    provisioning already applied gets flashed instead, no mounting of the card needed
+
+    with rootfs (default: flashhost.rootfs, implies prebaked) the firstrun changes get
+    applied to the rootfs of that copy, sparing the target the firstrun reboot. This
+    forces firstrun=False, no firstrun.sh or cmdline.txt patch ends up on the card
+
+    steps (separated by |, default: all) limits the cycle to some of prepare, flash,
+    provision and dut, as done by release_pipeline. prepare creates the prebaked copy
+    without touching the card
+    """
+    if target is None:
+        target = env.target
+    if target not in env.targets:
+        abort("Unknown target: {}".format(target))
+    if prebaked is None:
+        prebaked = env.flashhost.get("prebake", False)
+    if rootfs is None:
+        rootfs = env.flashhost.get("rootfs", False)
+    firstrun = is_true(firstrun)
+    rootfs = is_true(rootfs)
+    provision = provision_key(target, firstrun=firstrun, rootfs=rootfs)
+    steps = steps.split("|") if steps else FLASH_STEPS
+    for step in steps:
+        if step not in FLASH_STEPS:
+            abort("Unknown step: {}".format(step))
+
+    if is_true(prebaked) or rootfs:
+        # the prebaked copy already holds the provisioning, flashing it is all it takes
+        if "prepare" in steps or "flash" in steps:
+            if version.startswith("http://") or version.startswith("https://"):
+                name = cache if cache else image_name_from_url(version)
+                if flashhost_image_name(name) is None:
+                    flashhost_fetch_image(version, name)
+                version = name
+
+            variant = flashhost_prebake(
+                version, target, firstrun=firstrun, rootfs=rootfs
+            )
+
+        if "flash" in steps:
+            inputs = dict(image=flashhost_image_digest(variant) or variant)
+            state = dict(image=flashhost_image_digest(variant), provision=provision)
+            if not checkpoint(target, "flash", inputs, resume=resume):
+                flashhost_host(target=target)
+                if not flashhost_card_matches(target, resume=resume, **state):
+                    flashhost_flash(variant, target=target)
+                    flashhost_write_card_state(target, **state)
+                checkpoint_done(target, "flash", inputs)
+                checkpoint_done(target, "provision", inputs)
+
+    else:
+        inputs = dict(image=flashhost_image_digest(cache or version) or version)
+        state = dict(image=flashhost_image_digest(cache or version), provision=provision)
+        if "flash" in steps and not checkpoint(target, "flash", inputs, resume=resume):
+            flashhost_host(target=target)
+            if flashhost_card_matches(target, resume=resume, **state):
+                checkpoint_done(target, "flash", inputs)
+                checkpoint_done(target, "provision", dict(provision=provision))
+            else:
+                flashhost_flash(version, target=target, cache=cache)
+
+                # streamed images only got stored while flashing
+                inputs = dict(
+                    image=flashhost_image_digest(cache or version, refresh=True)
+                    or version
+                )
+                checkpoint_done(target, "flash", inputs)
+
+        inputs = dict(provision=provision)
+        if "provision" in steps and not checkpoint(
+            target, "provision", inputs, resume=resume
+        ):
+            flashhost_host(target=target)
+            flashhost_provision(target=target, firstrun=firstrun)
+            checkpoint_done(target, "provision", inputs)
+
+            state["image"] = flashhost_image_digest(cache or version, refresh=True)
+            flashhost_write_card_state(target, **state)
+
+    if "dut" in steps and not checkpoint(target, "dut", resume=resume):
+        flashhost_dut(target=target)
+        checkpoint_done(target, "dut")
+
+
+def flashhost_await_shutdown(target):
+    """
+    waits for target to stop answering pings, which it does once its network went down
+    late in the shutdown, with only unmounting the filesystems left to do
+    """
+    host = "{}.lan".format(env.targets[target]["hostname"])
+    timeout = env.flashhost.get("shutdown_timeout", 60)
+
+    # a few misses in a row, a single lost ping doesn't mean it's down
+    start = time.monotonic()
+    with settings(warn_only=True):
+        result = run(
+            "timeout {} sh -c 'misses=0; while [ $misses -lt 3 ]; do "
+            "if ping -c 1 -W 1 {} >/dev/null 2>&1; then misses=0; sleep 0.2; "
+            "else misses=$((misses + 1)); fi; done'".format(timeout, host)
+        )
+    if result.failed:
+        abort("{} was still up {}s after shutting it down".format(target, timeout))
+    print("{} went down after {:.1f}s".format(target, time.monotonic() - start))
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_capture_golden(name, base=None, target=None, shutdown=True):
+    """
+    captures the card of target as golden image name in the image store
+
+    base is the image the card got flashed with, taken from the card's fingerprint by
+    default. Only what changed compared to it gets stored. The steps in the target's
+    journal are stored along, flashhost_flash_golden restores both later on. With
+    shutdown (default) the target gets shut down cleanly first
+    """
+    if target is None:
+        target = env.target
+    if target not in env.targets:
+        abort("Unknown target: {}".format(target))
+    serial = env.targets[target]["serial"]
+
+    if base is None:
+        with settings(hide("everything"), warn_only=True):
+            data = read_file(flashhost_state_path(serial))
+        try:
+            base = json.loads(data.decode("utf-8")).get("image")
+        except (AttributeError, ValueError):
+            base = None
+        if not base:
+            abort("Don't know what {} got flashed with, please provide base".format(target))
+
+    # switching to host mode drops everything after "dut" from the journal
+    extra = dict(steps=journal_steps(target, exclude=("flash", "provision", "dut")))
+
+    if is_true(shutdown):
+        with settings(
+            host_string=dut_host_string(target), password=env.rpi_password, warn_only=True
+        ):
+            sudo("sync && shutdown -h now")
+        ssh_drop_session(dut_host_string(target))
+        flashhost_await_shutdown(target)
+    flashhost_host(target=target)
+    imagetool = flashhost_tool()
+    images = env.flashhost["images"]
+    sudo(
+        "{} store golden {} {} {} {} --target {} --extra '{}'".format(
+            imagetool,
+            images,
+            base,
+            name,
+            disk_device(serial),
+            target,
+            json.dumps(extra),
+        )
+    )
+    flashhost_store_chown(f"{images}/{name}.img")
+    flashhost_image_changed()
+
+    mqtt_annotate(target, "Captured {} as golden image {}".format(target, name))
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_flash_golden(name, target=None, resume=True):
+    """
+    flashes golden image name to target and switches it to DUT mode
+
+    the target comes up in the state it was captured in, the journal steps that led
+    to it are restored, so e.g. octopi_test_update_* skips provisioning if its inputs
+    are the same
+    """
+    if target is None:
+        target = env.target
+    if target not in env.targets:
+        abort("Unknown target: {}".format(target))
+
+    digest = flashhost_image_digest(name)
+    if digest is None:
+        abort("Image {} is not in the image store".format(name))
+    golden = flashhost_image_index()["images"].get(digest, dict()).get("golden")
+    if golden is None:
+        abort("{} is not a golden image".format(name))
+
+    inputs = dict(image=digest)
+    state = dict(image=digest, provision="golden")
+    if not checkpoint(target, "flash", inputs, resume=resume):
+        flashhost_host(target=target)
+        if not flashhost_card_matches(target, resume=resume, **state):
+            # beyond the base image golden images are mostly holes, don't dd those
+            mode = env.flashhost.get("flashmode", "full")
+            flashhost_flash(name, target=target, mode="sparse" if mode == "full" else mode)
+            flashhost_write_card_state(target, **state)
+
+        checkpoint_done(target, "flash", inputs)
+        checkpoint_done(target, "provision", inputs)
+        journal_restore(target, journal_load(target)["steps"] + golden.get("steps", []))
+
+    if not checkpoint(target, "dut", resume=resume):
+        flashhost_dut(target=target)
+        checkpoint_done(target, "dut")
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_list_images():
+    index = flashhost_image_index()
+    images = index["images"]
+
+    print("Available images:")
+    for name, digest in sorted(index["aliases"].items()):
+        if name.startswith("octopi-"):
+            name = name[len("octopi-") :]
+
+        info = images.get(digest, dict())
+        details = []
+        if info.get("octopi_version"):
+            details.append("OctoPi {}".format(info["octopi_version"]))
+        if info.get("size"):
+            details.append("{:.1f} GiB".format(info["size"] / 1024**3))
+        if info.get("golden"):
+            details.append(
+                "golden, {:.1f} GiB changed".format(
+                    info["golden"].get("changed_size", 0) / 1024**3
+                )
+            )
+
+        if details:
+            print("  {} ({})".format(name, ", ".join(details)))
+        else:
+            print("  {}".format(name))
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_image_info(image):
+    """prints the image store metadata of image"""
+    name = flashhost_image_name(image)
+    if name is None:
+        abort("Image {} is not in the image store".format(image))
+
+    index = flashhost_image_index()
+    digest = index["aliases"][name]
+    print("{}: {}".format(name, digest))
+    for key, value in sorted(index["images"].get(digest, dict()).items()):
+        print("  {}: {}".format(key, value))
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_import_images():
+    """moves plain .img files in the flashhost images directory into the image store"""
+    imagetool = flashhost_tool()
+    run("{} store import {}".format(imagetool, env.flashhost["images"]))
+    flashhost_image_changed()
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_ensure_image(url, image=None, checksum=None):
+    """fetches image from url like flashhost_fetch_image, unless it's already there"""
+    if image is None:
+        image = image_name_from_url(url)
+    if flashhost_image_path(image) is not None:
+        print("{} is already on the flashhost".format(image))
+        return
+    flashhost_fetch_image(url, image, checksum=checksum)
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_fetch_image(url, image, checksum=None):
+    """
+    downloads image from url to flashhost images directory
+
+    download, decompression (zip, xz, gz, zstd or none) and writing the .img happen in
+    one streaming pass, interrupted downloads are resumed. checksum is the expected
+    checksum of the download as [algorithm:]hexdigest, sha256 by default.
+    """
+    path = env.flashhost["images"]
+    tmp_path = path + "/tmp"
+
+    if flashhost_image_name(image) or files_exists("{}/{}.img".format(path, image)):
+        abort("Image {} already exists".format(image))
+
+    imagetool = flashhost_tool()
+    command = "{} fetch '{}' {}/{}.img --tmp {} --store {}".format(
+        imagetool, url, path, image, tmp_path, path
+    )
+    if checksum:
+        command += " --checksum {}".format(checksum)
+    if env.flashhost.get("quota"):
+        command += " --quota {}".format(env.flashhost["quota"])
+
+    run("mkdir -p {}".format(tmp_path))
+    run(command)
+    flashhost_image_changed()
+
+
 @task
 @hosts("pi@flashhost.octo")
-def flashhost_flash_and_provision(version, target=None, firstrun=True):
-    """runs flash & provision cycle on target for specified OctoPi version"""
-    if target is None:
-        target = env.target
-    flashhost_host(target=target)
-    flashhost_flash(version, target=target)
-    print("Flashing done, giving the system a bit to recover...")
-    time.sleep(5.0)
-    print("... done")
-    flashhost_provision(target=target, firstrun=firstrun)
-    flashhost_dut(target=target)
+def flashhost_prefetch_image(url, image, checksum=None):
+    """queues image from url for downloading in the background on the flashhost"""
+    if flashhost_image_name(image):
+        print("Image {} is already available".format(image))
+        return
+
+    imagetool = flashhost_tool()
+    command = "{} store prefetch {} '{}' {}".format(
+        imagetool, env.flashhost["images"], url, image
+    )
+    if checksum:
+        command += " --checksum {}".format(checksum)
+    if env.flashhost.get("quota"):
+        command += " --quota {}".format(env.flashhost["quota"])
+    run(command)
 
 
 @task
 @hosts("pi@flashhost.octo")
-def flashhost_list_images():
-    path = env.flashhost["images"]
-    print("Available images:")
-    for f in run("ls -1 {}".format(path), quiet=True).split("\n"):
-        f = f.strip()
-        if not f.endswith(".img"):
-            continue
-
-        if f.startswith("octopi-"):
-            print("  {}".format(f[len("octopi-") : -len(".img")]))
-        else:
-            print("  {}".format(f[: -len(".img")]))
+def flashhost_prefetch_status():
+    """shows the background download queue of the flashhost"""
+    imagetool = flashhost_tool()
+    run("{} store prefetch-status {}".format(imagetool, env.flashhost["images"]))
 
 
 @task
 @hosts("pi@flashhost.octo")
-def flashhost_fetch_image(url, image):
-    """downloads image from url to flashhost images directory"""
-    path = env.flashhost["images"]
-    tmp_path = path + "/tmp"
+def flashhost_evict_images(quota=None):
+    """evicts least recently flashed images until the image store fits the quota"""
+    if quota is None:
+        quota = env.flashhost.get("quota")
+    if not quota:
+        abort("No quota set")
 
-    if files.exists("{}/{}.img".format(path, image)):
-        abort("Image {} already exists".format(image))
+    imagetool = flashhost_tool()
+    run("{} store evict {} {}".format(imagetool, env.flashhost["images"], quota))
+    flashhost_image_changed()
 
-    run("wget {} -O {}/{}.zip".format(url, tmp_path, image))
-    run("unzip {}/{}.zip -d {}".format(tmp_path, image, tmp_path))
-    run("rm {}/{}.zip".format(tmp_path, image))
 
-    unpacked = run("ls {}/*.img | head -n 1".format(tmp_path), quiet=True).split("\n")[
-        0
-    ]
-    run("mv {} {}/{}.img".format(unpacked, path, image))
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_pin_image(image, unpin=False):
+    """protects image from eviction (or removes that protection with unpin)"""
+    name = flashhost_image_name(image)
+    if name is None:
+        abort("Image {} is not in the image store".format(image))
+
+    imagetool = flashhost_tool()
+    command = "{} store pin {} {}".format(imagetool, env.flashhost["images"], name)
+    if unpin:
+        command += " --unpin"
+    run(command)
 
 
 @task
@@ -714,14 +2283,21 @@ def flashhost_remove_image(image, ignore_missing=False):
     """removes image from flashhost images directory"""
     path = env.flashhost["images"]
 
+    name = flashhost_image_name(image)
+    if name is not None:
+        imagetool = flashhost_tool()
+        run("{} store remove {} {}".format(imagetool, path, name))
+        flashhost_image_changed()
+        return
+
     imagepath = "{}/{}.img".format(path, image)
-    if files.exists(imagepath):
-        run("rm {}".format(imagepath))
+    if files_exists(imagepath):
+        run("rm -f {} {}.bmap".format(imagepath, imagepath))
         return
 
     imagepath = "{}/octopi-{}.img".format(path, image)
-    if files.exists(imagepath):
-        run("rm {}".format(imagepath))
+    if files_exists(imagepath):
+        run("rm -f {} {}.bmap".format(imagepath, imagepath))
         return
 
     if ignore_missing:
@@ -747,6 +2323,102 @@ def flashhost_remote_test_image(image, target=None, e2e_branch=None):
     local(command)
 
 
+def flashhost_host_string():
+    return env.flashhost.get("host_string", "pi@flashhost.octo")
+
+
+def wheelhouse_path(abi=None):
+    path = env.flashhost["wheelhouse"]
+    if abi:
+        path += "/" + abi
+    return path
+
+
+def wheelhouse_url(abi):
+    return "http://{}:{}/{}/".format(
+        env.flashhost.get("lan_host", "flashhost.octo"),
+        env.flashhost.get("wheelhouse_port", 8040),
+        abi,
+    )
+
+
+def flashhost_daemon(port, command, cwd="~", log="/dev/null"):
+    """starts command on the flashhost in the background, unless port is already taken"""
+    run(
+        "ss -ltn | grep -q ':{port} ' || (cd {cwd} && setsid nohup {command} > {log} 2>&1 &)".format(
+            port=port, cwd=cwd, command=command, log=log
+        ),
+        pty=False,
+    )
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_serve_wheelhouse(abi=None):
+    """makes sure the wheelhouse is served to the LAN"""
+    path = wheelhouse_path()
+    port = env.flashhost.get("wheelhouse_port", 8040)
+
+    run("mkdir -p {}".format(wheelhouse_path(abi)))
+    flashhost_daemon(
+        port,
+        "python3 -m http.server {}".format(port),
+        cwd=path,
+        log=path + "/.server.log",
+    )
+
+
+@task
+@hosts("pi@flashhost.octo")
+def flashhost_serve_mirror():
+    """makes sure the artifact mirror is served to the LAN"""
+    path = env.flashhost["mirror"]
+    port = env.flashhost.get("mirror_port", 8041)
+
+    run("mkdir -p {}".format(path))
+    flashhost_daemon(
+        port,
+        "{} serve {} --port {} --max-age {}".format(
+            flashhost_tool("mirror.py"),
+            path,
+            port,
+            env.flashhost.get("mirror_max_age", 300),
+        ),
+        log=path + "/.server.log",
+    )
+
+
+_mirrored_urls = dict()
+
+
+def mirror_url(url):
+    """
+    returns the URL of url on the flashhost's artifact mirror, or url itself if no
+    mirror is configured
+
+    only the directory of url gets registered with the mirror, so the file name may
+    still contain placeholders like {target_version}
+    """
+    if not env.flashhost.get("mirror"):
+        return url
+
+    if url not in _mirrored_urls:
+        with settings(hide("everything"), host_string=flashhost_host_string()):
+            flashhost_serve_mirror()
+            path = run(
+                "{} add {} '{}'".format(
+                    flashhost_tool("mirror.py"), env.flashhost["mirror"], url
+                )
+            ).strip()
+        _mirrored_urls[url] = "http://{}:{}/{}".format(
+            env.flashhost.get("lan_host", "flashhost.octo"),
+            env.flashhost.get("mirror_port", 8041),
+            path,
+        )
+
+    return _mirrored_urls[url]
+
+
 ##~~ OctoPi ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
@@ -822,7 +2494,9 @@ def release_patch_octoprint(tag, branch, prerelease):
         branch=branch,
         additional_branches=old_branches,
         prerelease=prerelease,
-        pip="{}/archive/{{target_version}}.zip".format(env.releasetest_repo),
+        pip=mirror_url(
+            "{}/archive/{{target_version}}.zip".format(env.releasetest_repo)
+        ),
     )
 
 
@@ -832,8 +2506,10 @@ def release_patch_filecheck(tag, branch="master"):
         tag,
         "OctoPrint/OctoPrint-FileCheck",
         branch=branch,
-        pip="https://github.com/OctoPrint/OctoPrint-FileCheck/archive/{}.zip".format(
-            branch
+        pip=mirror_url(
+            "https://github.com/OctoPrint/OctoPrint-FileCheck/archive/{}.zip".format(
+                branch
+            )
         ),
     )
 
@@ -844,8 +2520,10 @@ def release_patch_firmwarecheck(tag, branch="master"):
         tag,
         "OctoPrint/OctoPrint-FirmwareCheck",
         branch=branch,
-        pip="https://github.com/OctoPrint/OctoPrint-FirmwareCheck/archive/{}.zip".format(
-            branch
+        pip=mirror_url(
+            "https://github.com/OctoPrint/OctoPrint-FirmwareCheck/archive/{}.zip".format(
+                branch
+            )
         ),
     )
 
@@ -854,6 +2532,7 @@ def release_patch_firmwarecheck(tag, branch="master"):
 def octopi_reboot():
     """reboots the system"""
     sudo("shutdown -r now")
+    ssh_drop_session()
 
 
 @task
@@ -864,7 +2543,7 @@ def octopi_octoservice(command):
 
 def octopi_standardrepo():
     """set standard repo"""
-    if files.exists("~/OctoPrint/.git"):
+    if files_exists("~/OctoPrint/.git"):
         run(
             "cd ~/OctoPrint && git remote set-url origin https://github.com/OctoPrint/OctoPrint"
         )
@@ -872,7 +2551,7 @@ def octopi_standardrepo():
 
 def octopi_releasetestrepo():
     """set releasetest repo"""
-    if files.exists("~/OctoPrint/.git"):
+    if files_exists("~/OctoPrint/.git"):
         run(
             "cd ~/OctoPrint && git remote set-url origin {}".format(
                 env.releasetest_repo
@@ -883,7 +2562,7 @@ def octopi_releasetestrepo():
 @task
 def octopi_releasetestplugin_github_release_patcher():
     """install release patcher"""
-    if not files.exists("~/.octoprint/plugins/github_release_patcher.py"):
+    if not files_exists("~/.octoprint/plugins/github_release_patcher.py"):
         put(
             "files/github_release_patcher.py",
             "~/.octoprint/plugins/github_release_patcher.py",
@@ -896,13 +2575,128 @@ def octopi_install(url):
     run('~/oprint/bin/pip install "{}"'.format(url))
 
 
+def octopi_python_abi():
+    return run(
+        "~/oprint/bin/python -c 'import sys, sysconfig; "
+        'print("cp{}{}-{}".format(sys.version_info[0], sys.version_info[1], '
+        'sysconfig.get_platform().replace("-", "_").replace(".", "_")))\''
+    ).strip()
+
+
+def requirement_batches(requirements):
+    """
+    splits requirements into batches that can each be installed with one pip call
+
+    only plain project names get batched. Anything pinned to a version, and URLs or
+    paths whose dependencies aren't known up front, gets a pip call of its own in the
+    original order, so a pin still overrides whatever got installed before it, just
+    like with one pip call per requirement
+    """
+    batches = []
+    names = set()
+    for requirement in requirements:
+        try:
+            parsed = pkg_resources.Requirement.parse(requirement)
+        except ValueError:
+            parsed = None
+
+        if parsed is None or parsed.specifier or parsed.url:
+            batches.append([requirement])
+            names = None
+            continue
+
+        if names is None or not batches or parsed.key in names:
+            batches.append([])
+            names = set()
+        batches[-1].append(requirement)
+        names.add(parsed.key)
+    return batches
+
+
+def octopi_install_batch(requirements):
+    """
+    installs all requirements inside OctoPrint venv, batching plain project names into
+    one pip call, using wheels from the flashhost's wheelhouse if configured
+    """
+    if not requirements:
+        return
+
+    for batch in requirement_batches(requirements):
+        octopi_pip_install(batch)
+
+
+def octopi_pip_install(requirements):
+    args = " ".join('"{}"'.format(requirement) for requirement in requirements)
+    if not env.flashhost.get("wheelhouse"):
+        run("~/oprint/bin/pip install {}".format(args))
+        return
+
+    abi = octopi_python_abi()
+    with settings(host_string=flashhost_host_string()):
+        flashhost_serve_wheelhouse(abi=abi)
+    links = "--find-links {} --trusted-host {}".format(
+        wheelhouse_url(abi), env.flashhost.get("lan_host", "flashhost.octo")
+    )
+
+    # once the wheelhouse has everything, no package index gets asked at all
+    with settings(warn_only=True):
+        result = run("~/oprint/bin/pip install --no-index {} {}".format(links, args))
+    if result.succeeded:
+        return
+
+    # otherwise collect all wheels, downloaded or built, and fill up the wheelhouse
+    wheels = "~/.cache/octoprint-devtools/wheels"
+    run("rm -rf {0} && mkdir -p {0}".format(wheels))
+    run("~/oprint/bin/pip wheel --wheel-dir {} {} {}".format(wheels, links, args))
+    run("~/oprint/bin/pip install --no-index --find-links {} {}".format(wheels, args))
+    octopi_upload_wheels(abi, wheels)
+
+
+def octopi_upload_wheels(abi, path):
+    """
+    copies the wheels in path on the Pi that the flashhost's wheelhouse doesn't have yet
+    straight to the flashhost, which fetches them from a short lived server on the Pi
+    """
+    with hide("stdout"):
+        wheels = [name for name in run("ls {}".format(path)).split() if name.endswith(".whl")]
+    with settings(hide("stdout"), host_string=flashhost_host_string()):
+        present = set(run("ls {}".format(wheelhouse_path(abi))).split())
+
+    missing = [name for name in wheels if name not in present]
+    if not missing:
+        return
+
+    port = env.flashhost.get("wheelhouse_upload_port", 8042)
+    run(
+        "cd {} && (setsid nohup timeout 600 python3 -m http.server {} > /dev/null 2>&1 &)".format(
+            path, port
+        ),
+        pty=False,
+    )
+    try:
+        fetch = " && ".join(
+            "curl -fsS --retry 5 --retry-connrefused --retry-delay 1 -o .{name}.part "
+            "http://{host}:{port}/{name} && mv .{name}.part {name}".format(
+                host=env.host, port=port, name=name
+            )
+            for name in missing
+        )
+        with settings(hide("running"), host_string=flashhost_host_string()):
+            run("cd {} && {}".format(wheelhouse_path(abi), fetch))
+    finally:
+        run("pkill -f 'http.server {}' || true".format(port))
+
+    print("Added {} wheels to the wheelhouse for {}".format(len(missing), abi))
+
+
 @task
 def octopi_curl_plugin(url):
     """install a single file plugin from url"""
     if url in env.fixes["plugins"]:
         url = env.fixes["plugins"][url]
+    url = mirror_url(url)
 
-    if not files.exists("~/.octoprint/plugins"):
+    if not files_exists("~/.octoprint/plugins"):
         run("mkdir -p ~/.octoprint/plugins")
     run("cd ~/.octoprint/plugins && curl -L -O '{}'".format(url))
 
@@ -923,7 +2717,8 @@ def octopi_get_version(target=None):
     return octopi_version_string
 
 
-def octopi_patch_python_env(target=None):
+def octopi_python_env_patches(target=None):
+    """requirements that need pinning in the OctoPrint venv of older OctoPi versions"""
     if target is None:
         target = env.target
 
@@ -931,7 +2726,12 @@ def octopi_patch_python_env(target=None):
     octopi_version = get_comparable_version(octopi_version_string)
 
     if octopi_version < get_comparable_version("0.16.0"):
-        octopi_install("wrapt==1.12.1")
+        return ["wrapt==1.12.1"]
+    return []
+
+
+def octopi_patch_python_env(target=None):
+    octopi_install_batch(octopi_python_env_patches(target=target))
 
 
 def octopi_test_releasepatch_octoprint(tag, branch, prerelease):
@@ -968,47 +2768,228 @@ def octopi_update_config(config):
     run("cat .octoprint/config.yaml")
 
 
+BOOT_PROBE = """
+left() {{ echo $(( {timeout} - SECONDS )); }}
+expired() {{ [ $SECONDS -ge {timeout} ]; }}
+event() {{ echo "BOOT $(cut -d' ' -f1 /proc/uptime) $1"; }}
+poll() {{
+    while ! "$@" >/dev/null 2>&1; do
+        expired && exit 3
+        sleep 0.5
+    done
+}}
+clock_synced() {{
+    # within a few seconds of the clock of the machine running fab
+    delta=$(( $(date +%s) - {now} - SECONDS ))
+    [ ${{delta#-}} -le 5 ]
+}}
+await_synced() {{
+    case "$(systemctl is-active systemd-timesyncd 2>/dev/null)" in
+        active|activating|reloading) ;;
+        *) poll clock_synced; return ;;
+    esac
+    if command -v inotifywait >/dev/null; then
+        # timesyncd creates the flag once the clock got synchronized
+        mkdir -p /run/systemd/timesync 2>/dev/null
+        while [ ! -e /run/systemd/timesync/synchronized ]; do
+            expired && exit 3
+            inotifywait -qq -t $(left) -e create -e moved_to /run/systemd/timesync
+        done
+    else
+        poll test -e /run/systemd/timesync/synchronized
+    fi
+}}
+await_service() {{
+    # returns once the boot transaction is done, every unit started at boot is up then
+    case "$(timeout $(left) systemctl is-system-running --wait 2>/dev/null)" in
+        running|degraded) ;;
+        *) expired && exit 3 ;;
+    esac
+    poll systemctl is-active --quiet "$1"
+}}
+event ssh
+await_synced
+event ntp
+if [ -n "{service}" ]; then
+    await_service {service}
+    event {service}
+fi
+"""
+
+
 @task
-def octopi_await_ntp(timeout=300):
-    """waits for the server to have ntp synchronized"""
+def octopi_await_boot(timeout=300, service="octoprint.service"):
+    """
+    waits for the server to have ntp synchronized and service to be running, over a
+    single ssh session, and prints the boot timeline
+    """
+    timeout = float(timeout)
     start = time.monotonic()
-    print("Waiting for OctoPi to have its time and date synced from NTP")
+
+    print(
+        "Waiting for OctoPi to have its time synced{}".format(
+            " and {} running".format(service) if service else ""
+        )
+    )
     while True:
-        if timeout is not None and time.monotonic() > start + timeout:
-            abort("Time was not synced after {}s".format(timeout))
+        remaining = start + timeout - time.monotonic()
+        if remaining < 1:
+            abort("OctoPi wasn't ready after {}s".format(timeout))
 
+        # $SECONDS starts over in every shell, so each attempt only gets what's left
+        script = BOOT_PROBE.format(
+            now=int(time.time()), timeout=int(remaining), service=service or ""
+        )
         try:
-            remote = run('date +"%Y%m%d"').strip()
-        except Exception:
-            pass
-        else:
-            local = datetime.date.today().strftime("%Y%m%d")
-            if remote == local:
-                print("Time has been synced")
-                break
+            # connection attempts also cover the time until sshd is up
+            with settings(
+                hide("running"),
+                warn_only=True,
+                timeout=5,
+                connection_attempts=max(1, int(remaining // 5)),
+                abort_exception=NetworkError,
+            ):
+                result = run(script)
+        except NetworkError:
+            time.sleep(1.0)
+            continue
+        if result.return_code != 3:
+            break
+
+    timeline = []
+    for line in result.splitlines():
+        if line.startswith("BOOT "):
+            _, uptime, event = line.split(" ", 2)
+            timeline.append({"event": event, "uptime": float(uptime)})
+    if result.failed or not timeline or timeline[-1]["event"] != (service or "ntp"):
+        abort("OctoPi wasn't ready after {}s".format(timeout))
+
+    print("Boot timeline of {} (seconds since kernel start):".format(env.host))
+    for entry in timeline:
+        print("  {:7.1f}  {}".format(entry["uptime"], entry["event"]))
+
+    if env.get("boot_timeline"):
+        with open(env.boot_timeline, mode="a", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "host": env.host,
+                        "time": datetime.datetime.now().isoformat(),
+                        "timeline": timeline,
+                    }
+                )
+                + "\n"
+            )
+
+    return timeline
+
+
+@task
+def octopi_await_ntp(timeout=300):
+    """waits for the server to have ntp synchronized"""
+    return octopi_await_boot(timeout=timeout, service=None)
+
 
-        time.sleep(10.0)
+def probe_tcp(host, port=80, timeout=2.0):
+    import socket
+
+    start = time.monotonic()
+    with socket.create_connection((host, port), timeout=timeout):
+        pass
+    return True, time.monotonic() - start
+
+
+def probe_http(session, url, accept, timeout=(2.0, 3.0)):
+    # streamed, so that elapsed is the time to the response headers and we don't
+    # wait for bodies we don't need
+    with session.get(url, timeout=timeout, stream=True, allow_redirects=False) as r:
+        return accept(r.status_code), r.elapsed.total_seconds()
+
+
+SERVER_PROBES = {
+    # haproxy accepts connections before OctoPrint is up
+    "tcp": lambda host, session: probe_tcp(host),
+    # served by OctoPrint itself, once it is up
+    "online.txt": lambda host, session: probe_http(
+        session, "http://{}/online.txt".format(host), lambda status: status == 200
+    ),
+    # any answer but a 5xx from haproxy means the API is being served, without an
+    # API key that's a 401/403 though
+    "api/version": lambda host, session: probe_http(
+        session, "http://{}/api/version".format(host), lambda status: status < 500
+    ),
+}
 
 
 @task
-def octopi_await_server(timeout=300):
+def octopi_await_server(timeout=300, probes="tcp,online.txt,api/version"):
     """waits for the server to come up, with optional timeout"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    host = env.host
+    if timeout is not None:
+        timeout = float(timeout)
+    probes = [probe for probe in probes.split(",") if probe]
+    for probe in probes:
+        if probe not in SERVER_PROBES:
+            abort("Unknown probe: {}".format(probe))
+    if "online.txt" not in probes:
+        probes.append("online.txt")
+
     start = time.monotonic()
-    print("Waiting for OctoPrint to become responsive at http://{}".format(env.host))
-    while True:
-        if timeout is not None and time.monotonic() > start + timeout:
-            abort("Server wasn't up after {}s".format(timeout))
+    interval = 0.5
+    phases = dict()
 
-        try:
-            r = requests.get("http://{}/online.txt".format(env.host))
-            if r.status_code == 200:
-                print("OctoPrint is up at http://{}".format(env.host))
+    # sessions aren't thread safe, every probe gets its own
+    sessions = {probe: requests.Session() for probe in probes}
+    errors = set()
+    executor = ThreadPoolExecutor(len(probes))
+
+    print("Waiting for OctoPrint to become responsive at http://{}".format(host))
+    try:
+        while True:
+            pending = [probe for probe in probes if probe not in phases]
+            futures = {
+                probe: executor.submit(SERVER_PROBES[probe], host, sessions[probe])
+                for probe in pending
+            }
+            for probe, future in futures.items():
+                try:
+                    ok, ttfb = future.result()
+                except Exception as exc:
+                    # expected while the server is down, but a broken probe shouldn't
+                    # just look like that until the timeout
+                    if (probe, type(exc)) not in errors:
+                        errors.add((probe, type(exc)))
+                        print("\n{}: not up yet ({})".format(probe, exc))
+                    continue
+                if ok:
+                    phases[probe] = (time.monotonic() - start, ttfb)
+                    print(
+                        "\n{}: up after {:.1f}s (ttfb {:.0f}ms)".format(
+                            probe, phases[probe][0], ttfb * 1000
+                        )
+                    )
+
+            if "online.txt" in phases:
+                print("OctoPrint is up at http://{}".format(host))
                 break
-        except Exception:
-            pass
 
-        print(".", end="")
-        time.sleep(10.0)
+            if timeout is not None and time.monotonic() > start + timeout:
+                abort("Server wasn't up after {}s".format(timeout))
+
+            print(".", end="")
+            sys.stdout.flush()
+
+            # poll fast while we might just have missed it, then back off
+            time.sleep(interval)
+            interval = min(interval * 1.5, 5.0)
+    finally:
+        executor.shutdown(wait=False)
+        for session in sessions.values():
+            session.close()
+
+    return phases
 
 
 @task
@@ -1027,19 +3008,22 @@ def octopi_provision(
     octopi_octoservice("stop")
     run("rm .octoprint/.incomplete_startup || true")
 
+    requirements = []
     if version is not None:
-        octopi_patch_python_env()
-        octopi_install("OctoPrint=={}".format(version))
+        requirements += octopi_python_env_patches()
+        requirements.append("OctoPrint=={}".format(version))
 
     if pip is not None:
-        octopi_install("pip=={}".format(pip))
+        requirements.append("pip=={}".format(pip))
 
     if packages:
         for package in packages.split("|"):
             if "/" in package:
                 package, version = package.split("/")
                 package = "{}=={}".format(package, version)
-            octopi_install(package)
+            requirements.append(package)
+
+    octopi_install_batch(requirements)
 
     if fixes:
         for fix in fixes.split("|"):
@@ -1089,7 +3073,7 @@ def octopi_provision(
     put(os.path.join(config, "users.yaml"), ".octoprint/users.yaml")
 
     if releasetest:
-        if files.exists("~/OctoPrint/.git"):
+        if files_exists("~/OctoPrint/.git"):
             octopi_releasetestrepo()
         octopi_releasetestplugin_github_release_patcher()
 
@@ -1113,13 +3097,39 @@ def octopi_wait(target=None, headless=False):
         host_string = "{}@{}".format(env.rpi_user, host)
 
     with settings(host_string=host_string, host=host, password=env.rpi_password):
-        octopi_await_ntp()
+        octopi_await_boot()
         octopi_await_server()
         if not headless:
             webbrowser.open("http://{}".format(env.host))
             octopi_tailoctolog()
 
 
+@task
+def octopi_verify(target=None):
+    """checks that the server is up and prints the installed OctoPrint version"""
+    if target is None:
+        target = env.target
+
+    host_string = env.host_string
+    host = env.host
+    if target:
+        if target not in env.targets:
+            abort("Unknown target: {}".format(target))
+        host = "{}.lan".format(env.targets[target]["hostname"])
+        host_string = "{}@{}".format(env.rpi_user, host)
+
+    with settings(host_string=host_string, host=host, password=env.rpi_password):
+        with settings(warn_only=True):
+            if run("systemctl is-active octoprint.service").failed:
+                abort("octoprint.service isn't running")
+        octopi_await_server(timeout=60)
+        version = run(
+            "~/oprint/bin/python -c 'import octoprint; print(octoprint.__version__)'"
+        ).strip()
+        print("OctoPrint {} is up at http://{}".format(version, host))
+        return version
+
+
 @task
 def octopi_test_simplepip(
     tag=None, target=None, pip=None, packages=None, fixes=None, headless=False
@@ -1144,13 +3154,13 @@ def octopi_test_simplepip(
 
     with settings(host_string=host_string, host=host, password=env.rpi_password):
         octopi_await_ntp()
-        url = "{}/archive/{}.zip".format(env.releasetest_repo, tag)
-        octopi_install(url)
+        url = mirror_url("{}/archive/{}.zip".format(env.releasetest_repo, tag))
+        requirements = [url]
         if pip:
-            octopi_install("pip=={}".format(pip))
+            requirements.append("pip=={}".format(pip))
         if packages:
-            for package in packages.split("|"):
-                octopi_install(package)
+            requirements += packages.split("|")
+        octopi_install_batch(requirements)
         if fixes:
             for fix in fixes.split("|"):
                 octopi_curl_plugin(fix)
@@ -1181,13 +3191,14 @@ def octopi_test_clean(
         octopi_await_ntp()
         if version or pip:
             octopi_octoservice("stop")
+            requirements = []
             if version:
-                octopi_install("OctoPrint=={}".format(version))
+                requirements.append("OctoPrint=={}".format(version))
             if pip:
-                octopi_install("pip=={}".format(pip))
+                requirements.append("pip=={}".format(pip))
             if packages:
-                for package in packages.split("|"):
-                    octopi_install(package)
+                requirements += packages.split("|")
+            octopi_install_batch(requirements)
             if fixes:
                 for fix in fixes.split("|"):
                     octopi_curl_plugin(fix)
@@ -1249,6 +3260,7 @@ def octopi_test_update(
     packages=None,
     fixes=None,
     headless=False,
+    resume=True,
 ):
     """
     generic update test prep: wait for server, provision, apply
@@ -1273,21 +3285,38 @@ def octopi_test_update(
 
     with settings(host_string=host_string, host=host, password=env.rpi_password):
         octopi_await_ntp()
-        octopi_provision(
-            config,
+
+        inputs = dict(
+            config=directory_hash(config),
             version=version,
-            release_channel=channel,
+            channel=channel,
             pip=pip,
             packages=packages,
             fixes=fixes,
-            restart=False,
-            releasetest=True,
-            headless=True,
         )
-        octopi_test_releasepatch_octoprint(tag, branch, prerelease)
-        octopi_octoservice("restart")
+        if not checkpoint(target, "octopi_provision", inputs, resume=resume):
+            octopi_provision(
+                config,
+                version=version,
+                release_channel=channel,
+                pip=pip,
+                packages=packages,
+                fixes=fixes,
+                restart=False,
+                releasetest=True,
+                headless=True,
+            )
+            checkpoint_done(target, "octopi_provision", inputs)
 
+        inputs = dict(tag=tag, branch=branch, prerelease=prerelease)
+        if not checkpoint(target, "releasepatch", inputs, resume=resume):
+            octopi_test_releasepatch_octoprint(tag, branch, prerelease)
+            checkpoint_done(target, "releasepatch", inputs)
+
+        octopi_octoservice("restart")
         octopi_await_server()
+        checkpoint_finish(target)
+
         if not headless:
             webbrowser.open("http://{}".format(env.host))
             octopi_tailoctolog()
@@ -1354,6 +3383,7 @@ def octopi_test_update_rc(
     config="configs/with_acl",
     target=None,
     headless=False,
+    resume=True,
 ):
     """tests update procedure for RCs"""
     octopi_test_update(
@@ -1368,6 +3398,7 @@ def octopi_test_update_rc(
         packages=packages,
         fixes=fixes,
         headless=headless,
+        resume=resume,
     )
 
 
@@ -1382,6 +3413,7 @@ def octopi_test_update_stable(
     config="configs/with_acl",
     target=None,
     headless=False,
+    resume=True,
 ):
     """tests update procedure for stable releases"""
     octopi_test_update(
@@ -1396,4 +3428,504 @@ def octopi_test_update_stable(
         packages=packages,
         fixes=fixes,
         headless=headless,
+        resume=resume,
+    )
+
+
+##~~ Release test matrix ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def matrix_cells(matrix):
+    """expands the test groups of a matrix into cells, list values multiply out"""
+    import itertools
+
+    cells = []
+    for group in matrix.get("tests", []):
+        keys = sorted(group.keys())
+        values = [
+            group[key]
+            if isinstance(group[key], list) and key != "targets"
+            else [group[key]]
+            for key in keys
+        ]
+        for combination in itertools.product(*values):
+            cell = {
+                key: str(value) if key != "targets" else value
+                for key, value in zip(keys, combination)
+            }
+            if "image" not in cell or "test" not in cell:
+                abort("Matrix cells need an image and a test: {!r}".format(cell))
+            cells.append(cell)
+    return cells
+
+
+def matrix_queues(cells, targets):
+    """
+    distributes cells over per target queues, keeping cells of the same image on the
+    same target so the card only needs changed blocks flashed
+    """
+    groups = collections.OrderedDict()
+    for cell in cells:
+        allowed = tuple(cell.get("targets") or targets)
+        groups.setdefault((cell["image"], allowed), []).append(cell)
+
+    queues = {target: [] for target in targets}
+    for (image, allowed), group in sorted(groups.items(), key=lambda x: -len(x[1])):
+        candidates = [target for target in allowed if target in queues]
+        if not candidates:
+            abort("No target available for image {}".format(image))
+        shortest = min(candidates, key=lambda target: len(queues[target]))
+        queues[shortest] += group
+    return queues
+
+
+def matrix_fab():
+    return [env.get("fab", "fab"), "-f", os.path.abspath(__file__)]
+
+
+def matrix_test(cell, target):
+    """fab invocation of the test task of cell on target"""
+    args = ["target={}".format(target), "headless=1"]
+    for key, value in sorted(cell.items()):
+        if key not in ("image", "test", "targets", "number"):
+            args.append("{}={}".format(key, value))
+    return "{}:{}".format(cell["test"], ",".join(args))
+
+
+def matrix_command(cell, target):
+    return matrix_fab() + [
+        "flashhost_flash_and_provision:{},target={}".format(cell["image"], target),
+        matrix_test(cell, target),
+    ]
+
+
+def run_logged(command, path, environment, timeout=None):
+    """runs command with its output appended to path, returns None on timeout"""
+    import subprocess
+
+    with open(path, "a") as log:
+        log.write("$ {}\n\n".format(" ".join(command)))
+        log.flush()
+        process = subprocess.Popen(
+            command,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            env=dict(os.environ, **environment),
+        )
+        try:
+            return process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            return None
+
+
+def load_matrix(matrix, targets=None, tag=None):
+    with open(matrix, encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+
+    if tag is None:
+        tag = data.get("tag", env.tag)
+    if tag is None:
+        abort("Tag needs to be set")
+
+    if targets is None:
+        targets = data.get("targets") or sorted(env.targets.keys())
+    elif isinstance(targets, str):
+        targets = targets.split("|")
+    for target in targets:
+        if target not in env.targets:
+            abort("Unknown target: {}".format(target))
+
+    cells = matrix_cells(data)
+    for number, cell in enumerate(cells, start=1):
+        cell["number"] = number
+    return cells, targets, tag
+
+
+def matrix_logdir(prefix="matrix-results"):
+    logdir = os.path.join(prefix, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(logdir)
+    return logdir
+
+
+@task
+def release_matrix(matrix="matrix.yaml", targets=None, tag=None, timeout=3600):
+    """runs a yaml release test matrix, spread over all (or the given, separated by |) targets"""
+    import threading
+
+    cells, targets, tag = load_matrix(matrix, targets=targets, tag=tag)
+    queues = matrix_queues(cells, targets)
+    logdir = matrix_logdir()
+    print(
+        "Running {} cells on {}, logs in {}".format(
+            len(cells), ", ".join(targets), logdir
+        )
+    )
+
+    lock = threading.Lock()
+    results = []
+
+    def next_cell(target):
+        with lock:
+            if queues[target]:
+                return queues[target].pop(0)
+
+            # steal from the back of the longest queue we are allowed to work on
+            for other in sorted(queues, key=lambda t: -len(queues[t])):
+                for cell in reversed(queues[other]):
+                    if target in (cell.get("targets") or targets):
+                        queues[other].remove(cell)
+                        return cell
+            return None
+
+    def work(target):
+        while True:
+            cell = next_cell(target)
+            if cell is None:
+                return
+
+            number = cell.pop("number")
+            name = "{:02d}-{}-{}-{}".format(number, target, cell["image"], cell["test"])
+            command = matrix_command(cell, target)
+            print("[{}] starting {}".format(target, name))
+
+            start = time.monotonic()
+            returncode = run_logged(
+                command,
+                os.path.join(logdir, name + ".log"),
+                dict(TAG=tag, TARGET=target),
+                timeout=float(timeout),
+            )
+
+            result = dict(
+                number=number,
+                cell=cell,
+                target=target,
+                duration=time.monotonic() - start,
+                returncode=returncode,
+                log=name + ".log",
+            )
+            with lock:
+                results.append(result)
+            print(
+                "[{}] {} {} after {:.0f}s".format(
+                    target,
+                    name,
+                    "passed"
+                    if returncode == 0
+                    else "timed out"
+                    if returncode is None
+                    else "failed",
+                    result["duration"],
+                )
+            )
+
+    start = time.monotonic()
+    workers = [threading.Thread(target=work, args=(target,)) for target in targets]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    results.sort(key=lambda result: result["number"])
+    with open(os.path.join(logdir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("")
+    for result in results:
+        print(
+            "{:>3} {:<8} {:<10} {:<40} {:>6.0f}s  {}".format(
+                result["number"],
+                result["target"],
+                result["cell"]["image"],
+                " ".join(
+                    [result["cell"]["test"]]
+                    + [
+                        "{}={}".format(k, v)
+                        for k, v in sorted(result["cell"].items())
+                        if k not in ("image", "test", "targets")
+                    ]
+                ),
+                result["duration"],
+                "ok" if result["returncode"] == 0 else "FAILED",
+            )
+        )
+    print("Total: {:.0f}s".format(time.monotonic() - start))
+
+    if not all(result["returncode"] == 0 for result in results):
+        abort("Not all cells passed, see {}".format(logdir))
+
+
+PIPELINE_STAGES = (
+    "fetch",
+    "prepare",
+    "flash",
+    "provision",
+    "boot-wait",
+    "configure",
+    "verify",
+)
+
+
+def pipeline_jobs(cell, target, bus):
+    """the stages of a cell as jobs, each with the resources it occupies"""
+    fab = matrix_fab()
+    image = cell["image"]
+
+    stages = []
+    if image.startswith("http://") or image.startswith("https://"):
+        name = image_name_from_url(image)
+        stages.append(
+            (
+                "fetch",
+                ["network"],
+                fab + ["flashhost_ensure_image:{},{}".format(image, name)],
+            )
+        )
+        image = name
+    else:
+        stages.append(("fetch", ["network"], None))
+
+    def flash_steps(steps):
+        return fab + [
+            "flashhost_flash_and_provision:{},target={},steps={}".format(
+                image, target, steps
+            )
+        ]
+
+    # only a prebaked copy can be prepared without the card
+    prebaked = is_true(env.flashhost.get("prebake", False)) or is_true(
+        env.flashhost.get("rootfs", False)
+    )
+    stages += [
+        ("prepare", ["flashhost"], flash_steps("prepare") if prebaked else None),
+        ("flash", ["flashhost", "bus:" + bus], flash_steps("flash")),
+        ("provision", ["flashhost"], flash_steps("provision|dut")),
+        ("boot-wait", [], fab + ["octopi_wait:target={},headless=1".format(target)]),
+        ("configure", [], fab + [matrix_test(cell, target)]),
+        ("verify", [], fab + ["octopi_verify:target={}".format(target)]),
+    ]
+
+    jobs = []
+    for stage, resources, command in stages:
+        jobs.append(
+            dict(
+                name="{:02d}-{}".format(cell["number"], stage),
+                cell=cell,
+                target=target,
+                stage=stage,
+                resources=resources,
+                command=command,
+                needs=[jobs[-1]["name"]] if jobs else [],
+                after=[],
+                state="pending",
+            )
+        )
+    if image != cell["image"]:
+        jobs[0]["url"] = cell["image"]
+    return jobs
+
+
+def run_pipeline(jobs, capacity, logdir, environment, timeout=None):
+    """
+    runs jobs as soon as everything they need succeeded, everything they come after
+    finished and all their resources have capacity left
+    """
+    import threading
+
+    condition = threading.Condition()
+    in_use = collections.Counter()
+    by_name = {job["name"]: job for job in jobs}
+
+    def execute(job):
+        start = time.monotonic()
+        if job["command"] is None:
+            returncode = 0
+        else:
+            returncode = run_logged(
+                job["command"],
+                os.path.join(logdir, job["log"]),
+                dict(environment, TARGET=job["target"]),
+                timeout=timeout,
+            )
+        with condition:
+            job["duration"] = time.monotonic() - start
+            job["state"] = "ok" if returncode == 0 else "failed"
+            if job["command"] is not None:
+                print(
+                    "[{}] {} {} after {:.0f}s".format(
+                        job["target"], job["name"], job["state"], job["duration"]
+                    )
+                )
+            for resource in job["resources"]:
+                in_use[resource] -= 1
+            condition.notify_all()
+
+    def startable(job):
+        if not all(by_name[name]["state"] == "ok" for name in job["needs"]) or not all(
+            by_name[name]["state"] in ("ok", "failed", "skipped") for name in job["after"]
+        ):
+            return False
+
+        # from here on, anything keeping the job from starting is a busy resource
+        job.setdefault("ready", time.monotonic())
+        return all(
+            in_use[resource] < capacity.get(resource, 1) for resource in job["resources"]
+        )
+
+    with condition:
+        while True:
+            changed = False
+            pending = [job for job in jobs if job["state"] == "pending"]
+            for job in pending:
+                if any(
+                    by_name[name]["state"] in ("failed", "skipped")
+                    for name in job["needs"]
+                ):
+                    job["state"] = "skipped"
+                    changed = True
+
+            for job in pending:
+                if job["state"] == "pending" and startable(job):
+                    job["state"] = "running"
+                    job["waited"] = time.monotonic() - job.pop("ready")
+                    for resource in job["resources"]:
+                        in_use[resource] += 1
+                    threading.Thread(target=execute, args=(job,)).start()
+
+            if not any(job["state"] == "running" for job in jobs):
+                if changed:
+                    # skips might have unblocked jobs coming after them
+                    continue
+                for job in jobs:
+                    if job["state"] == "pending":
+                        job["state"] = "skipped"
+                break
+            condition.wait()
+
+
+@task
+def release_pipeline(matrix="matrix.yaml", targets=None, tag=None, timeout=3600):
+    """
+    runs a yaml release test matrix as a pipeline of stages, overlapping downloads,
+    flashes and tests on all (or the given, separated by |) targets
+    """
+    cells, targets, tag = load_matrix(matrix, targets=targets, tag=tag)
+    queues = matrix_queues(cells, targets)
+    logdir = matrix_logdir()
+
+    pipeline = env.get("pipeline", dict())
+    capacity = dict(
+        network=pipeline.get("network", 2),
+        flashhost=pipeline.get("flashhost", 2),
+    )
+
+    # flashes are limited per USB bus, as many as the bus can take at card speed
+    buses = dict()
+    with settings(host_string=flashhost_host_string()):
+        for target in targets:
+            bus, slots = flashhost_flash_bus(target)
+            buses[target] = bus
+            capacity["bus:" + bus] = slots
+    print(
+        "Resources: {}".format(
+            ", ".join("{} {}".format(k, v) for k, v in sorted(capacity.items()))
+        )
+    )
+
+    jobs = []
+    fetches = dict()
+    for target, queue in queues.items():
+        previous = None
+        for cell in queue:
+            cell_jobs = pipeline_jobs(cell, target, buses[target])
+
+            # every image only gets downloaded once, other cells wait for that
+            url = cell_jobs[0].get("url")
+            if url in fetches:
+                cell_jobs[0]["command"] = None
+                cell_jobs[0]["needs"].append(fetches[url])
+            elif url:
+                fetches[url] = cell_jobs[0]["name"]
+            log = "{:02d}-{}-{}-{}.log".format(
+                cell["number"], target, cell["image"], cell["test"]
+            )
+            for job in cell_jobs:
+                job["log"] = log
+            if previous is not None:
+                # the card is only free again once the previous cell is done with it,
+                # preparing the next image can overlap its verification though
+                flash = next(job for job in cell_jobs if job["stage"] == "flash")
+                flash["after"].append(previous["name"])
+            previous = cell_jobs[-1]
+            jobs += cell_jobs
+
+    print(
+        "Running {} cells as {} stages on {}, logs in {}".format(
+            len(cells), len(jobs), ", ".join(targets), logdir
+        )
+    )
+    start = time.monotonic()
+    run_pipeline(jobs, capacity, logdir, dict(TAG=tag), timeout=float(timeout))
+
+    results = []
+    for cell in sorted(cells, key=lambda cell: cell["number"]):
+        cell_jobs = [job for job in jobs if job["cell"] is cell]
+        results.append(
+            dict(
+                number=cell["number"],
+                cell={k: v for k, v in cell.items() if k != "number"},
+                target=cell_jobs[0]["target"],
+                stages={
+                    job["stage"]: dict(
+                        state=job["state"],
+                        duration=job.get("duration"),
+                        resources=job["resources"],
+                        waited=job.get("waited"),
+                    )
+                    for job in cell_jobs
+                },
+                ok=all(job["state"] == "ok" for job in cell_jobs),
+                log=cell_jobs[0]["log"],
+            )
+        )
+    with open(os.path.join(logdir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("")
+    print(
+        "{:>3} {:<8} {:<10} {:<24} ".format("", "target", "image", "test")
+        + " ".join("{:>9}".format(stage) for stage in PIPELINE_STAGES)
+    )
+    for result in results:
+        print(
+            "{:>3} {:<8} {:<10} {:<24} ".format(
+                result["number"],
+                result["target"],
+                result["cell"]["image"][-10:],
+                result["cell"]["test"][-24:],
+            )
+            + " ".join(
+                "{:>9}".format(
+                    "{:.0f}s".format(stage["duration"])
+                    if stage["state"] == "ok" and stage["duration"] is not None
+                    else stage["state"]
+                )
+                for stage in (result["stages"][name] for name in PIPELINE_STAGES)
+            )
+        )
+    waited = collections.Counter()
+    for job in jobs:
+        for resource in job["resources"]:
+            waited[resource] += job.get("waited") or 0
+    print(
+        "Waited for resources: {}".format(
+            ", ".join("{} {:.0f}s".format(k, v) for k, v in sorted(waited.items()))
+        )
     )
+    print("Total: {:.0f}s".format(time.monotonic() - start))
+
+    if not all(result["ok"] for result in results):
+        abort("Not all cells passed, see {}".format(logdir))
@@ -0,0 +1,2968 @@
+#!/usr/bin/env python3
+"""
+Image helper for the flashhost.
+
+Gets uploaded to the flashhost by the fabfile and is run there, so it must only ever
+depend on the standard library of the flashhost's Python 3.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
+import glob
+import hashlib
+import http.client
+import json
+import lzma
+import os
+import queue
+import random
+import re
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+
+CHUNK_SIZE = 4 * 1024 * 1024  # same as the dd bs=4M of the full flash
+READ_SIZE = 1024 * 1024
+BLOCKMAP_VERSION = 4
+RECORD_VERSION = 1
+
+ZERO_CHUNK = bytes(CHUNK_SIZE)
+
+
+##~~ Helpers ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def format_size(size):
+    return "{:.1f} MiB".format(size / 1024 / 1024)
+
+
+def parse_size(value):
+    """Parses sizes like ``50G``, ``500M`` or plain bytes."""
+    value = str(value).strip().upper().rstrip("B").rstrip("I")
+    for exponent, unit in enumerate("KMGT", start=1):
+        if value.endswith(unit):
+            return int(float(value[:-1]) * 1024**exponent)
+    return int(value)
+
+
+@contextlib.contextmanager
+def locked_json(path, default):
+    """Yields the data of a JSON file under an exclusive lock and saves it afterwards."""
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = default()
+        yield data
+
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+    finally:
+        os.close(fd)
+
+
+class Progress(object):
+    def __init__(self, total, verb="written", interval=2.0):
+        self.total = total
+        self.verb = verb
+        self.interval = interval
+        self.done = 0
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def update(self, amount):
+        self.done += amount
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 0.001)
+        log(
+            "{} {} of {} ({:.1f} MiB/s)".format(
+                self.verb,
+                format_size(self.done),
+                format_size(self.total),
+                self.done / elapsed / 1024 / 1024,
+            )
+        )
+
+
+def data_extents(fd, size):
+    """
+    Yields ``(offset, length)`` of the data extents in the file, skipping holes if the
+    file is sparse and the filesystem supports SEEK_DATA/SEEK_HOLE.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError:
+            # ENXIO: no more data after offset
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def chunk_hash(data):
+    # blake2b is notably faster than sha256 in software, which matters on a Pi
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def device_size(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def partitions(path):
+    """Returns the primary partitions from the MBR of an image or device."""
+    with open(path, "rb") as f:
+        mbr = f.read(512)
+    if len(mbr) < 512 or mbr[510:512] != b"\x55\xaa":
+        return []
+
+    result = []
+    for number in range(4):
+        entry = mbr[446 + number * 16 : 446 + (number + 1) * 16]
+        part_type = entry[4]
+        start, sectors = struct.unpack("<II", entry[8:16])
+        if part_type and sectors:
+            result.append(
+                {
+                    "number": number + 1,
+                    "type": part_type,
+                    "offset": start * 512,
+                    "size": sectors * 512,
+                }
+            )
+    return result
+
+
+def rootfs_partition(path):
+    for partition in partitions(path):
+        if partition["type"] == 0x83:
+            return partition
+    return None
+
+
+def boot_partition(path):
+    for partition in partitions(path):
+        if partition["type"] in (0x0B, 0x0C, 0x0E):  # FAT
+            return partition
+    return None
+
+
+def chunk_ranges(chunks):
+    """Merges a sorted list of chunk indices into ``[start, end)`` ranges."""
+    ranges = []
+    for chunk in chunks:
+        if ranges and ranges[-1][1] == chunk:
+            ranges[-1][1] = chunk + 1
+        else:
+            ranges.append([chunk, chunk + 1])
+    return ranges
+
+
+##~~ Block map ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def build_blockmap(image, chunk_size=CHUNK_SIZE):
+    """
+    Scans the image and returns a block map of all chunks that contain data, together
+    with a hash of each mapped chunk.
+
+    Chunks that lie in a hole of a sparse image or consist only of zeroes are left out.
+    """
+    stat = os.stat(image)
+    size = stat.st_size
+    zero = ZERO_CHUNK if chunk_size == CHUNK_SIZE else bytes(chunk_size)
+
+    mapped = []
+    hashes = []
+    scanned = -1
+    progress = Progress(size, verb="scanned")
+    with open(image, "rb") as f:
+        for offset, length in data_extents(f.fileno(), size):
+            first = max(offset // chunk_size, scanned + 1)
+            last = (offset + length - 1) // chunk_size
+            for chunk in range(first, last + 1):
+                scanned = chunk
+                f.seek(chunk * chunk_size)
+                data = f.read(chunk_size)
+                if data != zero[: len(data)]:
+                    mapped.append(chunk)
+                    hashes.append(chunk_hash(data))
+                progress.update(len(data))
+
+    blockmap = make_blockmap(stat, mapped, hashes, chunk_size=chunk_size)
+    blockmap["unused"] = unused_ranges(image, size, chunk_size=chunk_size)
+    return blockmap
+
+
+def image_hash(size, mapped, hashes, chunk_size):
+    """
+    Content hash of an image, covering its size and where each mapped chunk sits, so
+    that images with the same data at other offsets or with more zeroes at the end
+    don't share it.
+    """
+    digest = hashlib.sha256("{} {}\n".format(size, chunk_size).encode("ascii"))
+    for chunk, chunk_digest in zip(mapped, hashes):
+        digest.update("{} {}\n".format(chunk * chunk_size, chunk_digest).encode("ascii"))
+    return digest.hexdigest()
+
+
+def make_blockmap(stat, mapped, hashes, chunk_size=CHUNK_SIZE):
+    size = stat.st_size
+    return {
+        "version": BLOCKMAP_VERSION,
+        "image_size": size,
+        "image_mtime": stat.st_mtime,
+        "image_hash": image_hash(size, mapped, hashes, chunk_size),
+        "chunk_size": chunk_size,
+        "mapped_size": sum(min(chunk_size, size - c * chunk_size) for c in mapped),
+        "ranges": chunk_ranges(mapped),
+        "hashes": hashes,
+    }
+
+
+def load_blockmap(path, image):
+    """Returns the cached block map at ``path`` if it still matches ``image``, else None."""
+    try:
+        with open(path, "r") as f:
+            blockmap = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(image)
+    if (
+        blockmap.get("version") != BLOCKMAP_VERSION
+        or blockmap.get("image_size") != stat.st_size
+        or blockmap.get("image_mtime") != stat.st_mtime
+    ):
+        return None
+
+    return blockmap
+
+
+def save_blockmap(path, blockmap):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(blockmap, f)
+    os.replace(tmp, path)
+
+
+def get_blockmap(image, path=None):
+    if path is None:
+        # aliases in the image store are symlinks, keep the map with the content
+        path = os.path.realpath(image) + ".bmap"
+
+    blockmap = load_blockmap(path, image)
+    if blockmap is None:
+        log("Building block map of {}...".format(image))
+        blockmap = build_blockmap(image)
+        try:
+            save_blockmap(path, blockmap)
+        except OSError as exc:
+            log("Could not cache block map at {}: {}".format(path, exc))
+    return blockmap
+
+
+def iter_mapped(blockmap):
+    """Yields ``(offset, length)`` for all mapped chunks, clipped to the image size."""
+    chunk_size = blockmap["chunk_size"]
+    size = blockmap["image_size"]
+    for start, end in blockmap["ranges"]:
+        for chunk in range(start, end):
+            offset = chunk * chunk_size
+            yield offset, min(chunk_size, size - offset)
+
+
+def iter_unmapped(blockmap):
+    """
+    Yields ``(offset, length)`` for all chunks that aren't mapped, i.e. are zeroes in the
+    image, except for those the block map lists as ``unused`` (content doesn't matter).
+    """
+    chunk_size = blockmap["chunk_size"]
+    size = blockmap["image_size"]
+    skip = set()
+    for start, end in blockmap["ranges"] + blockmap.get("unused", []):
+        skip.update(range(start, end))
+    for chunk in range(-(-size // chunk_size)):
+        if chunk not in skip:
+            offset = chunk * chunk_size
+            yield offset, min(chunk_size, size - offset)
+
+
+##~~ Writing ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def write_sparse(image, device, blockmap):
+    """
+    Writes only the mapped chunks of ``image`` to ``device``, unmapped chunks only get
+    zeroed where the card doesn't hold zeroes already.
+    """
+    drop_cache(device)
+
+    progress = Progress(blockmap["mapped_size"])
+    fd = os.open(device, os.O_RDWR)
+    try:
+        with open(image, "rb") as f:
+            for offset, length in iter_mapped(blockmap):
+                f.seek(offset)
+                data = f.read(length)
+                os.pwrite(fd, data, offset)
+                progress.update(len(data))
+        progress.report()
+        zero_unmapped(fd, blockmap)
+        log("Syncing {}...".format(device))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def zero_unmapped(fd, blockmap):
+    """
+    Makes sure the unmapped chunks of the image are zeroes on the device as well, the
+    card might have held something else there before. Chunks the block map lists as
+    unused (e.g. ext4 free space) don't matter and don't even get read, of the rest
+    only those that aren't zeroes already get written. Returns the number of bytes
+    written.
+    """
+    unmapped = list(iter_unmapped(blockmap))
+    progress = Progress(sum(length for _, length in unmapped), verb="checked")
+    written = 0
+    for offset, length in unmapped:
+        if os.pread(fd, length, offset) != ZERO_CHUNK[:length]:
+            os.pwrite(fd, ZERO_CHUNK[:length], offset)
+            written += length
+        progress.update(length)
+    progress.report()
+
+    if written:
+        log("Zeroed {} that should be empty".format(format_size(written)))
+    return written
+
+
+def write_diff(image, device, blockmap, record):
+    """
+    Writes only those mapped chunks of ``image`` that differ from what's on ``device``.
+
+    Chunks whose hash in the ``record`` of the last flash differs from the image are
+    written right away, all others are read back from the device first and only
+    written if their content changed since. Unmapped chunks get zeroed where needed.
+
+    Returns the number of bytes written.
+    """
+    recorded = record_hashes(record)
+
+    # chunks still in the page cache from before the card was in the DUT don't count
+    drop_cache(device)
+
+    progress = Progress(blockmap["mapped_size"], verb="compared")
+    written = 0
+    fd = os.open(device, os.O_RDWR)
+    try:
+        with open(image, "rb") as f:
+            for (offset, length), expected in zip(
+                iter_mapped(blockmap), blockmap["hashes"]
+            ):
+                if recorded.get(offset) == expected:
+                    current = os.pread(fd, length, offset)
+                    if chunk_hash(current) == expected:
+                        progress.update(length)
+                        continue
+
+                f.seek(offset)
+                data = f.read(length)
+                os.pwrite(fd, data, offset)
+                written += length
+                progress.update(length)
+        progress.report()
+        written += zero_unmapped(fd, blockmap)
+        log("Syncing {}...".format(device))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    return written
+
+
+##~~ Verification ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def verify_offsets(device, blockmap, region="all", sample=0.0):
+    """
+    Returns the offsets of the mapped chunks to read back, optionally only a random
+    ``sample`` (fraction) of them.
+
+    Region "boot" is the partition table plus everything up to the rootfs (i.e. what
+    provisioning is about to mount), "rest" everything after, "all" both.
+    """
+    offsets = sorted(record_hashes(blockmap))
+    if region != "all":
+        rootfs = rootfs_partition(device)
+        split = rootfs["offset"] if rootfs else blockmap["image_size"]
+        if region == "boot":
+            offsets = [offset for offset in offsets if offset < split]
+        else:
+            offsets = [offset for offset in offsets if offset >= split]
+
+    if sample and offsets:
+        count = max(1, int(len(offsets) * sample))
+        if count < len(offsets):
+            offsets = sorted(random.sample(offsets, count))
+    return offsets
+
+
+def verify_chunks(device, blockmap, offsets, jobs=None):
+    """
+    Reads the chunks at ``offsets`` back from ``device`` and compares them against the
+    hashes in ``blockmap``. Reading and hashing happens on ``jobs`` threads, hashlib
+    and pread both release the GIL, so that spreads over all cores.
+
+    Returns the offsets of all chunks that don't match.
+    """
+    expected = record_hashes(blockmap)
+    chunk_size = blockmap["chunk_size"]
+    size = blockmap["image_size"]
+
+    # whatever we just wrote is still in the page cache, we want what's on the card
+    drop_cache(device)
+
+    fd = os.open(device, os.O_RDONLY)
+
+    def check(offset):
+        data = os.pread(fd, min(chunk_size, size - offset), offset)
+        return offset, len(data), chunk_hash(data) == expected[offset]
+
+    mismatches = []
+    total = sum(min(chunk_size, size - offset) for offset in offsets)
+    progress = Progress(total, verb="verified")
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+            for offset, length, ok in pool.map(check, offsets):
+                progress.update(length)
+                if not ok:
+                    mismatches.append(offset)
+    finally:
+        os.close(fd)
+    progress.report()
+
+    return mismatches
+
+
+def save_result(path, result):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(result, f)
+    os.replace(tmp, path)
+
+
+def await_verification(path, timeout):
+    """
+    Waits for the verification writing its result to ``path`` to finish. A result of
+    "queued" means it's still waiting to get started.
+    """
+    start = time.monotonic()
+    last_report = start
+    while True:
+        result = load_record(path)
+        if result is not None and result.get("status") not in ("queued", "running"):
+            break
+        if result is not None and result.get("pid") and not pid_alive(result["pid"]):
+            log("Verification died without a result")
+            return 1
+        if timeout and time.monotonic() - start > timeout:
+            log("Verification still not done after {}s".format(timeout))
+            return 1
+        if time.monotonic() - last_report >= 30.0:
+            last_report = time.monotonic()
+            log("Waiting for verification to finish...")
+        time.sleep(1.0)
+
+    if result["status"] == "error":
+        log("Verification failed: {}".format(result.get("error")))
+        return 1
+    if result["status"] != "ok":
+        log(
+            "Verification failed, {} of {} chunks don't match: {}".format(
+                len(result["mismatches"]),
+                result["checked"],
+                ", ".join(str(offset) for offset in result["mismatches"]),
+            )
+        )
+        return 1
+
+    log(
+        "Verified {} chunks, waited {:.1f}s".format(
+            result["checked"], time.monotonic() - start
+        )
+    )
+    return 0
+
+
+##~~ Flash records ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def create_record(image, device, blockmap):
+    return {
+        "version": RECORD_VERSION,
+        "image": os.path.basename(image),
+        "image_hash": blockmap["image_hash"],
+        "image_size": blockmap["image_size"],
+        "chunk_size": blockmap["chunk_size"],
+        "device_size": device_size(device),
+        "ranges": blockmap["ranges"],
+        "hashes": blockmap["hashes"],
+        "flashed": time.time(),
+    }
+
+
+def record_hashes(record):
+    """Returns a dict of chunk offset to chunk hash from a record or block map."""
+    chunk_size = record["chunk_size"]
+    offsets = (
+        chunk * chunk_size for start, end in record["ranges"] for chunk in range(start, end)
+    )
+    return dict(zip(offsets, record["hashes"]))
+
+
+def load_record(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_record(path, record):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp, path)
+
+
+def record_staleness(record, device, blockmap, max_age):
+    """Returns the reason why ``record`` can't be trusted for ``device``, or None."""
+    if record is None:
+        return "no record of a previous flash"
+    if record.get("version") != RECORD_VERSION:
+        return "record has an outdated format"
+    if record.get("chunk_size") != blockmap["chunk_size"]:
+        return "record uses a different chunk size"
+    if max_age and time.time() - record.get("flashed", 0) > max_age:
+        return "record is older than {}s".format(max_age)
+    if record.get("device_size") != device_size(device):
+        return "device size changed, card got swapped"
+
+    # the card's content doesn't need checking here, write_diff reads back every chunk
+    # before skipping it. Its partition table in particular changes on first boot,
+    # when the rootfs gets expanded
+    return None
+
+
+##~~ Card state ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+STATE_FILE = "devtools-state.json"
+STATE_VERSION = 1
+
+EXT4_MAGIC = 0xEF53
+
+
+BLKFLSBUF = 0x1261
+
+
+def drop_cache(device):
+    """Makes sure the next reads come from the card, not from the page cache."""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        try:
+            # flushes and invalidates the buffers of a block device, needs root
+            fcntl.ioctl(fd, BLKFLSBUF)
+        except OSError:
+            pass
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def rootfs_usage(device):
+    """
+    Returns the fields of the rootfs' ext4 superblock that change whenever it gets
+    mounted or written to, i.e. whenever the card got booted.
+    """
+    partition = rootfs_partition(device)
+    if partition is None:
+        return None
+
+    drop_cache(device)
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        superblock = os.pread(fd, 1024, partition["offset"] + 1024)
+    finally:
+        os.close(fd)
+
+    if len(superblock) < 0x180 or struct.unpack_from("<H", superblock, 0x38)[0] != EXT4_MAGIC:
+        return None
+
+    mtime, wtime, mount_count = struct.unpack_from("<IIH", superblock, 0x2C)
+    (kbytes_written,) = struct.unpack_from("<Q", superblock, 0x178)
+    return {
+        "mtime": mtime,
+        "wtime": wtime,
+        "mount_count": mount_count,
+        "kbytes_written": kbytes_written,
+    }
+
+
+@contextlib.contextmanager
+def mounted_boot(device, readonly=False):
+    partition = boot_partition(device)
+    if partition is None:
+        raise ValueError("{} has no FAT boot partition".format(device))
+
+    mount = tempfile.mkdtemp(prefix="devtools-boot-")
+    os.rmdir(mount)
+    mount_partition(device, partition, mount, readonly=readonly)
+    try:
+        yield mount
+    finally:
+        umount_partition(mount)
+
+
+def write_state(device, record, image, provision):
+    """
+    Writes a fingerprint of what is on the card to its boot partition and mirrors it,
+    together with the current state of its rootfs, to ``record`` on the flashhost.
+    """
+    state = {
+        "version": STATE_VERSION,
+        "id": os.urandom(8).hex(),
+        "image": image,
+        "provision": provision,
+        "written": time.time(),
+    }
+    with mounted_boot(device) as mount:
+        with open(os.path.join(mount, STATE_FILE), "w") as f:
+            json.dump(state, f, indent=2)
+
+    state["rootfs"] = rootfs_usage(device)
+    save_record(record, state)
+    return state
+
+
+def check_state(device, record, image, provision):
+    """Returns why the card doesn't hold image with provision untouched, or None."""
+    state = load_record(record)
+    if state is None or state.get("version") != STATE_VERSION:
+        return "no fingerprint of the card"
+    if state.get("image") != image:
+        return "card holds a different image"
+    if state.get("provision") != provision:
+        return "card got provisioned differently"
+    if state.get("rootfs") is None:
+        return "card has no ext4 rootfs to check for changes"
+
+    usage = rootfs_usage(device)
+    if usage != state["rootfs"]:
+        return "card got booted since it was flashed"
+
+    # makes sure it's still the same card
+    try:
+        with mounted_boot(device, readonly=True) as mount:
+            with open(os.path.join(mount, STATE_FILE)) as f:
+                on_card = json.load(f)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return "no fingerprint on the card"
+    if on_card.get("id") != state.get("id"):
+        return "fingerprint on the card doesn't match, card got swapped"
+
+    return None
+
+
+##~~ Fetching ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+class HttpStream(object):
+    """
+    Readable stream of an HTTP download.
+
+    If the connection drops, the download gets resumed from the current offset via
+    a range request. The raw downloaded bytes can be hashed on the way through.
+    """
+
+    def __init__(self, url, checksum=None, retries=5, timeout=60):
+        self.url = url
+        self.retries = retries
+        self.timeout = timeout
+        self.offset = 0
+        self.size = None
+        self.etag = None
+        self.response = None
+
+        self.hash = None
+        self.expected = None
+        if checksum:
+            algorithm, _, expected = checksum.rpartition(":")
+            self.hash = hashlib.new(algorithm or "sha256")
+            self.expected = expected.lower()
+
+        self._reopen(initial=True)
+
+    def _open(self):
+        headers = {"User-Agent": "octoprint-devtools"}
+        if self.offset:
+            headers["Range"] = "bytes={}-".format(self.offset)
+            if self.etag:
+                headers["If-Range"] = self.etag
+
+        request = urllib.request.Request(self.url, headers=headers)
+        response = urllib.request.urlopen(request, timeout=self.timeout)
+        status = getattr(response, "status", None) or 200
+
+        if not self.offset:
+            length = response.headers.get("Content-Length")
+            self.size = int(length) if length else None
+            self.etag = response.headers.get("ETag")
+        elif status != 206:
+            # no range support (or the resource changed), skip what we already have
+            log("Server doesn't support resuming, skipping {} bytes".format(self.offset))
+            remaining = self.offset
+            while remaining:
+                data = response.read(min(remaining, READ_SIZE))
+                if not data:
+                    raise IOError("Download got shorter while resuming")
+                remaining -= len(data)
+
+        self.response = response
+
+    def _reopen(self, initial=False):
+        attempt = 0
+        while True:
+            try:
+                if self.response is not None:
+                    self.response.close()
+                self._open()
+                return
+            except (OSError, http.client.HTTPException) as exc:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log(
+                    "Could not {} download: {}, retrying...".format(
+                        "start" if initial else "resume", exc
+                    )
+                )
+                time.sleep(min(2**attempt, 30))
+
+    def read(self, size=READ_SIZE):
+        attempt = 0
+        while True:
+            try:
+                data = self.response.read(size)
+                if not data and self.size is not None and self.offset < self.size:
+                    raise http.client.IncompleteRead(b"", self.size - self.offset)
+                break
+            except (OSError, http.client.HTTPException) as exc:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log(
+                    "Download interrupted after {}: {}, resuming...".format(
+                        format_size(self.offset), exc
+                    )
+                )
+                time.sleep(min(2**attempt, 30))
+                self._reopen()
+
+        self.offset += len(data)
+        if self.hash is not None:
+            self.hash.update(data)
+        return data
+
+    def verify(self):
+        if self.hash is None:
+            return
+        actual = self.hash.hexdigest()
+        if actual != self.expected:
+            raise ValueError(
+                "Checksum mismatch for {}: expected {}, got {}".format(
+                    self.url, self.expected, actual
+                )
+            )
+        log("Checksum {}:{} verified".format(self.hash.name, actual))
+
+
+class PeekStream(object):
+    """Wraps a stream so that data can be pushed back in front of it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+
+    def read(self, size=READ_SIZE):
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
+
+    def read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            block = self.read(size - len(data))
+            if not block:
+                raise ValueError("Compressed data is truncated")
+            data += block
+        return data
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            block = self.stream.read(size - len(self.buffer))
+            if not block:
+                break
+            self.buffer += block
+        return self.buffer[:size]
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+MAGIC = (
+    (b"\x1f\x8b", "gz"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"PK\x03\x04", "zip"),
+)
+
+
+def detect_format(stream):
+    head = stream.peek(8)
+    for magic, fmt in MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return "img"
+
+
+def iter_inflate(stream, wbits):
+    decompressor = zlib.decompressobj(wbits)
+    data = b""
+    while not decompressor.eof:
+        if not data:
+            data = stream.read()
+            if not data:
+                raise ValueError("Compressed data is truncated")
+        # bounded output, zeroes compress *very* well
+        out = decompressor.decompress(data, CHUNK_SIZE)
+        data = decompressor.unconsumed_tail
+        if out:
+            yield out
+    stream.unread(decompressor.unused_data + data)
+
+
+def iter_gz(stream):
+    while True:
+        for out in iter_inflate(stream, 16 + zlib.MAX_WBITS):
+            yield out
+        if not stream.peek(2) == b"\x1f\x8b":
+            break
+
+
+def iter_xz(stream):
+    while True:
+        decompressor = lzma.LZMADecompressor()
+        while not decompressor.eof:
+            if decompressor.needs_input:
+                data = stream.read()
+                if not data:
+                    raise ValueError("Compressed data is truncated")
+            else:
+                data = b""
+            out = decompressor.decompress(data, CHUNK_SIZE)
+            if out:
+                yield out
+        stream.unread(decompressor.unused_data)
+        if not stream.peek(6) == b"\xfd7zXZ\x00":
+            break
+
+
+def iter_zstd(stream):
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+    if zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(stream)
+        while True:
+            out = reader.read(CHUNK_SIZE)
+            if not out:
+                break
+            yield out
+        return
+
+    # no python bindings, pipe through the zstd binary instead
+    process = subprocess.Popen(
+        ["zstd", "-d", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+
+    def feed():
+        try:
+            while True:
+                data = stream.read()
+                if not data:
+                    break
+                process.stdin.write(data)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    while True:
+        out = process.stdout.read(CHUNK_SIZE)
+        if not out:
+            break
+        yield out
+
+    feeder.join()
+    if process.wait() != 0:
+        raise ValueError("zstd failed with exit code {}".format(process.returncode))
+
+
+def iter_zip(stream):
+    """
+    Yields the decompressed content of the first ``.img`` in a zip file, parsed
+    straight from the stream via the local file headers.
+    """
+    while True:
+        header = stream.read_exact(30)
+        if header[:4] != b"PK\x03\x04":
+            raise ValueError("No .img found in zip file")
+
+        (flags, method, csize, usize, name_length, extra_length) = struct.unpack(
+            "<6xHH8xIIHH", header
+        )
+        name = stream.read_exact(name_length).decode("utf-8", "replace")
+        extra = stream.read_exact(extra_length)
+
+        if csize == 0xFFFFFFFF or usize == 0xFFFFFFFF:
+            # zip64, real sizes live in the extra field
+            offset = 0
+            while offset + 4 <= len(extra):
+                field, length = struct.unpack("<HH", extra[offset : offset + 4])
+                if field == 0x0001:
+                    usize, csize = struct.unpack("<QQ", extra[offset + 4 : offset + 20])
+                    break
+                offset += 4 + length
+
+        descriptor = flags & 0x08
+        if method == 8:
+            content = iter_inflate(stream, -zlib.MAX_WBITS)
+        elif method == 0 and not descriptor:
+
+            def stored(remaining):
+                while remaining:
+                    data = stream.read(min(remaining, READ_SIZE))
+                    if not data:
+                        raise ValueError("Compressed data is truncated")
+                    remaining -= len(data)
+                    yield data
+
+            content = stored(csize)
+        else:
+            raise ValueError(
+                "Unsupported compression method {} for {} in zip".format(method, name)
+            )
+
+        if name.endswith(".img"):
+            for out in content:
+                yield out
+            return
+
+        # not what we are looking for, skip it
+        for _ in content:
+            pass
+        if descriptor:
+            if stream.peek(4) == b"PK\x07\x08":
+                stream.read_exact(4)
+            stream.read_exact(20 if csize > 0xFFFFFFFF else 12)
+
+
+DECOMPRESSORS = {
+    "gz": iter_gz,
+    "xz": iter_xz,
+    "zstd": iter_zstd,
+    "zip": iter_zip,
+}
+
+
+def iter_image(stream, fmt="auto"):
+    """Yields the decompressed image data from ``stream``."""
+    stream = PeekStream(stream)
+    if fmt == "auto":
+        fmt = detect_format(stream)
+    log("Image format: {}".format(fmt))
+
+    if fmt in DECOMPRESSORS:
+        for out in DECOMPRESSORS[fmt](stream):
+            yield out
+    else:
+        while True:
+            data = stream.read()
+            if not data:
+                break
+            yield data
+
+
+class ImageSink(object):
+    """
+    Writes chunks to an image file, leaving all-zero chunks as holes and recording
+    the block map of the result on the way.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.mapped = []
+        self.hashes = []
+        self.size = 0
+
+    def write(self, offset, data):
+        if data != ZERO_CHUNK[: len(data)]:
+            self.file.seek(offset)
+            self.file.write(data)
+            self.mapped.append(offset // CHUNK_SIZE)
+            self.hashes.append(chunk_hash(data))
+        self.size = offset + len(data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.truncate(self.size)
+        self.file.close()
+
+    def blockmap(self, path=None):
+        return make_blockmap(os.stat(path or self.path), self.mapped, self.hashes)
+
+
+class DeviceSink(object):
+    """
+    Writes chunks to a block device. All-zero chunks only get written with ``full``,
+    otherwise only where the device doesn't hold zeroes already.
+    """
+
+    def __init__(self, device, full=False):
+        self.device = device
+        self.full = full
+        if not full:
+            drop_cache(device)
+        self.fd = os.open(device, os.O_RDWR)
+
+    def write(self, offset, data):
+        if data != ZERO_CHUNK[: len(data)] or self.full:
+            os.pwrite(self.fd, data, offset)
+        elif os.pread(self.fd, len(data), offset) != data:
+            os.pwrite(self.fd, data, offset)
+
+    def close(self):
+        if self.fd is None:
+            return
+        log("Syncing {}...".format(self.device))
+        try:
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+
+class BackgroundSink(object):
+    """
+    Hands chunks to another sink on a worker thread, so a slow sink doesn't hold up
+    the download or the other sinks. Up to ``depth`` chunks get buffered.
+    """
+
+    def __init__(self, sink, depth=8):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining so the producer doesn't block
+                continue
+            try:
+                self.sink.write(*item)
+            except Exception as exc:
+                self.error = exc
+
+    def write(self, offset, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((offset, data))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.sink.close()
+        if self.error is not None:
+            raise self.error
+
+
+def pump(stream, sinks, fmt="auto"):
+    """
+    Decompresses ``stream`` and hands it to all ``sinks`` in chunks of CHUNK_SIZE.
+
+    Returns the size of the decompressed image.
+    """
+    progress = Progress(stream.size or 0, verb="downloaded")
+    offset = 0
+    pending = b""
+    last = 0
+
+    def dispatch(data):
+        for sink in sinks:
+            sink.write(offset, data)
+
+    for out in iter_image(stream, fmt=fmt):
+        pending += out
+        while len(pending) >= CHUNK_SIZE:
+            dispatch(pending[:CHUNK_SIZE])
+            pending = pending[CHUNK_SIZE:]
+            offset += CHUNK_SIZE
+        progress.update(stream.offset - last)
+        last = stream.offset
+
+    if pending:
+        dispatch(pending)
+        offset += len(pending)
+
+    progress.report()
+    return offset
+
+
+##~~ Image store ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+STORE_VERSION = 1
+FIDEDUPERANGE = 0xC0189436
+FILE_DEDUPE_RANGE_SAME = 0
+
+
+def dedupe_range(src_fd, src_offset, length, dest_fd, dest_offset):
+    """
+    Asks the filesystem to share the extents of ``dest`` with those of ``src`` if
+    their content is identical (reflink). Returns the number of deduplicated bytes.
+    """
+    fmt = "=QQHHIqQQiI"
+    buffer = bytearray(
+        struct.pack(fmt, src_offset, length, 1, 0, 0, dest_fd, dest_offset, 0, 0, 0)
+    )
+    fcntl.ioctl(src_fd, FIDEDUPERANGE, buffer)
+    deduped, status = struct.unpack(fmt, buffer)[7:9]
+    if status != FILE_DEDUPE_RANGE_SAME:
+        return 0
+    return deduped
+
+
+def read_octopi_version(image):
+    """Reads /etc/octopi_version from the rootfs of an image, via debugfs."""
+    partition = rootfs_partition(image)
+    if partition is None:
+        return None
+
+    try:
+        output = subprocess.check_output(
+            [
+                "debugfs",
+                "-R",
+                "cat /etc/octopi_version",
+                "{}?offset={}".format(image, partition["offset"]),
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    version = output.decode("utf-8", "replace").strip()
+    return version or None
+
+
+class ImageStore(object):
+    """
+    Content addressed image store.
+
+    Images live as ``store/<hash>.img`` below the images directory, with ``<hash>``
+    being the image hash of their block map. Names are aliases of such hashes and
+    get exposed as ``<name>.img`` symlinks for everything that works with plain paths.
+    ``index.json`` holds the aliases and the metadata of all images, so listing and
+    lookups are a single read, plus an index of which stored images hold each chunk
+    hash, for deduplication.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.store = os.path.join(path, "store")
+        self.index_path = os.path.join(path, "index.json")
+        os.makedirs(self.store, exist_ok=True)
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        if index.get("version") != STORE_VERSION:
+            index = self.empty_index()
+        return index
+
+    @staticmethod
+    def empty_index():
+        return {"version": STORE_VERSION, "images": {}, "aliases": {}, "chunks": {}}
+
+    def locked(self):
+        """Yields the index under an exclusive lock and saves it afterwards."""
+        return locked_json(self.index_path, self.empty_index)
+
+    def content_path(self, digest):
+        return os.path.join(self.store, digest + ".img")
+
+    def alias_path(self, name):
+        return os.path.join(self.path, name + ".img")
+
+    def link(self, name, digest):
+        alias = self.alias_path(name)
+        tmp = alias + ".tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.relpath(self.content_path(digest), self.path), tmp)
+        os.replace(tmp, alias)
+
+    def add(self, name, image, compressed_size=None, source=None, extra=None):
+        """
+        Moves ``image`` into the store and makes it available as ``name``, ``extra``
+        gets merged into its metadata.
+        """
+        blockmap = get_blockmap(image)
+        digest = blockmap["image_hash"]
+        content = self.content_path(digest)
+        bmap = os.path.realpath(image) + ".bmap"
+
+        with self.locked() as index:
+            if digest in index["images"]:
+                log("{} is identical to an already stored image, sharing it".format(name))
+                os.remove(image)
+                if os.path.exists(bmap):
+                    os.remove(bmap)
+            else:
+                os.replace(image, content)
+                if os.path.exists(bmap):
+                    os.replace(bmap, content + ".bmap")
+
+                shared = self.dedupe(digest, blockmap, index)
+                self.index_chunks(digest, blockmap, index)
+                index["images"][digest] = {
+                    "size": blockmap["image_size"],
+                    "mapped_size": blockmap["mapped_size"],
+                    "shared_size": shared,
+                    "compressed_size": compressed_size,
+                    "octopi_version": read_octopi_version(content),
+                    "source": source,
+                    "added": time.time(),
+                }
+
+            if extra:
+                index["images"][digest].update(extra)
+
+            previous = index["aliases"].get(name)
+            index["aliases"][name] = digest
+            self.link(name, digest)
+            if previous and previous != digest:
+                self.collect(previous, index)
+
+        log("Stored {} as {}".format(name, digest))
+        return digest
+
+    def remove(self, name):
+        with self.locked() as index:
+            digest = index["aliases"].pop(name, None)
+            if digest is None:
+                return False
+            alias = self.alias_path(name)
+            if os.path.lexists(alias):
+                os.remove(alias)
+            self.collect(digest, index)
+        return True
+
+    def collect(self, digest, index):
+        """Removes the content of ``digest`` if nothing refers to it anymore."""
+        if digest in index["aliases"].values():
+            return
+        for path in (self.content_path(digest), self.content_path(digest) + ".bmap"):
+            if os.path.exists(path):
+                os.remove(path)
+        index["images"].pop(digest, None)
+        chunks = index.get("chunks", {})
+        for chunk, holders in list(chunks.items()):
+            holders[:] = [holder for holder in holders if holder[0] != digest]
+            if not holders:
+                del chunks[chunk]
+        log("Removed unreferenced image {}".format(digest))
+
+    @staticmethod
+    def index_chunks(digest, blockmap, index):
+        """Adds the full chunks of the image ``digest`` to the chunk index."""
+        if blockmap["chunk_size"] != CHUNK_SIZE:
+            return
+        chunks = index.setdefault("chunks", {})
+        for offset, chunk in record_hashes(blockmap).items():
+            if offset + CHUNK_SIZE > blockmap["image_size"]:
+                continue
+            holders = chunks.setdefault(chunk, [])
+            if all(holder[0] != digest for holder in holders):
+                holders.append([digest, offset])
+
+    def dedupe(self, digest, blockmap, index):
+        """
+        Shares identical chunks of the image ``digest`` with the other stored images
+        on filesystems that support it (btrfs, xfs). Returns the shared size.
+        """
+        if "chunks" not in index:
+            # stores from before the chunk index get it built once from the block maps
+            index["chunks"] = {}
+            for other in index["images"]:
+                other_map = load_blockmap(
+                    self.content_path(other) + ".bmap", self.content_path(other)
+                )
+                if other_map is not None:
+                    self.index_chunks(other, other_map, index)
+
+        known = index["chunks"]
+        if not known or blockmap["chunk_size"] != CHUNK_SIZE:
+            return 0
+
+        shared = 0
+        handles = {}
+        dest = os.open(self.content_path(digest), os.O_RDWR)
+        try:
+            for offset, chunk in record_hashes(blockmap).items():
+                if chunk not in known or offset + CHUNK_SIZE > blockmap["image_size"]:
+                    continue
+                holders = [
+                    holder
+                    for holder in known[chunk]
+                    if holder[0] != digest and holder[0] in index["images"]
+                ]
+                if not holders:
+                    continue
+                other, other_offset = holders[0]
+                if other not in handles:
+                    handles[other] = os.open(self.content_path(other), os.O_RDONLY)
+                try:
+                    shared += dedupe_range(
+                        handles[other], other_offset, CHUNK_SIZE, dest, offset
+                    )
+                except OSError as exc:
+                    if exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                        log("Filesystem doesn't support deduplication, skipping")
+                        break
+                    raise
+        finally:
+            os.close(dest)
+            for fd in handles.values():
+                os.close(fd)
+
+        if shared:
+            log("Shared {} with other stored images".format(format_size(shared)))
+        return shared
+
+    def resolve(self, name_or_path):
+        """Returns the hash of a stored image, given its name or (alias) path."""
+        index = self.load()
+        name = os.path.basename(name_or_path)
+        if name.endswith(".img"):
+            name = name[: -len(".img")]
+        if name in index["aliases"]:
+            return index["aliases"][name]
+        if name in index["images"]:
+            return name
+        return None
+
+    def touch(self, digest):
+        with self.locked() as index:
+            if digest in index["images"]:
+                index["images"][digest]["last_flashed"] = time.time()
+
+    def pin(self, name, pinned=True):
+        with self.locked() as index:
+            digest = index["aliases"].get(name)
+            if digest is None:
+                return False
+            index["images"][digest]["pinned"] = pinned
+        return True
+
+    def busy(self, digest):
+        """Whether the image is currently being flashed (flashes hold a shared lock)."""
+        try:
+            fd = os.open(self.content_path(digest), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def usage(self, index):
+        usage = 0
+        for digest in index["images"]:
+            try:
+                usage += os.stat(self.content_path(digest)).st_blocks * 512
+            except OSError:
+                pass
+        return usage
+
+    def evict(self, quota, keep=None):
+        """
+        Removes the least recently flashed images until the store fits into
+        ``quota`` bytes. Pinned images, images in ``keep`` and images that are
+        currently being flashed are never evicted.
+        """
+        keep = set(keep or [])
+        with self.locked() as index:
+            usage = self.usage(index)
+            if usage <= quota:
+                return
+
+            def last_used(digest):
+                info = index["images"][digest]
+                return info.get("last_flashed") or info.get("added") or 0
+
+            for digest in sorted(index["images"], key=last_used):
+                if usage <= quota:
+                    break
+
+                info = index["images"][digest]
+                names = [
+                    name for name, other in index["aliases"].items() if other == digest
+                ]
+                if info.get("pinned") or digest in keep or keep.intersection(names):
+                    continue
+                if self.busy(digest):
+                    continue
+
+                size = os.stat(self.content_path(digest)).st_blocks * 512
+                last = last_used(digest)
+                for name in names:
+                    del index["aliases"][name]
+                    alias = self.alias_path(name)
+                    if os.path.lexists(alias):
+                        os.remove(alias)
+                self.collect(digest, index)
+                usage -= size
+
+                log(
+                    "Evicted {} ({}), last used {}".format(
+                        ", ".join(names) or digest,
+                        format_size(size),
+                        time.strftime("%Y-%m-%d %H:%M", time.localtime(last)),
+                    )
+                )
+
+            if usage > quota:
+                log(
+                    "Image store still uses {}, more than its quota of {}".format(
+                        format_size(usage), format_size(quota)
+                    )
+                )
+
+    def import_legacy(self):
+        """Moves all plain ``<name>.img`` files in the images directory into the store."""
+        for name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, name)
+            if not name.endswith(".img") or os.path.islink(path):
+                continue
+            if not os.path.isfile(path):
+                continue
+            self.add(name[: -len(".img")], path)
+
+
+##~~ Variants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+FICLONE = 0x40049409
+
+
+def copy_image(source, target, blockmap):
+    """
+    Copies an image, as a reflink if the filesystem supports it, otherwise as a
+    sparse copy of its mapped chunks.
+    """
+    with open(source, "rb") as src, open(target, "wb") as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+
+        for offset, length in iter_mapped(blockmap):
+            src.seek(offset)
+            dest.seek(offset)
+            dest.write(src.read(length))
+        dest.truncate(blockmap["image_size"])
+
+
+def update_blockmap(image, blockmap, start, end):
+    """Returns the block map of ``image``, rescanning only the chunks in [start, end)."""
+    chunk_size = blockmap["chunk_size"]
+    hashes = record_hashes(blockmap)
+    first = start // chunk_size
+    last = (end - 1) // chunk_size
+
+    with open(image, "rb") as f:
+        for chunk in range(first, last + 1):
+            f.seek(chunk * chunk_size)
+            data = f.read(chunk_size)
+            offset = chunk * chunk_size
+            if data != ZERO_CHUNK[: len(data)]:
+                hashes[offset] = chunk_hash(data)
+            else:
+                hashes.pop(offset, None)
+
+    offsets = sorted(hashes)
+    updated = make_blockmap(
+        os.stat(image),
+        [offset // chunk_size for offset in offsets],
+        [hashes[offset] for offset in offsets],
+        chunk_size=chunk_size,
+    )
+    updated["unused"] = unused_ranges(image, updated["image_size"], chunk_size=chunk_size)
+    return updated
+
+
+def mount_partition(image, partition, mount, readonly=False):
+    os.makedirs(mount, exist_ok=True)
+    subprocess.check_call(
+        [
+            "mount",
+            "-o",
+            "{}loop,offset={},sizelimit={}".format(
+                "ro," if readonly else "", partition["offset"], partition["size"]
+            ),
+            image,
+            mount,
+        ]
+    )
+
+
+def umount_partition(mount):
+    subprocess.check_call(["umount", mount])
+    os.rmdir(mount)
+
+
+def build_variant(store, base, name, bundle, extra=None):
+    """
+    Creates a copy of the stored image ``base`` with the provisioning ``bundle``
+    applied to its boot partition and stores it as ``name``.
+
+    If the bundle contains a ``rootfs.sh``, that gets run against the rootfs of the
+    copy as well.
+    """
+    base_path = store.alias_path(base)
+    base_map = get_blockmap(base_path)
+
+    boot = boot_partition(base_path)
+    if boot is None:
+        raise ValueError("{} has no FAT boot partition".format(base))
+
+    steps = [(boot, ["sh", os.path.join(bundle, "provision_boot.sh")])]
+
+    rootfs_script = os.path.join(bundle, "rootfs.sh")
+    if os.path.exists(rootfs_script):
+        rootfs = rootfs_partition(base_path)
+        if rootfs is None:
+            raise ValueError("{} has no rootfs partition".format(base))
+        steps.append((rootfs, ["bash", rootfs_script]))
+
+    tmp = os.path.join(store.path, "tmp")
+    os.makedirs(tmp, exist_ok=True)
+    part = os.path.join(tmp, name + ".img")
+
+    copy_image(base_path, part, base_map)
+    try:
+        blockmap = base_map
+        for number, (partition, command) in enumerate(steps):
+            mount = os.path.join(tmp, "{}.mnt{}".format(name, number))
+            mount_partition(part, partition, mount)
+            try:
+                subprocess.check_call(command + [mount])
+            finally:
+                umount_partition(mount)
+
+            blockmap = update_blockmap(
+                part, blockmap, partition["offset"], partition["offset"] + partition["size"]
+            )
+        save_blockmap(part + ".bmap", blockmap)
+
+        info = {"variant": dict(extra or {}, base=base_map["image_hash"])}
+        return store.add(name, part, extra=info)
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+def ext4_used_chunks(device, partition, chunk_size=CHUNK_SIZE):
+    """
+    Returns the offsets of all chunks of ``device`` that hold blocks in use by the ext4
+    filesystem on ``partition``, according to its block bitmaps, or None if it isn't
+    an ext4 filesystem. Everything else in the partition is free space.
+    """
+    start = partition["offset"]
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        superblock = os.pread(fd, 1024, start + 1024)
+        if len(superblock) < 0x160 or struct.unpack_from("<H", superblock, 0x38)[0] != EXT4_MAGIC:
+            return None
+
+        (blocks_lo, first_data_block, log_block_size) = struct.unpack_from(
+            "<I12xII", superblock, 0x04
+        )
+        blocks_per_group = struct.unpack_from("<I", superblock, 0x20)[0]
+        inodes_per_group = struct.unpack_from("<I", superblock, 0x28)[0]
+        inode_size = struct.unpack_from("<H", superblock, 0x58)[0]
+        incompat, ro_compat = struct.unpack_from("<II", superblock, 0x60)
+
+        is_64bit = incompat & 0x80
+        blocks_count = blocks_lo
+        desc_size = 32
+        if is_64bit:
+            blocks_count |= struct.unpack_from("<I", superblock, 0x150)[0] << 32
+            desc_size = struct.unpack_from("<H", superblock, 0xFE)[0] or 64
+
+        reserved_gdt_blocks = struct.unpack_from("<H", superblock, 0xCE)[0]
+
+        block_size = 1024 << log_block_size
+        groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+        itable_blocks = -(-inodes_per_group * inode_size // block_size)
+        sparse_super = ro_compat & 0x1
+
+        def has_backup(group):
+            if group < 2 or not sparse_super:
+                return True
+            for base in (3, 5, 7):
+                power = base
+                while power < group:
+                    power *= base
+                if power == group:
+                    return True
+            return False
+
+        chunks = set()
+
+        def mark(block, count=1):
+            first = (start + block * block_size) // chunk_size
+            last = (start + (block + count) * block_size - 1) // chunk_size
+            chunks.update(range(first, last + 1))
+
+        descriptors = os.pread(
+            fd, groups * desc_size, start + (first_data_block + 1) * block_size
+        )
+        for group in range(groups):
+            desc = descriptors[group * desc_size : (group + 1) * desc_size]
+            block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc, 0)
+            flags = struct.unpack_from("<H", desc, 0x12)[0]
+            if is_64bit and desc_size >= 64:
+                hi = struct.unpack_from("<III", desc, 0x20)
+                block_bitmap |= hi[0] << 32
+                inode_bitmap |= hi[1] << 32
+                inode_table |= hi[2] << 32
+
+            group_start = first_data_block + group * blocks_per_group
+            if has_backup(group):
+                # superblock and group descriptors (or their backups)
+                gdt_blocks = -(-len(descriptors) // block_size)
+                mark(group_start, 1 + gdt_blocks + reserved_gdt_blocks)
+            mark(block_bitmap)
+            mark(inode_bitmap)
+            mark(inode_table, itable_blocks)
+
+            if flags & 0x2:  # BLOCK_UNINIT, nothing but metadata in use
+                continue
+
+            bitmap = os.pread(
+                fd, blocks_per_group // 8, start + block_bitmap * block_size
+            )
+            for index, byte in enumerate(bitmap):
+                if byte:
+                    mark(group_start + index * 8, 8)
+    finally:
+        os.close(fd)
+
+    end = start + partition["size"]
+    return sorted(
+        chunk * chunk_size for chunk in chunks if chunk * chunk_size < end
+    )
+
+
+def used_chunks(device, chunk_size=CHUNK_SIZE):
+    """
+    Returns the offsets of all chunks of ``device`` that hold data worth keeping: the
+    partition table, everything in the partitions, except for free space of ext4
+    filesystems. Also returns the end of the last partition.
+    """
+    table = partitions(device)
+    if not table:
+        raise ValueError("{} has no partitions".format(device))
+
+    chunks = set(range(min(p["offset"] for p in table) // chunk_size + 1))
+    for partition in table:
+        used = ext4_used_chunks(device, partition, chunk_size=chunk_size)
+        if used is None:
+            first = partition["offset"] // chunk_size
+            last = (partition["offset"] + partition["size"] - 1) // chunk_size
+            used = [chunk * chunk_size for chunk in range(first, last + 1)]
+        chunks.update(offset // chunk_size for offset in used)
+
+    end = max(p["offset"] + p["size"] for p in table)
+    return [chunk * chunk_size for chunk in sorted(chunks)], end
+
+
+def unused_ranges(image, size, chunk_size=CHUNK_SIZE):
+    """
+    Returns the ``[start, end)`` ranges of chunks of ``image`` whose content doesn't
+    matter, i.e. free space of its ext4 filesystems and anything outside of its
+    partitions. Flashing doesn't need to zero those.
+    """
+    try:
+        chunks, _ = used_chunks(image, chunk_size=chunk_size)
+    except ValueError:
+        return []
+    used = set(offset // chunk_size for offset in chunks)
+    return chunk_ranges(
+        [chunk for chunk in range(-(-size // chunk_size)) if chunk not in used]
+    )
+
+
+def check_filesystem(image):
+    """
+    Runs a read only e2fsck against the rootfs of ``image``, to make sure a capture
+    didn't miss anything the filesystem is using.
+    """
+    partition = rootfs_partition(image)
+    if partition is None:
+        return
+
+    try:
+        subprocess.check_output(
+            ["e2fsck", "-fn", "{}?offset={}".format(image, partition["offset"])],
+            stderr=subprocess.STDOUT,
+        )
+    except OSError as exc:
+        log("Could not check the rootfs of {}: {}".format(image, exc))
+    except subprocess.CalledProcessError as exc:
+        log(exc.output.decode("utf-8", "replace"))
+        raise ValueError("Rootfs of {} is inconsistent, capture is broken".format(image))
+
+
+def capture_variant(store, base, name, device, extra=None):
+    """
+    Stores the current content of the card in ``device`` as ``name``, a copy of the
+    stored image ``base`` (the image the card got flashed with) with only those chunks
+    replaced that changed on the card since.
+
+    Free space of the card's ext4 filesystems doesn't get read at all and stays a hole
+    in the copy, so a rootfs that got expanded to the size of the card costs nothing
+    but what's actually in use. On filesystems with reflink support (btrfs, xfs), all
+    unchanged chunks are shared with the base image.
+    """
+    digest = store.resolve(base)
+    if digest is None:
+        raise ValueError("No image {} in store".format(base))
+    base_path = store.content_path(digest)
+    base_map = get_blockmap(base_path)
+    chunk_size = base_map["chunk_size"]
+
+    drop_cache(device)
+    chunks, end = used_chunks(device, chunk_size=chunk_size)
+    size = max(end, base_map["image_size"])
+
+    tmp = os.path.join(store.path, "tmp")
+    os.makedirs(tmp, exist_ok=True)
+    part = os.path.join(tmp, name + ".img")
+
+    copy_image(base_path, part, base_map)
+    try:
+        hashes = record_hashes(base_map)
+        rescan = set()
+        if size > base_map["image_size"]:
+            # the last chunk of the base gets padded by the new size
+            rescan.add(base_map["image_size"] // chunk_size * chunk_size)
+
+        changed = 0
+        progress = Progress(len(chunks) * chunk_size, verb="compared")
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            with open(part, "r+b") as f:
+                f.truncate(size)
+                for offset in chunks:
+                    data = os.pread(fd, min(chunk_size, size - offset), offset)
+                    progress.update(len(data))
+                    if data == ZERO_CHUNK[: len(data)]:
+                        if offset in hashes:
+                            f.seek(offset)
+                            f.write(data)
+                            changed += len(data)
+                            rescan.add(offset)
+                        continue
+                    if hashes.get(offset) == chunk_hash(data):
+                        continue
+                    f.seek(offset)
+                    f.write(data)
+                    changed += len(data)
+                    rescan.add(offset)
+        finally:
+            os.close(fd)
+        progress.report()
+
+        with open(part, "rb") as f:
+            for offset in rescan:
+                f.seek(offset)
+                data = f.read(chunk_size)
+                if data and data != ZERO_CHUNK[: len(data)]:
+                    hashes[offset] = chunk_hash(data)
+                else:
+                    hashes.pop(offset, None)
+
+        offsets = sorted(hashes)
+        blockmap = make_blockmap(
+            os.stat(part),
+            [offset // chunk_size for offset in offsets],
+            [hashes[offset] for offset in offsets],
+            chunk_size=chunk_size,
+        )
+
+        # free space of the card, no need to zero that when flashing
+        blockmap["unused"] = unused_ranges(part, size, chunk_size=chunk_size)
+        save_blockmap(part + ".bmap", blockmap)
+        check_filesystem(part)
+        log(
+            "{} changed on {} compared to {}".format(
+                format_size(changed), device, base
+            )
+        )
+
+        info = {
+            "golden": dict(
+                extra or {},
+                base=digest,
+                changed_size=changed,
+                captured=time.time(),
+            )
+        }
+        return store.add(name, part, extra=info)
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+##~~ Prefetching ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+class PrefetchQueue(object):
+    """
+    Queue of images to download into the store in the background.
+
+    A single detached worker process works through the queue, so downloads never
+    compete with each other and stay off the critical path of flashing.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.path = os.path.join(store.path, "prefetch.json")
+        self.log_path = os.path.join(store.path, "prefetch.log")
+
+    @staticmethod
+    def empty():
+        return {"queue": [], "current": None, "done": [], "failed": []}
+
+    def locked(self):
+        return locked_json(self.path, self.empty)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self.empty()
+
+    def add(self, url, name, checksum=None, quota=None):
+        with self.locked() as state:
+            pending = [item["name"] for item in state["queue"]]
+            if state["current"]:
+                pending.append(state["current"]["name"])
+            if name in pending:
+                log("{} is already queued for prefetching".format(name))
+            else:
+                state["queue"].append(
+                    {
+                        "url": url,
+                        "name": name,
+                        "checksum": checksum,
+                        "quota": quota,
+                        "queued": time.time(),
+                    }
+                )
+                log("Queued {} for prefetching".format(name))
+        self.spawn_worker()
+
+    def spawn_worker(self):
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "store",
+            "prefetch-worker",
+            self.store.path,
+        ]
+        if shutil.which("ionice"):
+            # stay out of the way of flashes on the same disk
+            command = ["ionice", "-c", "3"] + command
+        with open(self.log_path, "a") as output:
+            subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+    def pending(self, name):
+        state = self.load()
+        if state["current"] and state["current"]["name"] == name:
+            return True
+        return any(item["name"] == name for item in state["queue"])
+
+    def work(self):
+        """Works through the queue, unless another worker already does."""
+        while True:
+            fd = os.open(self.path + ".worker", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                self._work()
+            finally:
+                os.close(fd)
+
+            # something might have been queued while we were shutting down
+            if not self.load()["queue"]:
+                return
+
+    def _work(self):
+        while True:
+            with self.locked() as state:
+                if not state["queue"]:
+                    state["current"] = None
+                    return
+                item = state["queue"].pop(0)
+                item["started"] = time.time()
+                state["current"] = item
+
+            name = item["name"]
+            if name in self.store.load()["aliases"]:
+                ok = True
+                log("{} is already in the store".format(name))
+            else:
+                ok = fetch_image(
+                    item["url"],
+                    self.store.alias_path(name),
+                    tmp=os.path.join(self.store.path, "tmp"),
+                    checksum=item.get("checksum"),
+                    store=self.store.path,
+                    quota=item.get("quota"),
+                )
+
+            with self.locked() as state:
+                item["finished"] = time.time()
+                state["current"] = None
+                key = "done" if ok else "failed"
+                state[key] = (state[key] + [item])[-20:]
+
+
+##~~ Device readiness ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+BLKRRPART = 0x125F
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class DirectoryWatch(object):
+    """
+    Wakes up as soon as entries appear in or vanish from any of the watched
+    directories, via inotify if the libc provides it and by polling otherwise.
+    """
+
+    def __init__(self, paths):
+        self.fd = None
+        try:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return
+            for path in paths:
+                if os.path.isdir(path):
+                    libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+            self.fd = fd
+        except (OSError, AttributeError):
+            pass
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def device_ready(path):
+    """A device is ready once it can be opened and has media of non-zero size."""
+    try:
+        return device_size(path) > 0
+    except OSError:
+        # ENOENT: no udev link yet, ENOMEDIUM/ENXIO: reader there but card not yet
+        return False
+
+
+def udev_settle(timeout):
+    try:
+        subprocess.call(["udevadm", "settle", "--timeout={}".format(int(timeout))])
+    except OSError:
+        pass
+
+
+def reread_partitions(device):
+    """Makes the kernel pick up the partition table that was just written to device."""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except OSError as exc:
+        log("Could not reread partition table of {}: {}".format(device, exc))
+    finally:
+        os.close(fd)
+
+
+def wait_devices(paths, timeout, absent=False, interval=0.25):
+    """
+    Waits until all of ``paths`` are ready (or gone, with ``absent``) and returns
+    how long that took. Directory events of /dev wake us up right away, the
+    interval only covers changes of the media that don't show up as such.
+    """
+    start = time.monotonic()
+    directories = {"/dev", "/dev/disk"} | {os.path.dirname(path) for path in paths}
+    watch = DirectoryWatch(sorted(directories))
+    try:
+        while True:
+            ready = [device_ready(path) for path in paths]
+            if (not any(ready)) if absent else all(ready):
+                return time.monotonic() - start
+
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                waiting = [path for path, r in zip(paths, ready) if r == absent]
+                raise TimeoutError(
+                    "Timed out after {}s waiting for {} to {}".format(
+                        timeout, ", ".join(waiting), "vanish" if absent else "be ready"
+                    )
+                )
+            watch.wait(min(interval, remaining))
+    finally:
+        watch.close()
+
+
+##~~ Flash scheduling ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def device_bus(device):
+    """Returns the USB bus (e.g. ``usb2``) a block device hangs off, or None."""
+    name = os.path.basename(os.path.realpath(device))
+    sysfs = os.path.realpath("/sys/class/block/{}".format(name))
+
+    bus = None
+    for part in sysfs.split("/"):
+        if re.match(r"^usb\d+$", part):
+            bus = part
+    return bus
+
+
+def serial_bus(serial):
+    """
+    Returns the USB bus of the USB device with ``serial``, or None. Unlike
+    :func:`device_bus` this also works while the card is switched to the DUT.
+    """
+    for path in glob.glob("/sys/bus/usb/devices/*/serial"):
+        try:
+            with open(path) as f:
+                if f.read().strip() != serial:
+                    continue
+        except OSError:
+            continue
+        port = os.path.basename(os.path.dirname(path))
+        return "usb" + port.split("-")[0]
+    return None
+
+
+def bus_slots(bus, card_mbps):
+    """
+    Returns how many cards can be flashed in parallel on ``bus`` before the bus
+    bandwidth rather than the cards becomes the bottleneck.
+    """
+    try:
+        with open("/sys/bus/usb/devices/{}/speed".format(bus)) as f:
+            speed = float(f.read().strip())  # Mbit/s
+    except (OSError, ValueError):
+        return 1
+
+    # leave some headroom for protocol overhead
+    usable = speed * 0.6 / 8
+    return max(1, int(usable // card_mbps))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FlashQueue(object):
+    """
+    FIFO queue of flash jobs per USB bus, with a limited number of slots per bus.
+
+    Every waiting job holds a ticket file in the bus' queue directory, named after
+    its enqueue time and pid, running jobs hold a flock on one of the slot files.
+    Both survive independent invocations, so separate fab runs share the queue.
+    """
+
+    def __init__(self, path, bus, slots):
+        self.path = os.path.join(path, bus)
+        self.bus = bus
+        self.slots = slots
+        self.ticket = None
+        self.lock = None
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def tickets(self):
+        tickets = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".ticket"):
+                continue
+            try:
+                pid = int(name.split("-")[1].split(".")[0])
+            except (IndexError, ValueError):
+                continue
+            if not pid_alive(pid):
+                # left behind by a killed job
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                continue
+            tickets.append(name)
+        return sorted(tickets)
+
+    def try_lock(self):
+        for slot in range(self.slots):
+            fd = os.open(
+                os.path.join(self.path, "slot-{}.lock".format(slot)),
+                os.O_RDWR | os.O_CREAT,
+                0o644,
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def acquire(self, timeout):
+        self.ticket = "{:020d}-{}.ticket".format(time.time_ns(), os.getpid())
+        with open(os.path.join(self.path, self.ticket), "w"):
+            pass
+
+        start = time.monotonic()
+        last_report = None
+        try:
+            while True:
+                tickets = self.tickets()
+                position = tickets.index(self.ticket) if self.ticket in tickets else 0
+                if position < self.slots:
+                    self.lock = self.try_lock()
+                    if self.lock is not None:
+                        break
+
+                waited = time.monotonic() - start
+                if timeout and waited > timeout:
+                    raise TimeoutError(
+                        "Got no flash slot on {} after {:.0f}s".format(self.bus, waited)
+                    )
+
+                if last_report is None or time.monotonic() - last_report >= 10.0:
+                    last_report = time.monotonic()
+                    log(
+                        "Waiting for a flash slot on {} ({} slots), queue position {}, waited {:.0f}s".format(
+                            self.bus, self.slots, position + 1, waited
+                        )
+                    )
+                time.sleep(0.5)
+        finally:
+            os.remove(os.path.join(self.path, self.ticket))
+
+        waited = time.monotonic() - start
+        log("Got flash slot on {} after waiting {:.1f}s".format(self.bus, waited))
+        return waited
+
+    def release(self):
+        if self.lock is not None:
+            os.close(self.lock)
+            self.lock = None
+
+
+##~~ CLI ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def cmd_bmap(args):
+    blockmap = get_blockmap(args.image, path=args.bmap)
+    log(
+        "{}: {} of {} mapped".format(
+            args.image,
+            format_size(blockmap["mapped_size"]),
+            format_size(blockmap["image_size"]),
+        )
+    )
+
+
+def cmd_write(args):
+    blockmap = get_blockmap(args.image, path=args.bmap)
+    start = time.monotonic()
+
+    # tells the image store not to evict the image while we are flashing it
+    image_lock = os.open(args.image, os.O_RDONLY)
+    fcntl.flock(image_lock, fcntl.LOCK_SH)
+
+    record = None
+    if args.diff:
+        record = load_record(args.record)
+        stale = record_staleness(record, args.device, blockmap, args.max_age)
+        if stale:
+            log("Falling back to full write: {}".format(stale))
+            record = None
+
+    if record is not None:
+        log(
+            "Writing changed chunks of {} from {} to {}, last flash was {}".format(
+                format_size(blockmap["mapped_size"]),
+                args.image,
+                args.device,
+                record.get("image"),
+            )
+        )
+        written = write_diff(args.image, args.device, blockmap, record)
+        log("Wrote {} of changed chunks".format(format_size(written)))
+    else:
+        log(
+            "Writing {} of {} from {} to {}".format(
+                format_size(blockmap["mapped_size"]),
+                format_size(blockmap["image_size"]),
+                args.image,
+                args.device,
+            )
+        )
+        write_sparse(args.image, args.device, blockmap)
+
+    if args.record:
+        save_record(args.record, create_record(args.image, args.device, blockmap))
+
+    os.close(image_lock)
+    if args.store:
+        ImageStore(args.store).touch(blockmap["image_hash"])
+
+    log("Done in {:.1f}s".format(time.monotonic() - start))
+
+
+def cmd_verify(args):
+    if args.action == "await":
+        return await_verification(args.result, args.timeout)
+
+    if args.result:
+        save_result(args.result, {"status": "running", "pid": os.getpid()})
+
+    blockmap = get_blockmap(args.image, path=args.bmap)
+
+    # tells the image store not to evict the image while we are reading it
+    image_lock = os.open(args.image, os.O_RDONLY)
+    fcntl.flock(image_lock, fcntl.LOCK_SH)
+
+    start = time.monotonic()
+    try:
+        offsets = verify_offsets(args.device, blockmap, region=args.region, sample=args.sample)
+        log(
+            "Verifying {}{} chunks of {} on {}...".format(
+                "a sample of " if args.sample else "",
+                len(offsets),
+                args.image,
+                args.device,
+            )
+        )
+        mismatches = verify_chunks(args.device, blockmap, offsets, jobs=args.jobs)
+    except Exception as exc:
+        if args.result:
+            save_result(
+                args.result,
+                {"status": "error", "checked": 0, "mismatches": [], "error": str(exc)},
+            )
+        raise
+    finally:
+        os.close(image_lock)
+
+    if args.result:
+        save_result(
+            args.result,
+            {
+                "status": "failed" if mismatches else "ok",
+                "checked": len(offsets),
+                "mismatches": mismatches,
+                "duration": time.monotonic() - start,
+            },
+        )
+
+    if mismatches:
+        log(
+            "{} of {} chunks don't match: {}".format(
+                len(mismatches),
+                len(offsets),
+                ", ".join(str(offset) for offset in mismatches),
+            )
+        )
+        return 1
+    log("Verified in {:.1f}s".format(time.monotonic() - start))
+
+
+def cmd_slot(args):
+    bus = args.bus or device_bus(args.device) or "unknown"
+    if args.slots == "auto":
+        slots = bus_slots(bus, args.card_mbps)
+    else:
+        slots = int(args.slots)
+
+    command = args.cmd
+    if command and command[0] == "--":
+        command = command[1:]
+
+    queue = FlashQueue(args.queue, bus, slots)
+    try:
+        queue.acquire(args.timeout)
+    except TimeoutError as exc:
+        log(str(exc))
+        return 1
+
+    try:
+        return subprocess.call(command)
+    finally:
+        queue.release()
+
+
+def cmd_bus(args):
+    bus = args.bus or device_bus(args.device) or "unknown"
+    if bus == "unknown" and args.serial:
+        bus = serial_bus(args.serial) or bus
+    if args.slots == "auto":
+        slots = bus_slots(bus, args.card_mbps)
+    else:
+        slots = int(args.slots)
+    print("{} {}".format(bus, slots))
+    return 0
+
+
+def cmd_state(args):
+    if args.action == "write":
+        state = write_state(args.device, args.record, args.image, args.provision)
+        log("Wrote fingerprint {} to {}".format(state["id"], args.device))
+        return
+
+    reason = check_state(args.device, args.record, args.image, args.provision)
+    if reason:
+        log("Card doesn't match: {}".format(reason))
+        return 1
+    log("Card holds {} untouched since it was flashed".format(args.image))
+
+
+def cmd_wait(args):
+    start = time.monotonic()
+    if args.reread:
+        reread_partitions(args.reread)
+        # the kernel dropping and re-adding the partitions only shows up in /dev
+        # once udev has worked through the events
+        udev_settle(args.timeout)
+
+    try:
+        wait_devices(args.device, args.timeout, absent=args.absent)
+        if not args.absent:
+            # partition links of a device that just appeared come in separate events
+            udev_settle(max(1, args.timeout - (time.monotonic() - start)))
+    except TimeoutError as exc:
+        log(str(exc))
+        return 1
+
+    log(
+        "{} {} after {:.2f}s".format(
+            ", ".join(args.device),
+            "gone" if args.absent else "ready",
+            time.monotonic() - start,
+        )
+    )
+
+
+def fetch_image(
+    url, image, tmp=None, checksum=None, fmt="auto", store=None, quota=None
+):
+    """
+    Downloads ``url`` to ``image`` and adds it to the ``store`` if set, evicting old
+    images if that exceeds ``quota``. Returns whether that worked.
+    """
+    start = time.monotonic()
+    tmp = tmp or os.path.dirname(os.path.abspath(image))
+    os.makedirs(tmp, exist_ok=True)
+    part = os.path.join(tmp, os.path.basename(image) + ".part")
+
+    log("Fetching {} to {}".format(url, image))
+    sink = None
+    try:
+        stream = HttpStream(url, checksum=checksum)
+        sink = ImageSink(part)
+        size = pump(stream, [sink], fmt=fmt)
+        sink.close()
+        stream.verify()
+    except (OSError, ValueError, http.client.HTTPException) as exc:
+        if sink is not None:
+            sink.close()
+            os.remove(part)
+        log("Fetching {} failed: {}".format(url, exc))
+        return False
+
+    os.replace(part, image)
+
+    # we already know which chunks contain data, no need to scan again for flashing
+    save_blockmap(image + ".bmap", sink.blockmap(path=image))
+
+    if store:
+        name = os.path.basename(image)[: -len(".img")]
+        image_store = ImageStore(store)
+        image_store.add(name, image, compressed_size=stream.offset, source=url)
+        if quota:
+            image_store.evict(parse_size(quota), keep=[name])
+
+    log(
+        "Fetched {} image from {} download in {:.1f}s".format(
+            format_size(size), format_size(stream.offset), time.monotonic() - start
+        )
+    )
+    return True
+
+
+def cmd_fetch(args):
+    ok = fetch_image(
+        args.url,
+        args.image,
+        tmp=args.tmp,
+        checksum=args.checksum,
+        fmt=args.format,
+        store=args.store,
+        quota=args.quota,
+    )
+    return 0 if ok else 1
+
+
+def close_sinks(sinks):
+    """Closes all sinks, even if some of them fail, and raises the first error."""
+    error = None
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as exc:
+            if error is None:
+                error = exc
+    if error is not None:
+        raise error
+
+
+def cmd_stream(args):
+    start = time.monotonic()
+    tmp = args.tmp or os.path.dirname(os.path.abspath(args.cache))
+    part = os.path.join(tmp, os.path.basename(args.cache) + ".part")
+
+    log("Streaming {} to {}, caching it as {}".format(args.url, args.device, args.cache))
+    stream = HttpStream(args.url, checksum=args.checksum)
+    cache = ImageSink(part)
+    sinks = [
+        BackgroundSink(DeviceSink(args.device, full=args.mode == "full")),
+        BackgroundSink(cache),
+    ]
+    try:
+        try:
+            size = pump(stream, sinks, fmt=args.format)
+        finally:
+            close_sinks(sinks)
+        stream.verify()
+    except (OSError, ValueError, http.client.HTTPException) as exc:
+        os.remove(part)
+        log("Streaming {} failed: {}".format(args.url, exc))
+        return 1
+
+    os.replace(part, args.cache)
+    blockmap = cache.blockmap(path=args.cache)
+    save_blockmap(args.cache + ".bmap", blockmap)
+    if args.record:
+        save_record(args.record, create_record(args.cache, args.device, blockmap))
+
+    if args.store:
+        name = os.path.basename(args.cache)[: -len(".img")]
+        store = ImageStore(args.store)
+        digest = store.add(
+            name, args.cache, compressed_size=stream.offset, source=args.url
+        )
+        store.touch(digest)
+        if args.quota:
+            store.evict(parse_size(args.quota), keep=[name])
+
+    log(
+        "Flashed {} image from {} download in {:.1f}s".format(
+            format_size(size), format_size(stream.offset), time.monotonic() - start
+        )
+    )
+
+
+def cmd_store(args):
+    store = ImageStore(args.store)
+    if args.action == "add":
+        store.add(
+            args.name, args.image, compressed_size=args.compressed_size, source=args.source
+        )
+    elif args.action == "remove":
+        if not store.remove(args.name):
+            log("No image {} in store".format(args.name))
+            return 1
+    elif args.action == "import":
+        store.import_legacy()
+    elif args.action == "list":
+        print(json.dumps(store.load(), indent=2, sort_keys=True))
+    elif args.action == "touch":
+        digest = store.resolve(args.name)
+        if digest is not None:
+            store.touch(digest)
+    elif args.action == "pin":
+        if not store.pin(args.name, pinned=not args.unpin):
+            log("No image {} in store".format(args.name))
+            return 1
+    elif args.action == "evict":
+        store.evict(parse_size(args.quota), keep=args.keep)
+    elif args.action == "prefetch":
+        PrefetchQueue(store).add(
+            args.url, args.name, checksum=args.checksum, quota=args.quota
+        )
+    elif args.action == "prefetch-worker":
+        PrefetchQueue(store).work()
+    elif args.action == "prefetch-status":
+        print(json.dumps(PrefetchQueue(store).load(), indent=2, sort_keys=True))
+    elif args.action == "await":
+        return await_image(store, args.name, args.timeout)
+    elif args.action == "variant":
+        build_variant(
+            store,
+            args.base,
+            args.name,
+            args.bundle,
+            extra={"key": args.key, "target": args.target},
+        )
+    elif args.action == "golden":
+        extra = json.loads(args.extra) if args.extra else {}
+        capture_variant(
+            store, args.base, args.name, args.device, extra=dict(extra, target=args.target)
+        )
+
+
+def await_image(store, name, timeout):
+    """Waits for a queued prefetch of ``name`` to land in the store."""
+    prefetch = PrefetchQueue(store)
+    start = time.monotonic()
+    last_report = start
+    while True:
+        if name in store.load()["aliases"]:
+            log("{} is available after {:.1f}s".format(name, time.monotonic() - start))
+            return 0
+        if not prefetch.pending(name):
+            log("{} is neither stored nor queued for prefetching".format(name))
+            return 1
+        if timeout and time.monotonic() - start > timeout:
+            log("{} still not prefetched after {}s".format(name, timeout))
+            return 1
+        if time.monotonic() - last_report >= 30.0:
+            last_report = time.monotonic()
+            log("Waiting for prefetch of {}...".format(name))
+        time.sleep(2.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="flashhost image helper")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    bmap = subparsers.add_parser("bmap", help="build or refresh the block map of an image")
+    bmap.add_argument("image")
+    bmap.add_argument("--bmap", help="path of the block map, defaults to <image>.bmap")
+    bmap.set_defaults(func=cmd_bmap)
+
+    write = subparsers.add_parser(
+        "write", help="write the mapped chunks of an image to a device"
+    )
+    write.add_argument("image")
+    write.add_argument("device")
+    write.add_argument("--bmap", help="path of the block map, defaults to <image>.bmap")
+    write.add_argument(
+        "--record", help="path of the record of the last flash of this device"
+    )
+    write.add_argument(
+        "--diff",
+        action="store_true",
+        help="only write chunks that differ from the device, needs --record",
+    )
+    write.add_argument(
+        "--store", help="images directory to record the flash in the store of"
+    )
+    write.add_argument(
+        "--max-age",
+        type=int,
+        default=0,
+        help="consider records older than this many seconds stale",
+    )
+    write.set_defaults(func=cmd_write)
+
+    verify = subparsers.add_parser(
+        "verify", help="read a flashed image back from a device and compare"
+    )
+    verify_actions = verify.add_subparsers(dest="action")
+    verify_actions.required = True
+
+    verify_check = verify_actions.add_parser(
+        "check", help="compare the mapped chunks of the image with the device"
+    )
+    verify_check.add_argument("image")
+    verify_check.add_argument("device")
+    verify_check.add_argument(
+        "--bmap", help="path of the block map, defaults to <image>.bmap"
+    )
+    verify_check.add_argument(
+        "--region",
+        choices=["all", "boot", "rest"],
+        default="all",
+        help="only the partition table & boot partition, or only everything after",
+    )
+    verify_check.add_argument(
+        "--sample",
+        type=float,
+        default=0.0,
+        help="only check this fraction of randomly picked chunks",
+    )
+    verify_check.add_argument(
+        "--jobs", type=int, help="threads to read & hash with, defaults to all cores"
+    )
+    verify_check.add_argument("--result", help="file to write the result to")
+
+    verify_await = verify_actions.add_parser(
+        "await", help="wait for a verification writing a result file to finish"
+    )
+    verify_await.add_argument("result")
+    verify_await.add_argument("--timeout", type=int, default=3600)
+
+    verify.set_defaults(func=cmd_verify)
+
+    fetch = subparsers.add_parser(
+        "fetch", help="download, decompress and store an image in one pass"
+    )
+    fetch.add_argument("url")
+    fetch.add_argument("image", help="path of the resulting .img")
+    fetch.add_argument(
+        "--checksum",
+        help="expected checksum of the download, as [algorithm:]hexdigest (default sha256)",
+    )
+    fetch.add_argument(
+        "--format",
+        default="auto",
+        choices=["auto", "img"] + sorted(DECOMPRESSORS.keys()),
+        help="compression of the download, detected from its content by default",
+    )
+    fetch.add_argument("--tmp", help="directory for the partial image")
+    fetch.add_argument("--store", help="images directory to add the image to the store of")
+    fetch.add_argument("--quota", help="size limit of the store, e.g. 50G")
+    fetch.set_defaults(func=cmd_fetch)
+
+    stream = subparsers.add_parser(
+        "stream", help="flash an image straight from a URL while caching it"
+    )
+    stream.add_argument("url")
+    stream.add_argument("device")
+    stream.add_argument("--cache", required=True, help="path of the cached .img")
+    stream.add_argument(
+        "--record", help="path of the record of the last flash of this device"
+    )
+    stream.add_argument(
+        "--checksum",
+        help="expected checksum of the download, as [algorithm:]hexdigest (default sha256)",
+    )
+    stream.add_argument(
+        "--format",
+        default="auto",
+        choices=["auto", "img"] + sorted(DECOMPRESSORS.keys()),
+        help="compression of the download, detected from its content by default",
+    )
+    stream.add_argument("--tmp", help="directory for the partial cached image")
+    stream.add_argument(
+        "--mode",
+        choices=["full", "sparse"],
+        default="sparse",
+        help="full also writes all-zero chunks, sparse only zeroes where needed",
+    )
+    stream.add_argument(
+        "--store", help="images directory to add the cached image to the store of"
+    )
+    stream.add_argument("--quota", help="size limit of the store, e.g. 50G")
+    stream.set_defaults(func=cmd_stream)
+
+    store = subparsers.add_parser("store", help="manage the content addressed image store")
+    store_actions = store.add_subparsers(dest="action")
+    store_actions.required = True
+
+    store_add = store_actions.add_parser("add", help="move an image into the store")
+    store_add.add_argument("store", help="images directory")
+    store_add.add_argument("name")
+    store_add.add_argument("image")
+    store_add.add_argument("--compressed-size", type=int)
+    store_add.add_argument("--source")
+
+    store_remove = store_actions.add_parser("remove", help="remove an image alias")
+    store_remove.add_argument("store", help="images directory")
+    store_remove.add_argument("name")
+
+    store_import = store_actions.add_parser(
+        "import", help="move plain .img files into the store"
+    )
+    store_import.add_argument("store", help="images directory")
+
+    store_list = store_actions.add_parser("list", help="print the store index")
+    store_list.add_argument("store", help="images directory")
+
+    store_touch = store_actions.add_parser("touch", help="mark an image as just flashed")
+    store_touch.add_argument("store", help="images directory")
+    store_touch.add_argument("name", help="name or path of the image")
+
+    store_pin = store_actions.add_parser("pin", help="protect an image from eviction")
+    store_pin.add_argument("store", help="images directory")
+    store_pin.add_argument("name")
+    store_pin.add_argument("--unpin", action="store_true")
+
+    store_evict = store_actions.add_parser(
+        "evict", help="evict least recently flashed images down to a quota"
+    )
+    store_evict.add_argument("store", help="images directory")
+    store_evict.add_argument("quota", help="size limit of the store, e.g. 50G")
+    store_evict.add_argument("--keep", action="append", help="image to never evict")
+
+    store_prefetch = store_actions.add_parser(
+        "prefetch", help="queue an image for downloading in the background"
+    )
+    store_prefetch.add_argument("store", help="images directory")
+    store_prefetch.add_argument("url")
+    store_prefetch.add_argument("name")
+    store_prefetch.add_argument("--checksum")
+    store_prefetch.add_argument("--quota", help="size limit of the store, e.g. 50G")
+
+    store_worker = store_actions.add_parser(
+        "prefetch-worker", help="work through the prefetch queue"
+    )
+    store_worker.add_argument("store", help="images directory")
+
+    store_status = store_actions.add_parser(
+        "prefetch-status", help="print the prefetch queue"
+    )
+    store_status.add_argument("store", help="images directory")
+
+    store_await = store_actions.add_parser(
+        "await", help="wait for a queued prefetch of an image to finish"
+    )
+    store_await.add_argument("store", help="images directory")
+    store_await.add_argument("name")
+    store_await.add_argument("--timeout", type=int, default=3600)
+
+    store_variant = store_actions.add_parser(
+        "variant", help="store a copy of an image with a provisioning bundle applied"
+    )
+    store_variant.add_argument("store", help="images directory")
+    store_variant.add_argument("base", help="name of the stored base image")
+    store_variant.add_argument("name", help="name of the variant")
+    store_variant.add_argument("bundle", help="extracted provisioning bundle")
+    store_variant.add_argument("--key", help="hash of the provisioning inputs")
+    store_variant.add_argument("--target", help="target the variant is for")
+
+    store_golden = store_actions.add_parser(
+        "golden", help="store the content of a card as copy of the image it was flashed with"
+    )
+    store_golden.add_argument("store", help="images directory")
+    store_golden.add_argument("base", help="name or hash of the stored image on the card")
+    store_golden.add_argument("name", help="name of the golden image")
+    store_golden.add_argument("device", help="card to capture")
+    store_golden.add_argument("--target", help="target the card belongs to")
+    store_golden.add_argument("--extra", help="JSON object to store with the image")
+
+    store.set_defaults(func=cmd_store)
+
+    slot = subparsers.add_parser(
+        "slot", help="run a command once a flash slot on the device's USB bus is free"
+    )
+    slot.add_argument("--queue", required=True, help="directory holding the queues")
+    slot.add_argument("--device", required=True, help="device that will be flashed")
+    slot.add_argument("--bus", help="USB bus of the device, detected if not set")
+    slot.add_argument(
+        "--slots",
+        default="auto",
+        help="concurrent flashes per bus, 'auto' derives it from the bus speed",
+    )
+    slot.add_argument(
+        "--card-mbps",
+        type=float,
+        default=20.0,
+        help="expected write speed of a single card in MB/s, for --slots auto",
+    )
+    slot.add_argument("--timeout", type=int, default=600)
+    slot.add_argument("cmd", nargs=argparse.REMAINDER)
+    slot.set_defaults(func=cmd_slot)
+
+    bus = subparsers.add_parser(
+        "bus", help="print the device's USB bus and how many flash slots it has"
+    )
+    bus.add_argument("--device", required=True, help="device that will be flashed")
+    bus.add_argument("--serial", help="USB serial of the card reader, if not attached")
+    bus.add_argument("--bus", help="USB bus of the device, detected if not set")
+    bus.add_argument(
+        "--slots",
+        default="auto",
+        help="concurrent flashes per bus, 'auto' derives it from the bus speed",
+    )
+    bus.add_argument(
+        "--card-mbps",
+        type=float,
+        default=20.0,
+        help="expected write speed of a single card in MB/s, for --slots auto",
+    )
+    bus.set_defaults(func=cmd_bus)
+
+    wait = subparsers.add_parser(
+        "wait", help="wait for block devices to become ready, or to vanish"
+    )
+    wait.add_argument("device", nargs="+")
+    wait.add_argument(
+        "--absent", action="store_true", help="wait for the devices to vanish instead"
+    )
+    wait.add_argument(
+        "--reread", metavar="DISK", help="reread the partition table of DISK first"
+    )
+    wait.add_argument("--timeout", type=float, default=30.0)
+    wait.set_defaults(func=cmd_wait)
+
+    state = subparsers.add_parser(
+        "state", help="write or check the fingerprint of what is on a card"
+    )
+    state.add_argument("action", choices=["write", "check"])
+    state.add_argument("device")
+    state.add_argument("record", help="path of the fingerprint on the flashhost")
+    state.add_argument("--image", required=True, help="hash of the flashed image")
+    state.add_argument(
+        "--provision", default="", help="hash of the provisioning inputs"
+    )
+    state.set_defaults(func=cmd_state)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "diff", False) and not args.record:
+        parser.error("--diff needs --record")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Artifact mirror for the flashhost.
+
+Serves release archives, plugin files and the like to the Pis on the LAN. Every
+upstream directory that gets mirrored is registered as an origin under a short key,
+``http://<flashhost>:<port>/<key>/<name>`` then maps to ``<origin>/<name>``. Files get
+fetched from upstream on first request and are served from disk after that, upstream
+is only asked again (conditionally) once they are older than the max age. If upstream
+is unreachable, the last copy gets served, so the mirror doubles as a stand-in for
+offline testing.
+
+Gets uploaded to the flashhost by the fabfile and is run there, so it must only ever
+depend on the standard library of the flashhost's Python 3.
+"""
+
+import argparse
+import base64
+import contextlib
+import email.utils
+import fcntl
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+READ_SIZE = 1024 * 1024
+
+
+def log(message):
+    print(message, flush=True)
+
+
+@contextlib.contextmanager
+def locked(path):
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def origin_key(origin):
+    return hashlib.sha256(origin.encode("utf-8")).hexdigest()[:16]
+
+
+def load_origins(root):
+    try:
+        with open(os.path.join(root, "origins.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def add_origin(root, url):
+    """Registers the directory of url as origin and returns the mirrored path of url."""
+    origin, _, name = url.rpartition("/")
+    key = origin_key(origin)
+
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, "origins.json")
+    with locked(path):
+        origins = load_origins(root)
+        if origins.get(key) != origin:
+            origins[key] = origin
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(origins, f, indent=2, sort_keys=True)
+            os.replace(tmp, path)
+
+    return "{}/{}".format(key, name)
+
+
+def upstream_request(url, meta):
+    """Builds the request for url, moving credentials into a header and revalidating."""
+    parts = urllib.parse.urlsplit(url)
+    headers = {"User-Agent": "octoprint-devtools"}
+    if parts.username:
+        credentials = "{}:{}".format(
+            urllib.parse.unquote(parts.username),
+            urllib.parse.unquote(parts.password or ""),
+        )
+        headers["Authorization"] = "Basic " + base64.b64encode(
+            credentials.encode("utf-8")
+        ).decode("ascii")
+        netloc = parts.hostname + (":{}".format(parts.port) if parts.port else "")
+        url = urllib.parse.urlunsplit(parts._replace(netloc=netloc))
+
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return urllib.request.Request(url, headers=headers)
+
+
+def refresh(root, key, name, max_age, timeout=30):
+    """
+    Makes sure ``root/key/name`` holds a copy of the upstream file that is at most
+    ``max_age`` seconds old, returns its metadata or None if there's no copy.
+    """
+    origin = load_origins(root).get(key)
+    if origin is None:
+        return None
+
+    path = os.path.join(root, key, name)
+    meta_path = path + ".json"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with locked(path):
+        meta = {}
+        if os.path.exists(path):
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {}
+            if time.time() - meta.get("checked", 0) < max_age:
+                return meta
+
+        url = "{}/{}".format(origin, urllib.parse.quote(name))
+        try:
+            response = urllib.request.urlopen(
+                upstream_request(url, meta if os.path.exists(path) else {}),
+                timeout=timeout,
+            )
+        except urllib.error.HTTPError as exc:
+            if exc.code == 304:
+                meta["checked"] = time.time()
+                save_meta(meta_path, meta)
+                return meta
+            log("Upstream answered {} for {}/{}".format(exc.code, key, name))
+            return meta or None
+        except OSError as exc:
+            # offline, serve what we have
+            log("Upstream unreachable for {}/{}: {}".format(key, name, exc))
+            return meta or None
+
+        tmp = path + ".part"
+        digest = hashlib.sha256()
+        with response, open(tmp, "wb") as f:
+            while True:
+                data = response.read(READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                f.write(data)
+        os.replace(tmp, path)
+
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_type": response.headers.get("Content-Type"),
+            "sha256": digest.hexdigest(),
+            "checked": time.time(),
+        }
+        save_meta(meta_path, meta)
+        log("Mirrored {}/{}".format(key, name))
+        return meta
+
+
+def save_meta(path, meta):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    root = None
+    max_age = 300
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body=True):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not all(parts) or any(p in (".", "..") for p in parts):
+            self.send_error(404)
+            return
+
+        key, name = parts
+        meta = refresh(self.root, key, name, self.max_age)
+        if meta is None:
+            self.send_error(404)
+            return
+
+        file_path = os.path.join(self.root, key, name)
+        stat = os.stat(file_path)
+        etag = '"{}"'.format(meta["sha256"])
+
+        headers = {
+            "ETag": etag,
+            "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+            "Cache-Control": "max-age={}".format(self.max_age),
+        }
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header(
+            "Content-Type", meta.get("content_type") or "application/octet-stream"
+        )
+        self.send_header("Content-Length", str(stat.st_size))
+        self.end_headers()
+        if body:
+            with open(file_path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, READ_SIZE)
+
+
+##~~ CLI ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def cmd_add(args):
+    print(add_origin(args.root, args.url))
+
+
+def cmd_serve(args):
+    os.makedirs(args.root, exist_ok=True)
+    MirrorHandler.root = args.root
+    MirrorHandler.max_age = args.max_age
+
+    server = http.server.ThreadingHTTPServer(("", args.port), MirrorHandler)
+    log("Serving mirror of {} on port {}".format(args.root, args.port))
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="flashhost artifact mirror")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    add = subparsers.add_parser(
+        "add", help="register the origin of a URL, prints the mirrored path"
+    )
+    add.add_argument("root", help="mirror directory")
+    add.add_argument("url")
+    add.set_defaults(func=cmd_add)
+
+    serve = subparsers.add_parser("serve", help="serve the mirror")
+    serve.add_argument("root", help="mirror directory")
+    serve.add_argument("--port", type=int, default=8041)
+    serve.add_argument(
+        "--max-age",
+        type=int,
+        default=300,
+        help="seconds before upstream gets asked again whether a file changed",
+    )
+    serve.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/bin/sh
+# Applies a provisioning bundle to a boot partition.
+#
+# Runs from the extracted bundle directory on the flashhost, which contains:
+#   boot/          files to copy onto the boot partition, if any
+#   config.txt     lines to append to config.txt, unless already present
+#   cmdline.txt    arguments to append to cmdline.txt, if any
+#
+# Usage: provision_boot.sh <mountpoint> [<device>]
+#
+# If a device is given it gets mounted on the mountpoint (unless already mounted) and
+# unmounted again afterwards, otherwise the mountpoint is expected to be populated.
+
+set -e
+
+bundle=$(dirname "$0")
+mount=$1
+device=$2
+
+if [ -n "$device" ]; then
+    mkdir -p "$mount"
+    if ! mountpoint -q "$mount"; then
+        mount "$device" "$mount"
+    fi
+    trap 'umount "$mount"' EXIT
+fi
+
+if [ -d "$bundle/boot" ]; then
+    cp -r "$bundle"/boot/. "$mount"/
+fi
+
+if [ -s "$bundle/config.txt" ]; then
+    while IFS= read -r line; do
+        grep -qxF "$line" "$mount/config.txt" || echo "$line" >> "$mount/config.txt"
+    done < "$bundle/config.txt"
+fi
+
+if [ -s "$bundle/cmdline.txt" ]; then
+    if ! grep -q "firstrun.sh" "$mount/cmdline.txt"; then
+        cmdline=$(tr -d '\n' < "$mount/cmdline.txt")
+        echo "$cmdline $(cat "$bundle/cmdline.txt")" > "$mount/cmdline.txt"
+    fi
+    echo "--- cmdline.txt"
+    cat "$mount/cmdline.txt"
+fi
+
+if [ ! -f "$mount/octopi.txt" ]; then
+    # not an octopi image, make sure to manually enable ssh
+    touch "$mount/ssh"
+fi
+
+sync
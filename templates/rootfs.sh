@@ -0,0 +1,146 @@
+#!/bin/bash
+
+# Offline counterpart of firstrun.sh: applies the same changes to a mounted rootfs
+# on the flashhost, so the DUT comes up fully configured on its first boot.
+#
+# Usage: rootfs.sh <rootfs mountpoint>
+
+set -e
+
+ROOT=$1
+
+# newer images bring their own tools for what firstrun.sh does, run them inside the
+# rootfs like firstrun.sh would, without network access to the flashhost's own wifi
+IMAGER_CUSTOM=/usr/lib/raspberrypi-sys-mods/imager_custom
+USERCONF=/usr/lib/userconf-pi/userconf
+
+unbind() {
+   for fs in dev sys proc; do
+      if mountpoint -q $ROOT/$fs; then
+         umount $ROOT/$fs
+      fi
+   done
+}
+trap unbind EXIT
+
+in_root() {
+   for fs in proc sys dev; do
+      if ! mountpoint -q $ROOT/$fs; then
+         mount --bind /$fs $ROOT/$fs
+      fi
+   done
+   unshare --net chroot $ROOT "$@"
+}
+
+CURRENT_HOSTNAME=`cat $ROOT/etc/hostname | tr -d " \t\n\r"`
+if [ -f $ROOT$IMAGER_CUSTOM ]; then
+   in_root $IMAGER_CUSTOM set_hostname {{ hostname }}
+else
+   echo {{ hostname }} >$ROOT/etc/hostname
+   sed -i "s/127.0.1.1.*$CURRENT_HOSTNAME/127.0.1.1\t{{ hostname }}/g" $ROOT/etc/hosts
+fi
+
+FIRSTUSER=`awk -F: '$3 == 1000 { print $1 }' $ROOT/etc/passwd`
+if [ -f $ROOT$USERCONF ]; then
+   in_root $USERCONF '{{ user }}' '{{ passwordhash }}'
+else
+   echo "$FIRSTUSER:"'{{ passwordhash }}' | chpasswd -R "$ROOT" -e
+   if [ "$FIRSTUSER" != "{{ user }}" ]; then
+      usermod -R "$ROOT" -l "{{ user }}" "$FIRSTUSER"
+      usermod -R "$ROOT" -m -d "/home/{{ user }}" "{{ user }}"
+      groupmod -R "$ROOT" -n "{{ user }}" "$FIRSTUSER"
+      if grep -qs "^autologin-user=" $ROOT/etc/lightdm/lightdm.conf ; then
+         sed $ROOT/etc/lightdm/lightdm.conf -i -e "s/^autologin-user=.*/autologin-user={{ user }}/"
+      fi
+      if [ -f $ROOT/etc/systemd/system/getty@tty1.service.d/autologin.conf ]; then
+         sed $ROOT/etc/systemd/system/getty@tty1.service.d/autologin.conf -i -e "s/$FIRSTUSER/{{ user }}/"
+      fi
+      if [ -f $ROOT/etc/sudoers.d/010_pi-nopasswd ]; then
+         sed -i "s/^$FIRSTUSER /{{ user }} /" $ROOT/etc/sudoers.d/010_pi-nopasswd
+      fi
+   fi
+
+   if [ -f $ROOT/lib/systemd/system/userconfig.service ]; then
+      # what userconf-pi does once a user is set: no first boot user wizard
+      rm -f $ROOT/etc/systemd/system/multi-user.target.wants/userconfig.service
+      mkdir -p $ROOT/etc/systemd/system/getty.target.wants
+      ln -sf /lib/systemd/system/getty@.service $ROOT/etc/systemd/system/getty.target.wants/getty@tty1.service
+   fi
+fi
+
+if [ -f $ROOT$IMAGER_CUSTOM ]; then
+   in_root $IMAGER_CUSTOM set_wlan '{{ ssid }}' '{{ psk }}' '{{ country }}'
+else
+   cat >$ROOT/etc/wpa_supplicant/wpa_supplicant.conf <<'WPAEOF'
+country={{ country }}
+ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev
+ap_scan=1
+
+update_config=1
+network={
+	ssid="{{ ssid }}"
+	psk={{ psk }}
+}
+
+WPAEOF
+   chmod 600 $ROOT/etc/wpa_supplicant/wpa_supplicant.conf
+
+   if [ -d $ROOT/etc/NetworkManager/system-connections ]; then
+      cat >$ROOT/etc/NetworkManager/system-connections/preconfigured.nmconnection <<'NMEOF'
+[connection]
+id=preconfigured
+type=wifi
+
+[wifi]
+mode=infrastructure
+ssid={{ ssid }}
+
+[wifi-security]
+key-mgmt=wpa-psk
+psk={{ psk }}
+
+[ipv4]
+method=auto
+
+[ipv6]
+method=auto
+NMEOF
+      chmod 600 $ROOT/etc/NetworkManager/system-connections/preconfigured.nmconnection
+   fi
+fi
+unbind
+
+# firstrun.sh unblocks wifi on the running system, the closest thing offline is the
+# saved rfkill state plus a unit doing the unblock once on the first boot
+for filename in $ROOT/var/lib/systemd/rfkill/*:wlan ; do
+   if [ -e "$filename" ]; then
+      echo 0 > $filename
+   fi
+done
+
+if [ -x $ROOT/usr/sbin/rfkill ]; then
+   mkdir -p $ROOT/etc/systemd/system/multi-user.target.wants
+   cat >$ROOT/etc/systemd/system/rfkill-unblock-wifi.service <<'RFKILLEOF'
+[Unit]
+Description=Unblock wifi once after offline provisioning
+After=systemd-rfkill.service
+Before=network-pre.target
+Wants=network-pre.target
+
+[Service]
+Type=oneshot
+ExecStart=-/usr/sbin/rfkill unblock wifi
+ExecStart=/bin/rm -f /etc/systemd/system/multi-user.target.wants/rfkill-unblock-wifi.service /etc/systemd/system/rfkill-unblock-wifi.service
+
+[Install]
+WantedBy=multi-user.target
+RFKILLEOF
+   ln -sf /etc/systemd/system/rfkill-unblock-wifi.service $ROOT/etc/systemd/system/multi-user.target.wants/rfkill-unblock-wifi.service
+fi
+
+if [ -f $ROOT/lib/systemd/system/ssh.service ]; then
+   mkdir -p $ROOT/etc/systemd/system/multi-user.target.wants
+   ln -sf /lib/systemd/system/ssh.service $ROOT/etc/systemd/system/multi-user.target.wants/ssh.service
+fi
+
+exit 0